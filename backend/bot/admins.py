@@ -0,0 +1,148 @@
+"""
+Admin lists of chats shared by all bot processes.
+
+Admin IDs of a chat are kept in redis set `admins:<chat_id>` for `ADMIN_CACHE_EXPIRY` seconds,
+so `getChatAdministrators` is called about once per expiry per chat by all processes together.
+In between the set is updated incrementally:
+- `chat_member`/`my_chat_member` updates (raw updates received by webhook view)
+- members that left chat
+- when user isn't in the set, it is refreshed at most once per `ADMIN_REFRESH_COOLDOWN`,
+  because promotions are invisible to the bot otherwise
+- admin-only actions confirm that user is still admin by `getChatMember`, because demotions
+  are invisible until the next full refresh otherwise
+
+Bot's own status is kept separately in `admins:bot:<chat_id>` ("1" or "0"): it's updated by
+`my_chat_member` updates and full refreshes, so chats where bot isn't admin don't cause
+refreshes on every check.
+"""
+import logging
+from typing import Set
+
+from django.conf import settings
+from telegram import Bot
+
+from bot import metrics, redis
+from bot.memoize import memoize
+
+logger = logging.getLogger(__name__)
+
+ADMIN_STATUSES = ('creator', 'administrator')
+# set always contains this member, so empty admin list is distinguishable from missing key
+PLACEHOLDER = '-'
+
+UPDATE_SCRIPT = """
+-- KEYS: admins
+-- ARGV: SADD or SREM, user ID
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call(ARGV[1], KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+update_script = redis.rc.register_script(UPDATE_SCRIPT)
+
+
+def _key(chat_id):
+    return f'admins:{chat_id}'
+
+
+def _bot_key(chat_id):
+    return f'admins:bot:{chat_id}'
+
+
+def fetch_admin_ids(bot: Bot, chat_id) -> Set[int]:
+    """Get admins from telegram and store them in redis."""
+    metrics.inc('admin_list_api_calls')
+    ids = {admin.user.id for admin in bot.get_chat_administrators(chat_id)}
+    key = _key(chat_id)
+    pipe = redis.rc.pipeline()
+    pipe.delete(key)
+    pipe.sadd(key, PLACEHOLDER, *ids)
+    pipe.expire(key, settings.ADMIN_CACHE_EXPIRY)
+    pipe.set(_bot_key(chat_id), int(bot.id in ids), ex=settings.ADMIN_CACHE_EXPIRY)
+    pipe.execute()
+    get_bot_status.cache.invalidate(bot, chat_id)
+    return ids
+
+
+# the same bot everywhere, so entries are keyed by chat only and can be dropped w/o bot
+@memoize(ttl=10, maxsize=10000, name='admin_ids', key=lambda bot, chat_id: chat_id)
+def get_admin_ids(bot: Bot, chat_id) -> Set[int]:
+    """Returns a set of admin IDs for a given chat. Shared by processes, 10s local cache."""
+    members = redis.rc.smembers(_key(chat_id))
+    if members:
+        return {int(m) for m in members if m.decode() != PLACEHOLDER}
+    return fetch_admin_ids(bot, chat_id)
+
+
+@memoize(ttl=10, maxsize=10000, name='bot_status', key=lambda bot, chat_id: chat_id)
+def get_bot_status(bot: Bot, chat_id) -> bool:
+    """Whether bot is admin of chat. Shared by processes, 10s local cache."""
+    status = redis.rc.get(_bot_key(chat_id))
+    if status is not None:
+        return status == b'1'
+    return bot.id in fetch_admin_ids(bot, chat_id)
+
+
+def set_bot_status(chat_id, is_admin: bool):
+    redis.rc.set(_bot_key(chat_id), int(is_admin), ex=settings.ADMIN_CACHE_EXPIRY)
+    get_bot_status.cache.invalidate(None, chat_id)
+
+
+def verify_admin(bot: Bot, user_id, chat_id) -> bool:
+    """Check user's status by telegram and drop user from admin list if it was demoted."""
+    metrics.inc('admin_verify_api_calls')
+    is_admin = bot.get_chat_member(chat_id, user_id).status in ADMIN_STATUSES
+    if not is_admin:
+        set_admin(chat_id, user_id, False)
+    return is_admin
+
+
+def is_chat_admin(bot: Bot, user_id, chat_id, verify=False) -> bool:
+    """
+    :param verify: confirm positive answer by telegram (for admin-only actions),
+        otherwise demoted admin is considered admin until the next full refresh
+    """
+    if user_id in get_admin_ids(bot, chat_id):
+        return not verify or verify_admin(bot, user_id, chat_id)
+    # user could be promoted since last refresh
+    cooldown_key = f'admins:refreshed:{chat_id}'
+    if not redis.rc.set(cooldown_key, 1, nx=True, ex=settings.ADMIN_REFRESH_COOLDOWN):
+        return False
+    get_admin_ids.cache.invalidate(bot, chat_id)
+    return user_id in fetch_admin_ids(bot, chat_id)
+
+
+def set_admin(chat_id, user_id, is_admin: bool):
+    """Update cached admin list of chat (if it's cached) with a single change."""
+    command = 'SADD' if is_admin else 'SREM'
+    update_script(keys=[_key(chat_id)], args=[command, user_id], client=redis.rc)
+    get_admin_ids.cache.invalidate(None, chat_id)
+
+
+def apply_chat_member_update(data: dict) -> bool:
+    """
+    Update admin list by raw `chat_member` or `my_chat_member` update.
+    Return True if update was one of them.
+    """
+    member_update = data.get('chat_member') or data.get('my_chat_member')
+    if not member_update:
+        return False
+    try:
+        chat_id = member_update['chat']['id']
+        member = member_update['new_chat_member']
+        user_id = member['user']['id']
+        status = member['status']
+        old_status = (member_update.get('old_chat_member') or {}).get('status')
+    except (KeyError, TypeError, AttributeError):
+        logger.warning(f"malformed chat member update: {data}")
+        return True
+    if 'my_chat_member' in data:
+        # bot's own status, it changes rarely
+        set_bot_status(chat_id, status in ADMIN_STATUSES)
+    if status not in ADMIN_STATUSES and old_status not in ADMIN_STATUSES:
+        # members that join and leave don't change admin list
+        return True
+    set_admin(chat_id, user_id, status in ADMIN_STATUSES)
+    metrics.inc('admin_list_incremental_updates')
+    return True
@@ -0,0 +1,266 @@
+"""
+Non-blocking transport for Telegram Bot API.
+
+`AsyncRequest` is a drop-in replacement of python-telegram-bot's `Request`: all requests are
+made by a single asyncio loop in a background thread, so a process can keep hundreds
+of calls in flight instead of being limited by its urllib3 connection pool.
+Bot methods keep their usual blocking behaviour, except calls made with `defer`:
+they are only submitted to the loop and return True right away, errors are logged.
+Use `defer` for calls whose result handler doesn't need (answer callback query, delete message).
+
+While webhook request is processed, the first call made with `respond` isn't sent at all:
+it becomes the body of webhook response and Telegram executes it (saves a round trip).
+Further calls are sent as usual.
+
+File uploads are sent by the original urllib3 implementation.
+"""
+import asyncio
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from django.conf import settings
+from telegram import Bot, InputFile, InputMedia
+from telegram.error import (
+    BadRequest, Conflict, InvalidToken, NetworkError, TelegramError, TimedOut, Unauthorized,
+)
+from telegram.utils.request import Request, USER_AGENT
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.simple_httpclient import HTTPTimeoutError
+
+from bot import metrics, ratelimit
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def is_deferred() -> bool:
+    return getattr(_local, 'deferred', False)
+
+
+@contextmanager
+def deferred():
+    """Bot methods called within this block don't wait for response (with `AsyncRequest`)."""
+    previous = is_deferred()
+    _local.deferred = True
+    try:
+        yield
+    finally:
+        _local.deferred = previous
+
+
+def defer(method, *args, **kwargs):
+    """Call bot method (or `message.delete` etc.) w/o waiting for response."""
+    with deferred():
+        return method(*args, **kwargs)
+
+
+class WebhookReply:
+    """Bot API call that will be sent as response to webhook request."""
+    def __init__(self):
+        self.data: Optional[dict] = None
+
+
+@contextmanager
+def webhook_reply() -> Iterator[WebhookReply]:
+    """Calls made with `respond` within this block can be captured into returned reply."""
+    previous = getattr(_local, 'webhook_reply', None)
+    reply = _local.webhook_reply = WebhookReply()
+    try:
+        yield reply
+    finally:
+        _local.webhook_reply = previous
+
+
+def can_respond() -> bool:
+    reply = getattr(_local, 'webhook_reply', None)
+    return reply is not None and reply.data is None
+
+
+def respond(method, *args, **kwargs):
+    """
+    Call bot method as response to webhook request if it's still possible, otherwise as usual.
+    Response doesn't return result of the call, so use it only if caller doesn't need one.
+    """
+    previous = getattr(_local, 'responding', False)
+    _local.responding = True
+    try:
+        return method(*args, **kwargs)
+    finally:
+        _local.responding = previous
+
+
+def raise_for_status(status: int, body: bytes):
+    """Same errors as `Request._request_wrapper` raises for unsuccessful responses."""
+    try:
+        message = Request._parse(body)
+    except ValueError:
+        message = 'Unknown HTTPError'
+
+    if status in (401, 403):
+        raise Unauthorized(message)
+    elif status == 400:
+        raise BadRequest(message)
+    elif status == 404:
+        raise InvalidToken()
+    elif status == 409:
+        raise Conflict(message)
+    elif status == 413:
+        raise NetworkError('File too large. Check telegram api limits '
+                           'https://core.telegram.org/bots/api#senddocument')
+    elif status == 502:
+        raise NetworkError('Bad Gateway')
+    else:
+        raise NetworkError(f'{message} ({status})')
+
+
+def make_json_data(data: dict) -> Optional[dict]:
+    """Convert request to JSON serializable dict, return None if it contains files."""
+    res = {}
+    for key, val in data.items():
+        if isinstance(val, InputFile):
+            return
+        if key == 'media':
+            media = [val] if isinstance(val, InputMedia) else val
+            if any(isinstance(m.media, InputFile) for m in media):
+                return
+            val = val.to_dict() if isinstance(val, InputMedia) else [m.to_dict() for m in val]
+        res[key] = val
+    return res
+
+
+def make_json_body(data: dict) -> Optional[bytes]:
+    """Encode request as JSON, return None if it contains files (needs multipart)."""
+    res = make_json_data(data)
+    if res is not None:
+        return json.dumps(res).encode('utf-8')
+
+
+class AsyncRequest(Request):
+    def __init__(self, max_clients=100, connect_timeout=5., read_timeout=5., **kwargs):
+        # urllib3 pool is used only for uploads
+        super().__init__(connect_timeout=connect_timeout, read_timeout=read_timeout, **kwargs)
+        self._read_timeout = read_timeout
+        self._max_clients = max_clients
+        self._client = None
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name='bot-api', daemon=True)
+        self._thread.start()
+
+    @property
+    def con_pool_size(self):
+        return self._max_clients
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    async def _post(self, url, body: bytes, timeout):
+        if self._client is None:
+            self._client = AsyncHTTPClient(force_instance=True, max_clients=self._max_clients)
+        read_timeout = self._read_timeout if timeout is None else timeout
+        request = HTTPRequest(
+            url,
+            method='POST',
+            body=body,
+            headers={
+                'Content-Type': 'application/json',
+                'Connection': 'keep-alive',
+                'User-Agent': USER_AGENT,
+            },
+            connect_timeout=self._connect_timeout,
+            request_timeout=self._connect_timeout + read_timeout if read_timeout else None,
+        )
+        try:
+            response = await self._client.fetch(request, raise_error=False)
+        except HTTPTimeoutError:
+            raise TimedOut()
+        except Exception as e:
+            raise NetworkError(f'tornado error {e!r}')
+        if not 200 <= response.code <= 299:
+            raise_for_status(response.code, response.body)
+        return self._parse(response.body)
+
+    async def _call(self, url, body: bytes, timeout, background: bool):
+        try:
+            return await self._post(url, body, timeout)
+        except Exception as e:
+            if not background:
+                raise
+            metrics.inc('api_deferred_errors')
+            method = url.rsplit('/', 1)[-1]
+            if isinstance(e, TelegramError):
+                logger.debug(f"{method} failed: {e!r}")
+            else:
+                logger.error(f"{method} failed: {e!r}")
+        finally:
+            with self._idle:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.notify_all()
+
+    def join(self, timeout=None) -> bool:
+        """Wait until all submitted requests are finished."""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def post(self, url, data, timeout=None):
+        body = make_json_body(data)
+        if body is None:
+            return super().post(url, data, timeout)
+        background = is_deferred()
+        with self._idle:
+            self._pending += 1
+        future = asyncio.run_coroutine_threadsafe(
+            self._call(url, body, timeout, background), self._loop
+        )
+        if not background:
+            return future.result()
+        metrics.inc('api_deferred_calls')
+        return True
+
+    def stop(self):
+        self.join(self._connect_timeout + self._read_timeout)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        super().stop()
+
+
+class WebhookReplyRequest:
+    """Wraps `Request`, so calls made with `respond` can be captured into webhook reply."""
+    def __init__(self, request):
+        self.request = request
+
+    def __getattr__(self, name):
+        return getattr(self.request, name)
+
+    def post(self, url, data, timeout=None):
+        if getattr(_local, 'responding', False) and can_respond():
+            json_data = make_json_data(data)
+            if json_data is not None:
+                method = url.rsplit('/', 1)[-1]
+                _local.webhook_reply.data = {'method': method, **json_data}
+                metrics.inc('webhook_reply_calls')
+                return True
+        return self.request.post(url, data, timeout)
+
+
+def make_bot(**kwargs) -> Bot:
+    """Bot that uses `AsyncRequest` if `TG_API_ASYNC` is on and is rate limited."""
+    if 'request' not in kwargs:
+        if settings.TG_API_ASYNC:
+            request = AsyncRequest(max_clients=settings.TG_API_MAX_CONNECTIONS)
+        else:
+            # same pool as `Updater` makes for its own bot
+            request = Request(con_pool_size=settings.TG_BOT_WORKERS + 4)
+        request = WebhookReplyRequest(request)
+        if settings.TG_RATE_LIMIT:
+            request = ratelimit.RateLimitedRequest(
+                request, ratelimit.make_scheduler(), retries=settings.TG_RATE_RETRIES
+            )
+        kwargs['request'] = request
+    return Bot(settings.TG_BOT_TOKEN, **kwargs)
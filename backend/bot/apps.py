@@ -4,3 +4,16 @@ from django.apps import AppConfig
 class BotConfig(AppConfig):
     name = 'bot'
     verbose_name = 'Bot App'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+
+        from bot import chat_config
+        from core.models import Chat
+
+        post_save.connect(
+            chat_config.on_chat_saved, sender=Chat, dispatch_uid='chat_config_saved'
+        )
+        post_delete.connect(
+            chat_config.on_chat_deleted, sender=Chat, dispatch_uid='chat_config_deleted'
+        )
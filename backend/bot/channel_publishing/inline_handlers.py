@@ -16,9 +16,10 @@ from telegram.error import BadRequest
 from telegram.ext import CallbackContext
 
 from bot.markup import make_reactions_keyboard, make_reply_markup
-from bot.utils import get_message_type
+from bot.upserts import get_user_from_update
+from bot.utils import edit_reply_markup, get_message_type
 from bot.wrapper import chosen_inline_handler, inline_query_handler
-from core.models import Message, MessageToPublish, User
+from core.models import Message, MessageToPublish
 
 logger = logging.getLogger(__name__)
 
@@ -93,7 +94,7 @@ def handle_publishing(update: Update, context: CallbackContext):
 
     message = Message.objects.create_from_inline(
         inline_message_id=inline_id,
-        from_user=User.objects.from_update(update),
+        from_user=get_user_from_update(update),
         buttons=buttons,
     )
     _, reply_markup = make_reply_markup(
@@ -103,8 +104,11 @@ def handle_publishing(update: Update, context: CallbackContext):
         message=message,
     )
     try:
-        context.bot.edit_message_reply_markup(
-            reply_markup=reply_markup,
+        edit_reply_markup(
+            context.bot,
+            message.id,
+            reply_markup,
+            respond=False,
             inline_message_id=inline_id,
         )
     except BadRequest:  # message was deleted too fast (probably by the same bot in chat)
@@ -8,10 +8,13 @@ from telegram import (
 from telegram.ext import CallbackContext, Filters
 
 from bot import redis
+from bot.counters import toggle_reaction
 from bot.filters import StateFilter
 from bot.markup import make_reply_markup
+from bot.markup_updater import markup_updater
+from bot.utils import edit_reply_markup
 from bot.wrapper import message_handler
-from core.models import Message, Reaction
+from core.models import Message
 
 logger = logging.getLogger(__name__)
 
@@ -39,7 +42,7 @@ def handle_reaction_response(update: Update, context: CallbackContext):
         return
 
     mids = message.ids
-    _, button = Reaction.objects.react(
+    _, button, reactions = toggle_reaction(
         user=user,
         button_text=reaction,
         **mids,
@@ -47,6 +50,12 @@ def handle_reaction_response(update: Update, context: CallbackContext):
     if not button:
         msg.reply_text(f"Post already has too many reactions.")
         return
-    _, reply_markup = make_reply_markup(update, context.bot, message=message)
-    context.bot.edit_message_reply_markup(reply_markup=reply_markup, **mids)
+
+    def edit_markup(fresh_reactions=None):
+        if fresh_reactions is None:
+            message.refresh_from_db(fields=['button_counts'])
+        _, reply_markup = make_reply_markup(update, context.bot, fresh_reactions, message=message)
+        edit_reply_markup(context.bot, message.id, reply_markup, **mids)
+
+    markup_updater.schedule(message.id, edit_markup, reactions)
     msg.reply_text(f"Reacted with {reaction}")
@@ -0,0 +1,242 @@
+"""
+Cache of chat settings shared by all bot processes.
+
+Chats are kept in an in-process LRU backed by redis. Every save or delete of a chat
+(`/edit`, django admin, upserts) overwrites redis copy and publishes chat ID to `CHANNEL`,
+and every process that uses the cache listens to it and drops its local copy.
+Local copies also expire after `CHAT_CACHE_TTL` seconds in case a notification was missed.
+Values that were loaded while some chat was invalidated aren't kept locally, as they may
+be older than the invalidation.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+
+from bot import metrics, redis
+from core.models import Chat, Message
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'chat:config:invalidate'
+
+_field_names = [f.attname for f in Chat._meta.concrete_fields]
+_local = OrderedDict()
+_lock = threading.Lock()
+# incremented by every invalidation of local copies
+_generation = 0
+_listener: Optional['Listener'] = None
+
+
+def _key(chat_id):
+    return f'chat:config:{chat_id}'
+
+
+def _dump(chat: Chat) -> str:
+    return json.dumps([getattr(chat, name) for name in _field_names])
+
+
+def _make_chat(data: str) -> Optional[Chat]:
+    # decode on every call, so callers can't spoil cached values (eg: append to buttons)
+    values = json.loads(data)
+    if values is None:
+        return
+    return Chat.from_db('default', _field_names, values)
+
+
+def _make_settings(data: str) -> Optional[Mapping]:
+    values = json.loads(data)
+    if values is None:
+        return
+    return MappingProxyType({
+        name: tuple(value) if isinstance(value, list) else value
+        for name, value in zip(_field_names, values)
+    })
+
+
+def _get_generation() -> int:
+    with _lock:
+        return _generation
+
+
+def _get_local(chat_id) -> Optional[Tuple[str, Optional[Mapping]]]:
+    with _lock:
+        item = _local.get(chat_id)
+        if item is None:
+            return
+        data, chat_settings, expires = item
+        if expires < time.monotonic():
+            del _local[chat_id]
+            return
+        _local.move_to_end(chat_id)
+        return data, chat_settings
+
+
+def _set_local(chat_id, data: str, generation: int) -> Tuple[str, Optional[Mapping]]:
+    """Keep loaded data locally unless something was invalidated since `generation`."""
+    chat_settings = _make_settings(data)
+    with _lock:
+        if generation != _generation:
+            return data, chat_settings
+        _local[chat_id] = (data, chat_settings, time.monotonic() + settings.CHAT_CACHE_TTL)
+        _local.move_to_end(chat_id)
+        while len(_local) > settings.CHAT_CACHE_SIZE:
+            _local.popitem(last=False)
+    return data, chat_settings
+
+
+def forget_local(chat_id=None):
+    """Drop local copy of chat settings or of all chats if `chat_id` is None."""
+    global _generation
+    with _lock:
+        _generation += 1
+        if chat_id is None:
+            _local.clear()
+        else:
+            _local.pop(str(chat_id), None)
+
+
+def _load(chat_id: str) -> Tuple[str, Optional[Mapping]]:
+    """Return encoded chat and its settings using local cache, redis and DB in that order."""
+    start_listener()
+
+    item = _get_local(chat_id)
+    if item is not None:
+        metrics.inc('chat_config_local_hits')
+        return item
+
+    generation = _get_generation()
+    try:
+        data = redis.rc.get(_key(chat_id))
+    except Exception:
+        logger.exception("failed to get chat config")
+        data = None
+    if data is not None:
+        metrics.inc('chat_config_redis_hits')
+        return _set_local(chat_id, data.decode(), generation)
+
+    metrics.inc('chat_config_misses')
+    chat = Chat.objects.filter(id=chat_id).first()
+    if chat is None:
+        # remember locally that chat doesn't exist, creation of chat will invalidate it
+        return _set_local(chat_id, 'null', generation)
+    data = _dump(chat)
+    try:
+        # don't overwrite values that were stored by concurrent save
+        redis.rc.set(_key(chat_id), data, ex=settings.CHAT_CACHE_EXPIRY, nx=True)
+    except Exception:
+        logger.exception("failed to set chat config")
+    return _set_local(chat_id, data, generation)
+
+
+def get_chat(chat_id) -> Optional[Chat]:
+    """Return chat by ID using local cache, redis and DB in that order."""
+    if chat_id is None:
+        return
+    if settings.CHAT_CACHE_SIZE <= 0:
+        return Chat.objects.filter(id=chat_id).first()
+    data, _ = _load(str(chat_id))
+    return _make_chat(data)
+
+
+def get_settings(chat_id) -> Optional[Mapping]:
+    """
+    Same as `get_chat` but returns read-only mapping of chat's fields (lists become tuples).
+    Mapping is shared by all callers, so it's cheaper than chat instance on hot paths.
+    """
+    if chat_id is None:
+        return
+    if settings.CHAT_CACHE_SIZE <= 0:
+        chat = Chat.objects.filter(id=chat_id).first()
+        return chat and _make_settings(_dump(chat))
+    _, chat_settings = _load(str(chat_id))
+    return chat_settings
+
+
+def get_message_chat(message: Message) -> Optional[Chat]:
+    """Same as `message.chat` but uses cache. Also stores chat in message's relation cache."""
+    if message.chat_id is None:
+        return
+    if Message.chat.is_cached(message):
+        return message.chat
+    chat = get_chat(message.chat_id)
+    if chat is not None:
+        message.chat = chat
+    return chat
+
+
+def invalidate(chat_id, chat: Chat = None):
+    """
+    Replace chat settings in redis with `chat` (or drop them if it is None)
+    and notify all processes to drop their local copies.
+    """
+    chat_id = str(chat_id)
+    try:
+        pipe = redis.rc.pipeline()
+        if chat is None:
+            pipe.delete(_key(chat_id))
+        else:
+            pipe.set(_key(chat_id), _dump(chat), ex=settings.CHAT_CACHE_EXPIRY)
+        pipe.publish(CHANNEL, chat_id)
+        pipe.execute()
+    except Exception:
+        logger.exception("failed to invalidate chat config")
+    finally:
+        # after redis was updated, so concurrent loads of old values aren't kept
+        forget_local(chat_id)
+
+
+def on_chat_saved(sender, instance: Chat, **kwargs):
+    # after commit, so other processes can't cache old values in between
+    transaction.on_commit(lambda: invalidate(instance.id, instance))
+
+
+def on_chat_deleted(sender, instance: Chat, **kwargs):
+    transaction.on_commit(lambda: invalidate(instance.id))
+
+
+class Listener(threading.Thread):
+    """Drop local copies of chats that were changed by other processes."""
+    def __init__(self):
+        super().__init__(name='chat-config-listener', daemon=True)
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            pubsub = None
+            try:
+                pubsub = redis.rc.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                # notifications could be missed while we were disconnected
+                forget_local()
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=1)
+                    if message is not None:
+                        forget_local(message['data'].decode())
+            except Exception:
+                logger.exception("chat config listener failed")
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+            self._stopped.wait(1)
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+def start_listener():
+    global _listener
+    if _listener is not None:
+        return
+    with _lock:
+        if _listener is None:
+            _listener = Listener()
+            _listener.start()
@@ -0,0 +1,100 @@
+"""
+Bounded `user_data` and `chat_data` of dispatcher.
+
+python-telegram-bot keeps a dict for every user and chat it has ever seen (they are created
+by `CallbackContext.from_update` even if handlers don't use them), so a long-running process
+grows with its audience. `ContextData` keeps dicts of at most `CONTEXT_DATA_SIZE` recently
+seen users (chats) for `CONTEXT_DATA_TTL` seconds since the last access, older ones are
+evicted and start empty next time. With size 0 nothing is kept.
+"""
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from django.conf import settings
+from telegram.ext import Dispatcher
+
+from bot import metrics
+
+
+class ContextData(MutableMapping):
+    """Replacement of `defaultdict(dict)`: LRU of dicts with expiration."""
+    def __init__(self, name: str, size: int, ttl: float):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        # key -> (dict, time of last access), from the least recently used
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._expired_at = 0.0
+        self._evicted = 0
+
+    def _evict(self, now):
+        # an entry is added per call, so at most one is over the size
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+            self._evicted += 1
+        if now - self._expired_at < 1:
+            return
+        # expired entries are removed (and evictions are counted) at most once a second,
+        # expired ones that are accessed before that start empty anyway
+        self._expired_at = now
+        while self._data:
+            key = next(iter(self._data))
+            if now - self._data[key][1] <= self.ttl:
+                break
+            del self._data[key]
+            self._evicted += 1
+        if self._evicted:
+            metrics.inc(f'{self.name}_evicted', self._evicted)
+            self._evicted = 0
+
+    def __getitem__(self, key) -> dict:
+        if not self.size:
+            return {}
+        now = time.monotonic()
+        with self._lock:
+            value, used = self._data.pop(key, (None, now))
+            if value is None or now - used > self.ttl:
+                value = {}
+            self._data[key] = (value, now)
+            self._evict(now)
+        return value
+
+    def __contains__(self, key) -> bool:
+        # doesn't add an entry like `__getitem__`
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and now - item[1] <= self.ttl
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __setitem__(self, key, value: dict):
+        if not self.size:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, now)
+            self._evict(now)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+
+def bound_context_data(dp: Dispatcher):
+    """Replace unbounded `user_data` and `chat_data` of dispatcher."""
+    size, ttl = settings.CONTEXT_DATA_SIZE, settings.CONTEXT_DATA_TTL
+    dp.user_data = ContextData('user_data', size, ttl)
+    dp.chat_data = ContextData('chat_data', size, ttl)
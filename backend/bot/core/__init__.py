@@ -7,5 +7,5 @@ from .commands import (
     command_start,
 )
 from .edit_command import command_edit
-from .misc_handlers import handle_bot_is_new_member, handle_error
+from .misc_handlers import handle_bot_is_new_member, handle_error, handle_member_left
 from .query_callback_handlers import handle_button_callback, handle_empty_callback
@@ -3,6 +3,7 @@ import logging
 from telegram import Update
 from telegram.ext import CallbackContext, Filters
 
+from bot import admins
 from bot.wrapper import message_handler
 from core.models import Chat
 
@@ -20,3 +21,9 @@ def handle_bot_is_new_member(update: Update, context: CallbackContext):
     for member in msg.new_chat_members:
         if member.id == context.bot.id:
             Chat.objects.get_or_create(id=msg.chat_id)
+
+
+@message_handler(Filters.status_update.left_chat_member)
+def handle_member_left(update: Update, _: CallbackContext):
+    msg = update.effective_message
+    admins.set_admin(msg.chat_id, msg.left_chat_member.id, False)
@@ -1,31 +1,50 @@
 import logging
+import time
 
+from django.conf import settings
 from telegram import Update
 from telegram.error import BadRequest, TimedOut
 from telegram.ext import CallbackContext
 
-from core.models import Reaction, Message
+from core.models import Message
+from bot import metrics
+from bot.api import defer, respond
+from bot.counters import toggle_reaction
 from bot.markup import make_reply_markup
+from bot.markup_updater import markup_updater
+from bot.utils import edit_reply_markup
 from bot.wrapper import callback_query_handler
 
 logger = logging.getLogger(__name__)
 
 
 def reply_to_reaction(bot, query, button, reaction):
-    if reaction:
+    if button is None:
+        reply = "Post already has too many reactions."
+    elif reaction:
         reply = f"You reacted with {button.text}."
     else:
         reply = "You took your reaction back."
-    bot.answer_callback_query(query.id, reply)
+    defer(respond, bot.answer_callback_query, query.id, reply)
 
 
 @callback_query_handler(pattern=r"^button:(.+)$")
 def handle_button_callback(update: Update, context: CallbackContext):
+    """
+    Toggle reaction. With `CALLBACK_FAST_ACK` the query is answered before any DB work
+    and user sees the result only in updated markup, otherwise answer tells what was done.
+    """
+    start = time.monotonic()
     msg = update.effective_message
     user = update.effective_user
     query = update.callback_query
     text = context.match[1]
 
+    fast_ack = settings.CALLBACK_FAST_ACK
+    if fast_ack:
+        defer(context.bot.answer_callback_query, query.id)
+        metrics.observe('callback_ack_seconds_fast', time.monotonic() - start)
+
     mids = dict(
         chat_id=msg and msg.chat and msg.chat_id,
         message_id=msg and msg.message_id,
@@ -35,23 +54,39 @@ def handle_button_callback(update: Update, context: CallbackContext):
         message = Message.objects.prefetch_related().get_by_ids(**mids)
     except Message.DoesNotExist:
         logger.debug(f"Message {mids} doesn't exist.")
+        if not fast_ack:
+            defer(respond, context.bot.answer_callback_query, query.id)
         return
 
-    reaction, button = Reaction.objects.react(
+    reaction, button, reactions = toggle_reaction(
         user=user,
         button_text=text,
         **mids,
     )
-    reply_to_reaction(context.bot, query, button, reaction)
-    _, reply_markup = make_reply_markup(update, context.bot, message=message)
-    try:
-        context.bot.edit_message_reply_markup(reply_markup=reply_markup, **mids)
-    except TimedOut:
-        logger.debug("timeout")
-    except BadRequest as e:
-        logger.debug(f"😡 {e}")
+    if button is None:
+        logger.debug(f"Reaction {text} to {mids} wasn't added.")
+        if fast_ack:
+            # the button is on keyboard, so it's rejected only if others were added meanwhile;
+            # user sees that in refreshed markup
+            metrics.inc('callback_rejected_after_ack')
+    if not fast_ack:
+        reply_to_reaction(context.bot, query, button, reaction)
+        metrics.observe('callback_ack_seconds_full', time.monotonic() - start)
+
+    def edit_markup(fresh_reactions=None):
+        if fresh_reactions is None:
+            message.refresh_from_db(fields=['button_counts'])
+        _, reply_markup = make_reply_markup(update, context.bot, fresh_reactions, message=message)
+        try:
+            edit_reply_markup(context.bot, message.id, reply_markup, **mids)
+        except TimedOut:
+            logger.debug("timeout")
+        except BadRequest as e:
+            logger.debug(f"😡 {e}")
+
+    markup_updater.schedule(message.id, edit_markup, reactions)
 
 
 @callback_query_handler(pattern="^~$")
 def handle_empty_callback(update: Update, _: CallbackContext):
-    update.callback_query.answer(cache_time=10)
+    defer(respond, update.callback_query.answer, cache_time=10)
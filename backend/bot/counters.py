@@ -0,0 +1,367 @@
+"""
+Redis-backed reaction counters with write-behind persistence.
+
+When `REACTIONS_BACKEND = 'redis'` click handlers toggle reactions in redis only:
+
+- `reactions:<umid>:buttons` - list of button texts (button index == position)
+- `reactions:<umid>:counts` - hash of button text -> count
+- `reactions:<umid>:permanent` - set of permanent button texts
+- `reactions:<umid>:users` - hash of user id -> button text
+- `reactions:<umid>:changes` - hash of user id -> last reaction change (journal)
+- `reactions:dirty` - set of messages with unflushed changes
+
+State is loaded from DB on first click and expires after `REACTIONS_CACHE_EXPIRY`. If it has
+expired with unflushed changes, they are flushed before state is loaded again.
+`Flusher` periodically moves journal into `reactions:<umid>:flushing` and persists it into DB
+with a couple of bulk queries per message. Flushing key is removed only after DB transaction
+was committed, so changes left after a crash are merged with new ones and replayed on next flush.
+"""
+import json
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from telegram import User as TGUser
+
+from bot import redis
+from core.models import Button, Message, Reaction, ReactionToggle, User
+
+logger = logging.getLogger(__name__)
+
+DIRTY_KEY = 'reactions:dirty'
+
+TOGGLE_SCRIPT = """
+-- KEYS: loaded, buttons, counts, permanent, users, changes, dirty
+-- ARGV: umid, user_id, text, max_buttons, expire, reacted_change, removed_change
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local user, text = ARGV[2], ARGV[3]
+local old = redis.call('HGET', KEYS[5], user)
+if old ~= text and redis.call('HEXISTS', KEYS[3], text) == 0 then
+    if redis.call('LLEN', KEYS[2]) >= tonumber(ARGV[4]) then
+        return {-1}
+    end
+    redis.call('RPUSH', KEYS[2], text)
+    redis.call('HSET', KEYS[3], text, 0)
+end
+
+local function dec(t)
+    local count = redis.call('HINCRBY', KEYS[3], t, -1)
+    if count <= 0 then
+        if redis.call('SISMEMBER', KEYS[4], t) == 0 then
+            redis.call('HDEL', KEYS[3], t)
+            redis.call('LREM', KEYS[2], 0, t)
+        else
+            redis.call('HSET', KEYS[3], t, 0)
+        end
+    end
+end
+
+local reacted = 1
+if old == text then
+    redis.call('HDEL', KEYS[5], user)
+    dec(text)
+    reacted = 0
+    redis.call('HSET', KEYS[6], user, ARGV[7])
+else
+    if old then
+        dec(old)
+    end
+    redis.call('HINCRBY', KEYS[3], text, 1)
+    redis.call('HSET', KEYS[5], user, text)
+    redis.call('HSET', KEYS[6], user, ARGV[6])
+end
+redis.call('SADD', KEYS[7], ARGV[1])
+for i = 1, 5 do
+    redis.call('EXPIRE', KEYS[i], ARGV[5])
+end
+
+local result = {reacted}
+for _, t in ipairs(redis.call('LRANGE', KEYS[2], 0, -1)) do
+    table.insert(result, t)
+    table.insert(result, redis.call('HGET', KEYS[3], t))
+end
+return result
+"""
+
+LOAD_SCRIPT = """
+-- KEYS: loaded, buttons, counts, permanent, users
+-- ARGV: expire, number of buttons, (text, count, permanent) * buttons, (user, text) * reactions
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('DEL', KEYS[2], KEYS[3], KEYS[4], KEYS[5])
+local n = tonumber(ARGV[2])
+for i = 0, n - 1 do
+    local text = ARGV[3 + i * 3]
+    redis.call('RPUSH', KEYS[2], text)
+    redis.call('HSET', KEYS[3], text, ARGV[4 + i * 3])
+    if ARGV[5 + i * 3] == '1' then
+        redis.call('SADD', KEYS[4], text)
+    end
+end
+for i = 3 + n * 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[5], ARGV[i], ARGV[i + 1])
+end
+redis.call('SET', KEYS[1], 1)
+for i = 1, 5 do
+    redis.call('EXPIRE', KEYS[i], ARGV[1])
+end
+return 1
+"""
+
+CLAIM_SCRIPT = """
+-- KEYS: changes, flushing, loaded, buttons, counts
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    if redis.call('EXISTS', KEYS[2]) == 1 then
+        -- leftovers of failed flush: newer changes win
+        local changes = redis.call('HGETALL', KEYS[1])
+        for i = 1, #changes, 2 do
+            redis.call('HSET', KEYS[2], changes[i], changes[i + 1])
+        end
+        redis.call('DEL', KEYS[1])
+    else
+        redis.call('RENAME', KEYS[1], KEYS[2])
+    end
+end
+local loaded = redis.call('EXISTS', KEYS[3])
+local buttons = {}
+if loaded == 1 then
+    for _, t in ipairs(redis.call('LRANGE', KEYS[4], 0, -1)) do
+        table.insert(buttons, t)
+        table.insert(buttons, redis.call('HGET', KEYS[5], t))
+    end
+end
+return {loaded, redis.call('HGETALL', KEYS[2]), buttons}
+"""
+
+FINALIZE_SCRIPT = """
+-- KEYS: flushing, changes, dirty
+-- ARGV: umid
+redis.call('DEL', KEYS[1])
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[1])
+end
+"""
+
+toggle_script = redis.rc.register_script(TOGGLE_SCRIPT)
+load_script = redis.rc.register_script(LOAD_SCRIPT)
+claim_script = redis.rc.register_script(CLAIM_SCRIPT)
+finalize_script = redis.rc.register_script(FINALIZE_SCRIPT)
+
+
+def _key(umid, name):
+    return f'reactions:{umid}:{name}'
+
+
+def _state_keys(umid):
+    return [_key(umid, name) for name in ('loaded', 'buttons', 'counts', 'permanent', 'users')]
+
+
+def _pairs(values: list):
+    return [(values[i].decode(), values[i + 1]) for i in range(0, len(values), 2)]
+
+
+def _change(text, user: TGUser):
+    return json.dumps([text, user.username, user.first_name, user.last_name])
+
+
+def load(umid):
+    """Load message's buttons and reactions from DB into redis if they aren't there yet."""
+    buttons = Button.objects.filter(message_id=umid).order_by('index')
+    buttons = list(buttons.values_list('text', 'count', 'permanent'))
+    reactions = Reaction.objects.filter(message_id=umid).values_list('user_id', 'button__text')
+    args = [settings.REACTIONS_CACHE_EXPIRY, len(buttons)]
+    for text, count, permanent in buttons:
+        args.extend([text, count, int(permanent)])
+    for user_id, text in reactions:
+        args.extend([user_id, text])
+    load_script(keys=_state_keys(umid), args=args, client=redis.rc)
+
+
+def forget(umid):
+    """Persist pending changes of the message and drop its redis state."""
+    if settings.REACTIONS_BACKEND != 'redis':
+        return
+    flush_message(umid)
+    redis.rc.delete(*_state_keys(umid))
+
+
+def get_reactions(message: Message) -> List[Tuple[str, int]]:
+    """Same as `Message.get_reactions` but prefers fresh counts from redis."""
+    if settings.REACTIONS_BACKEND == 'redis':
+        umid = message.id
+        pipe = redis.rc.pipeline()
+        pipe.exists(_key(umid, 'loaded'))
+        pipe.lrange(_key(umid, 'buttons'), 0, -1)
+        pipe.hgetall(_key(umid, 'counts'))
+        loaded, texts, counts = pipe.execute()
+        if loaded:
+            return [(text.decode(), int(counts.get(text, 0))) for text in texts]
+    return message.get_reactions()
+
+
+def toggle_reaction(
+    user: TGUser, chat_id, message_id, inline_message_id, button_text
+) -> ReactionToggle:
+    """Same as `ReactionManager.toggle` but uses configured reactions backend."""
+    if settings.REACTIONS_BACKEND != 'redis':
+        return Reaction.objects.toggle(user, chat_id, message_id, inline_message_id, button_text)
+
+    umid = Message.get_id(chat_id, message_id, inline_message_id)
+    keys = [*_state_keys(umid), _key(umid, 'changes'), DIRTY_KEY]
+    args = [
+        umid,
+        user.id,
+        button_text,
+        settings.MAX_NUM_BUTTONS,
+        settings.REACTIONS_CACHE_EXPIRY,
+        _change(button_text, user),
+        _change('', user),
+    ]
+    result = toggle_script(keys=keys, args=args, client=redis.rc)
+    if result is None:
+        # journal may have outlived the state, DB snapshot must include it
+        flush_message(umid)
+        load(umid)
+        result = toggle_script(keys=keys, args=args, client=redis.rc)
+
+    reacted, *values = result
+    if reacted == -1:
+        # too many buttons
+        return ReactionToggle(None, None, None)
+    reactions = [(text, int(count)) for text, count in _pairs(values)]
+    counts = dict(reactions)
+    button = Button(message_id=umid, text=button_text, count=counts.get(button_text, 0))
+    reaction = None
+    if reacted:
+        reaction = Reaction(user_id=str(user.id), message_id=umid, button=button)
+    return ReactionToggle(reaction, button, reactions)
+
+
+def persist(umid, changes: Dict[str, list], buttons: Optional[List[Tuple[str, int]]]):
+    """
+    Write reaction changes and button counts of the message into DB.
+
+    :param umid: message ID
+    :param changes: user ID -> [button text or empty string if reaction was removed, user info]
+    :param buttons: (text, count) pairs in display order,
+        None if redis state expired and counts should be recalculated from DB
+    """
+    with transaction.atomic():
+        if not Message.objects.filter(id=umid).exists():
+            logger.debug(f"message {umid} was deleted, dropping its reactions")
+            return
+
+        existing = {b.text: b for b in Button.objects.filter(message_id=umid)}
+        if buttons is not None:
+            new_buttons, updated_buttons = [], []
+            for index, (text, count) in enumerate(buttons):
+                b = existing.get(text)
+                if b:
+                    b.index = index
+                    b.count = count
+                    updated_buttons.append(b)
+                else:
+                    b = existing[text] = Button(
+                        message_id=umid, index=index, text=text, count=count
+                    )
+                    new_buttons.append(b)
+            Button.objects.bulk_create(new_buttons)
+            Button.objects.bulk_update(updated_buttons, ['index', 'count'])
+        else:
+            # buttons that were added in redis after the last flush
+            missing = sorted({text for text, *_ in changes.values() if text} - set(existing))
+            free = max(settings.MAX_NUM_BUTTONS - len(existing), 0)
+            if len(missing) > free:
+                logger.warning(
+                    f"message {umid} has no room for buttons {missing[free:]}, "
+                    f"dropping their reactions"
+                )
+            index = max((b.index for b in existing.values()), default=-1) + 1
+            new_buttons = [
+                Button(message_id=umid, index=index + i, text=text, count=0)
+                for i, text in enumerate(missing[:free])
+            ]
+            Button.objects.bulk_create(new_buttons)
+            existing.update((b.text, b) for b in new_buttons)
+
+        User.objects.bulk_create(
+            [
+                User(id=user_id, username=username, first_name=first_name, last_name=last_name)
+                for user_id, (_, username, first_name, last_name) in changes.items()
+            ],
+            ignore_conflicts=True,
+        )
+        Reaction.objects.filter(message_id=umid, user_id__in=list(changes)).delete()
+        Reaction.objects.bulk_create([
+            Reaction(user_id=user_id, message_id=umid, button_id=existing[text].id)
+            for user_id, (text, *_) in changes.items()
+            if text in existing
+        ])
+
+        if buttons is None:
+            for b in existing.values():
+                b.count = b.reaction_set.count()
+            Button.objects.bulk_update(list(existing.values()), ['count'])
+        else:
+            texts = {text for text, _ in buttons}
+            stale = [b.id for text, b in existing.items() if text not in texts and not b.permanent]
+            Button.objects.filter(id__in=stale).delete()
+        Message.objects.filter(id=umid).rebuild_button_counts()
+
+
+def flush_message(umid):
+    flushing_key = _key(umid, 'flushing')
+    loaded, changes, buttons = claim_script(
+        keys=[_key(umid, 'changes'), flushing_key, *_state_keys(umid)[:3]],
+        client=redis.rc,
+    )
+    changes = {user_id: json.loads(change) for user_id, change in _pairs(changes)}
+    buttons = [(text, int(count)) for text, count in _pairs(buttons)] if loaded else None
+    if changes or buttons is not None:
+        persist(umid, changes, buttons)
+    finalize_script(
+        keys=[flushing_key, _key(umid, 'changes'), DIRTY_KEY],
+        args=[umid],
+        client=redis.rc,
+    )
+    return len(changes)
+
+
+def flush():
+    """Persist changes of all dirty messages. Returns number of flushed reactions."""
+    total = 0
+    for umid in redis.rc.smembers(DIRTY_KEY):
+        umid = umid.decode()
+        try:
+            total += flush_message(umid)
+        except Exception:
+            logger.exception(f"failed to flush reactions of message {umid}")
+    if total:
+        logger.debug(f"flushed {total} reactions")
+    return total
+
+
+class Flusher(threading.Thread):
+    """Background thread that persists reactions every `interval` seconds."""
+
+    def __init__(self, interval=None):
+        super().__init__(name='reactions-flusher', daemon=True)
+        self.interval = interval or settings.REACTIONS_FLUSH_INTERVAL
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            close_old_connections()
+            flush()
+
+    def stop(self):
+        """Stop the thread and flush everything that is left."""
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        flush()
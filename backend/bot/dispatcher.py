@@ -1,25 +1,63 @@
+import functools
 import logging
-from typing import List
+from typing import List, Optional
 
 from django.conf import settings
+from telegram import TelegramError, Update
 from telegram.ext import (
-    Updater,
+    CallbackContext,
     Dispatcher,
+    DispatcherHandlerStop,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     InlineQueryHandler,
     ChosenInlineResultHandler,
-    run_async,
 )
 
+from .api import make_bot
+from .context_data import bound_context_data
 from .core import handle_error
 from . import channel_publishing, channel_reaction, core, group_reaction, group_reposting, stats
+from .counters import Flusher
+from .intake import PollingIntake, Unfinished
+from .keyed_executor import KeyedExecutor, get_update_key
+from .routing import HandlerIndex, Router, get_allowed_updates
+from .update_queue import Worker, process_update
 from .wrapper import HandlerWrapper
 
 logger = logging.getLogger(__name__)
 
 
+class IndexedDispatcher(Dispatcher):
+    """Checks only handlers that `index` picked for update instead of all of them."""
+    index: Optional[HandlerIndex] = None
+
+    def process_update(self, update):
+        if self.index is None or not isinstance(update, Update):
+            super().process_update(update)
+            return
+        try:
+            for handler in self.index.candidates(update):
+                check = handler.check_update(update)
+                if check is not None and check is not False:
+                    context = None
+                    if self.use_context:
+                        context = CallbackContext.from_update(update, self)
+                    handler.handle_update(update, self, check, context)
+                    break
+        except DispatcherHandlerStop:
+            logger.debug('Stopping further handlers due to DispatcherHandlerStop')
+        except TelegramError as e:
+            logger.warning('A TelegramError was raised while processing the Update')
+            try:
+                self.dispatch_error(update, e)
+            except Exception:
+                logger.exception('An uncaught error was raised while handling the error')
+        except Exception:
+            logger.exception('An uncaught error was raised while processing the update')
+
+
 def extract_handlers(module):
     res = []
     for key, value in vars(module).items():
@@ -60,12 +98,39 @@ def sort_by_type(handlers: List[HandlerWrapper]):
     handlers.sort(key=lambda h: priority[h.handler_class])
 
 
-def make_async(handlers: List[HandlerWrapper]):
+def run_keyed(callback, dp: Dispatcher, executor: KeyedExecutor, unfinished: Unfinished = None):
+    """
+    Make callback run in executor: in order within chat, in parallel across chats.
+    Updates are kept in `unfinished` until callback is finished.
+    """
+    @functools.wraps(callback)
+    def submit(update, context):
+        def run():
+            try:
+                callback(update, context)
+            except Exception as e:
+                dp.dispatch_error(update, e)
+            finally:
+                if unfinished is not None:
+                    unfinished.done(update.update_id)
+
+        if unfinished is not None:
+            unfinished.add(update.update_id)
+        if not executor.submit(get_update_key(update), run):
+            logger.warning(f"too many updates of {get_update_key(update)}, dropped {update}")
+            if unfinished is not None:
+                unfinished.done(update.update_id)
+
+    return submit
+
+
+def make_keyed(handlers: List[HandlerWrapper], dp: Dispatcher, executor: KeyedExecutor,
+               unfinished: Unfinished = None):
     for wrapper in handlers:
-        wrapper.handler.callback = run_async(wrapper.handler.callback)
+        wrapper.handler.callback = run_keyed(wrapper.handler.callback, dp, executor, unfinished)
 
 
-def setup_dispatcher(dp: Dispatcher, inspect=True, use_async=False):
+def get_handlers() -> List[HandlerWrapper]:
     handlers: List[HandlerWrapper] = []
     for module in [
         channel_publishing,
@@ -76,22 +141,92 @@ def setup_dispatcher(dp: Dispatcher, inspect=True, use_async=False):
         stats,
     ]:
         handlers.extend(extract_handlers(module))
-
     sort_by_type(handlers)
-    if use_async:
-        make_async(handlers)
+    return handlers
+
+
+def setup_dispatcher(
+    dp: Dispatcher, inspect=True, executor: KeyedExecutor = None, unfinished: Unfinished = None
+) -> List[HandlerWrapper]:
+    handlers = get_handlers()
+    if executor is not None:
+        make_keyed(handlers, dp, executor, unfinished)
     for wrapper in handlers:
         dp.add_handler(wrapper.handler)
+    if isinstance(dp, IndexedDispatcher) and settings.HANDLER_INDEX:
+        dp.index = HandlerIndex([wrapper.handler for wrapper in handlers])
     dp.add_error_handler(handle_error)
+    bound_context_data(dp)
     if inspect:
         inspect_handlers(handlers)
+    return handlers
 
 
 def run():
-    updater = Updater(settings.TG_BOT_TOKEN, use_context=True, workers=settings.TG_BOT_WORKERS)
-    setup_dispatcher(updater.dispatcher, use_async=True)
+    """Poll and process updates until interrupted."""
+    # handlers run in executor's threads, so dispatcher doesn't need its own
+    dispatcher = IndexedDispatcher(make_bot(), update_queue=None, workers=0, use_context=True)
+    executor = KeyedExecutor(
+        settings.TG_BOT_WORKERS, max_queue=settings.CHAT_QUEUE_SIZE, name='updates'
+    )
+    unfinished = Unfinished()
+    handlers = setup_dispatcher(dispatcher, executor=executor, unfinished=unfinished)
+    router = Router(handlers)
+
+    def handle(updates: List[dict]):
+        for data in updates:
+            try:
+                process_update(dispatcher, data, router)
+            except Exception:
+                logger.exception(f"failed to process update {data['update_id']}")
+
+    intake = PollingIntake(
+        dispatcher.bot, handle, backlog=executor.pending,
+        allowed_updates=get_allowed_updates(handlers), unfinished=unfinished.lowest,
+    )
+
+    flusher = None
+    if settings.REACTIONS_BACKEND == 'redis':
+        flusher = Flusher()
+        flusher.start()
 
     logger.info('start polling...')
-    updater.start_polling()
-    updater.idle()
+    try:
+        intake.run()
+    except KeyboardInterrupt:
+        intake.stop()
+    logger.info('waiting for updates in progress...')
+    executor.shutdown()
+    try:
+        intake.commit_handled()
+    except Exception:
+        logger.exception("failed to save offset")
+    if flusher:
+        logger.info('flushing reactions...')
+        flusher.stop()
+    logger.info('bye')
+
+
+def run_worker(threads: int):
+    """Process updates queued by webhook view until interrupted."""
+    dispatcher = IndexedDispatcher(make_bot(), update_queue=None, use_context=True)
+    handlers = setup_dispatcher(dispatcher)
+    worker = Worker(dispatcher, threads, router=Router(handlers))
+
+    flusher = None
+    if settings.REACTIONS_BACKEND == 'redis':
+        flusher = Flusher()
+        flusher.start()
+
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info('waiting for updates in progress...')
+        worker.stop()
+        worker.shutdown()
+        if flusher:
+            logger.info('flushing reactions...')
+            flusher.stop()
     logger.info('bye')
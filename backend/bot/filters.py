@@ -34,8 +34,9 @@ class StateFilter:
             return bool(user and redis.check_state(user.id, self.state))
 
         def filter(self, message: TGMessage):
-            user: TGUser = message.from_user
-            return self.filter_by_user(user)
+            # all state filters of the message share state loaded by a single request
+            session = redis.get_session(message)
+            return bool(session and session.get('state') == str(self.state))
 
     reaction = _StateFilter(State.reaction)
     create_start = _StateFilter(State.create_start)
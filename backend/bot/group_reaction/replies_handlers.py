@@ -5,12 +5,14 @@ from telegram import Message as TGMessage, Update
 from telegram.error import BadRequest
 from telegram.ext import CallbackContext, Filters
 
+from bot import counters
+from bot.chat_config import get_message_chat
 from bot.filters import reply_to_bot
 from bot.magic_marks import process_magic_mark
 from bot.markup import make_reply_markup
-from bot.utils import try_delete
+from bot.utils import edit_reply_markup, try_delete
 from bot.wrapper import message_handler
-from core.models import Message, Reaction
+from core.models import Message
 
 logger = logging.getLogger(__name__)
 
@@ -22,10 +24,10 @@ def get_msg(reply: TGMessage):
         logger.debug(f"message doesn't exist. reply: {reply}")
 
 
-def update_markup(update, context, message, tg_message, reply):
-    _, reply_markup = make_reply_markup(update, context.bot, message=message)
+def update_markup(update, context, message, tg_message, reply, reactions=None):
+    _, reply_markup = make_reply_markup(update, context.bot, reactions, message=message)
     try:
-        reply.edit_reply_markup(reply_markup=reply_markup)
+        edit_reply_markup(context.bot, message.id, reply_markup, **message.ids)
     except BadRequest as e:
         logger.debug(f"message was not modified (chat.repost=false, toggle anonymity): {e}")
     try_delete(context.bot, update, tg_message)
@@ -44,15 +46,16 @@ def handle_reaction_reply(update: Update, context: CallbackContext):
     if not message:
         return
 
-    if not message.chat.allow_reactions:
+    chat = get_message_chat(message)
+    if not chat.allow_reactions:
         logger.debug("reactions are not allowed")
         return
 
-    if message.chat.force_emojis and reaction not in UNICODE_EMOJI:
+    if chat.force_emojis and reaction not in UNICODE_EMOJI:
         logger.debug("can't react with non-emoji text")
         return
 
-    _, button = Reaction.objects.react(
+    _, button, reactions = counters.toggle_reaction(
         user=user,
         chat_id=reply.chat_id,
         message_id=reply.message_id,
@@ -63,7 +66,7 @@ def handle_reaction_reply(update: Update, context: CallbackContext):
         msg.reply_text("Post already has too many reactions.")
         return
 
-    update_markup(update, context, message, msg, reply)
+    update_markup(update, context, message, msg, reply, reactions)
 
 
 @message_handler(
@@ -91,9 +94,10 @@ def handle_magic_reply(update: Update, context: CallbackContext):
 
     if anonymous:
         message.anonymous = not message.anonymous
-        message.save()
+        message.save(update_fields=['anonymous'])
 
     if buttons is not None:
+        counters.forget(message.id)
         message.button_set.all().delete()
         message.set_buttons(buttons)
 
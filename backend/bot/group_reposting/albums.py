@@ -0,0 +1,132 @@
+"""
+Collect parts of an album (media group), so it can be processed as a whole.
+
+Telegram sends every part of an album as a separate message. Parts are buffered in redis list
+`album:<media_group_id>:parts`. The first part atomically claims the album with `SET NX` and
+schedules it in sorted set `albums:due`, the process that claimed it processes all collected
+parts after `ALBUM_WINDOW` seconds. Parts are taken together with the claim, so a part that
+comes after that claims the album again and is processed after the next window. Processed album
+is marked with `album:<media_group_id>:saved` (ID of its repost, 0 if it wasn't reposted),
+so late parts are attached to it instead of being processed as another album.
+Albums that weren't processed in time (eg: process was restarted) are processed by the next
+process that receives a part of any album.
+"""
+import json
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+
+from django.conf import settings
+from django.db import connection
+
+from bot import metrics, redis
+
+logger = logging.getLogger(__name__)
+
+DUE_KEY = 'albums:due'
+OVERDUE_BATCH = 10
+
+ADD_SCRIPT = """
+-- KEYS: parts, claim, due
+-- ARGV: media group ID, part, expire in ms, due time
+redis.call('RPUSH', KEYS[1], ARGV[2])
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+if redis.call('SET', KEYS[2], 1, 'NX', 'PX', ARGV[3]) then
+    redis.call('ZADD', KEYS[3], ARGV[4], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+TAKE_SCRIPT = """
+-- KEYS: parts, claim, due
+-- ARGV: media group ID
+if redis.call('ZREM', KEYS[3], ARGV[1]) == 0 then
+    -- taken by another process
+    return {}
+end
+local parts = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1], KEYS[2])
+return parts
+"""
+
+add_script = redis.rc.register_script(ADD_SCRIPT)
+take_script = redis.rc.register_script(TAKE_SCRIPT)
+
+
+def _keys(media_group_id):
+    return f'album:{media_group_id}:parts', f'album:{media_group_id}:claim', DUE_KEY
+
+
+def _saved_key(media_group_id):
+    return f'album:{media_group_id}:saved'
+
+
+def _expire_ms():
+    return int(settings.ALBUM_WINDOW * 10 * 1000)
+
+
+def add_part(media_group_id, part: dict, on_complete: Callable[[List[dict]], None]) -> bool:
+    """
+    Buffer part of album. Return True if album was claimed by this call,
+    in that case `on_complete` is called with all parts when window closes.
+    Requires `ALBUM_WINDOW > 0`.
+    """
+    window = settings.ALBUM_WINDOW
+    args = [media_group_id, json.dumps(part), _expire_ms(), time.time() + window]
+    claimed = bool(add_script(keys=_keys(media_group_id), args=args, client=redis.rc))
+    metrics.inc('album_parts')
+    if claimed:
+        timer = threading.Timer(window, _complete_in_timer, args=(media_group_id, on_complete))
+        timer.daemon = True
+        timer.start()
+    complete_overdue(on_complete)
+    return claimed
+
+
+def take_parts(media_group_id) -> List[dict]:
+    """
+    Remove collected parts of album from buffer and return them in order of messages.
+    Returns nothing if album was already taken.
+    """
+    parts = take_script(keys=_keys(media_group_id), args=[media_group_id], client=redis.rc)
+    parts = [json.loads(p) for p in parts]
+    return sorted(parts, key=lambda p: p['message']['message_id'])
+
+
+def mark_saved(media_group_id, repost_id: int = 0):
+    """Remember that album is processed, `repost_id` is ID of its first reposted message."""
+    redis.rc.set(_saved_key(media_group_id), repost_id, px=_expire_ms())
+
+
+def get_saved(media_group_id) -> Optional[int]:
+    """Return what `mark_saved` remembered, None if album isn't processed yet."""
+    value = redis.rc.get(_saved_key(media_group_id))
+    return int(value) if value is not None else None
+
+
+def complete(media_group_id, on_complete: Callable[[List[dict]], None]):
+    try:
+        parts = take_parts(media_group_id)
+        if parts:
+            metrics.inc('albums')
+            on_complete(parts)
+    except Exception:
+        logger.exception(f"failed to process album {media_group_id}")
+
+
+def _complete_in_timer(media_group_id, on_complete: Callable[[List[dict]], None]):
+    try:
+        complete(media_group_id, on_complete)
+    finally:
+        connection.close()
+
+
+def complete_overdue(on_complete: Callable[[List[dict]], None]):
+    """Process albums which window closed more than a window ago."""
+    deadline = time.time() - settings.ALBUM_WINDOW
+    overdue = redis.rc.zrangebyscore(DUE_KEY, 0, deadline, start=0, num=OVERDUE_BATCH)
+    for media_group_id in overdue:
+        metrics.inc('albums_overdue')
+        complete(media_group_id.decode(), on_complete)
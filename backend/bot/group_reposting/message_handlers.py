@@ -1,35 +1,42 @@
 import logging
+from functools import partial
+from typing import List, Mapping, Optional
 
+from django.conf import settings
 from django.utils import timezone
-from telegram import (Message as TGMessage, Update)
+from telegram import Bot, InputMediaPhoto, InputMediaVideo, Message as TGMessage, Update
 from telegram.ext import CallbackContext, Filters
 
-from bot.magic_marks import process_magic_mark
+from bot import chat_config, metrics
+from bot.group_reposting import albums
+from bot.magic_marks import MAGIC_MARK_PREFIXES, process_magic_mark
 from bot.markup import make_reply_markup
+from bot.upserts import get_chat_from_update, get_user_from_update
 from bot.utils import (
     get_forward_from,
     get_forward_from_chat,
     get_message_type,
+    get_raw_message_type,
     repost_message,
     try_delete,
 )
 from bot.wrapper import message_handler
-from core.models import Chat, Message, User
+from core.models import Chat, Message, default_allowed_types
 
 logger = logging.getLogger(__name__)
 
 
 def process_message(
     update: Update,
-    context: CallbackContext,
+    bot: Bot,
     msg_type: str,
     chat: Chat,
     anonymous: bool,
     buttons=None,
     repost=False,
-):
+) -> Optional[TGMessage]:
+    """Attach reactions to message, return its repost if message was reposted."""
     msg: TGMessage = update.effective_message
-    bot = context.bot
 
     chat, reply_markup = make_reply_markup(update, bot, buttons, chat=chat, anonymous=anonymous)
 
@@ -48,37 +55,152 @@ def process_message(
     if sent_msg:
         if should_repost:
             try_delete(bot, update, msg)
-        Message.objects.create_from_tg_ids(
-            sent_msg.chat_id,
-            sent_msg.message_id,
-            date=timezone.make_aware(msg.date),
-            buttons=buttons,
-            anonymous=anonymous,
-            original_message_id=msg.message_id,
-            from_user=User.objects.from_update(update),
-            forward_from=get_forward_from(msg),
-            forward_from_chat=get_forward_from_chat(msg),
-            forward_from_message_id=msg.forward_from_message_id,
-        )
+        save_message(update, sent_msg, buttons, anonymous)
+    return sent_msg if should_repost else None
+
+
+def save_message(update: Update, sent_msg: TGMessage, buttons, anonymous: bool):
+    """Create message with reactions for `sent_msg` that was sent in response to `update`."""
+    msg: TGMessage = update.effective_message
+    Message.objects.create_from_tg_ids(
+        sent_msg.chat_id,
+        sent_msg.message_id,
+        date=timezone.make_aware(msg.date),
+        buttons=buttons,
+        anonymous=anonymous,
+        original_message_id=msg.message_id,
+        from_user=get_user_from_update(update),
+        forward_from=get_forward_from(msg),
+        forward_from_chat=get_forward_from_chat(msg),
+        forward_from_message_id=msg.forward_from_message_id,
+    )
+
+
+def make_input_media(msg: TGMessage):
+    if msg.photo:
+        return InputMediaPhoto(msg.photo[-1].file_id, caption=msg.caption_html, parse_mode='HTML')
+    if msg.video:
+        return InputMediaVideo(msg.video.file_id, caption=msg.caption_html, parse_mode='HTML')
+
+
+def process_album(bot: Bot, parts: List[dict]):
+    """
+    Repost all parts of album with a single `sendMediaGroup` (if chat allows reposting)
+    and attach one message with reactions to it. Parts that come after album is processed
+    are attached to it, album of one part is processed as a single message.
+    """
+    messages = [TGMessage.de_json(part['message'], bot) for part in parts]
+    first = messages[0]
+    update = Update(0, message=first)
+    repost_id = albums.get_saved(first.media_group_id)
+    if repost_id is not None:
+        attach_late_parts(bot, messages, repost_id)
+        return
+    anonymous = any(part['anonymous'] for part in parts)
+    buttons = next((part['buttons'] for part in parts if part['buttons'] is not None), None)
+    repost = any(part['repost'] for part in parts)
+
+    chat = chat_config.get_chat(first.chat_id)
+    if len(messages) == 1:
+        msg_type = get_raw_message_type(first, albums=False)
+        sent_msg = process_message(update, bot, msg_type, chat, anonymous, buttons, repost)
+        albums.mark_saved(first.media_group_id, sent_msg.message_id if sent_msg else 0)
+        return
+    chat, reply_markup = make_reply_markup(update, bot, buttons, chat=chat, anonymous=anonymous)
+
+    media = [make_input_media(m) for m in messages]
+    # sendMediaGroup takes 2-10 items
+    should_repost = (chat.repost or repost) and all(media) and len(media) >= 2
+    if should_repost:
+        sent_album = bot.send_media_group(first.chat_id, media, disable_notification=True)
+        reply_to_message_id = sent_album[0].message_id
+    else:
+        reply_to_message_id = first.message_id
+    sent_msg = bot.send_message(
+        first.chat_id,
+        '^',
+        disable_notification=True,
+        reply_to_message_id=reply_to_message_id,
+        reply_markup=reply_markup,
+    )
+    if should_repost:
+        for m in messages:
+            try_delete(bot, update, m)
+    save_message(update, sent_msg, buttons, anonymous)
+    albums.mark_saved(first.media_group_id, reply_to_message_id if should_repost else 0)
+
+
+def attach_late_parts(bot: Bot, messages: List[TGMessage], repost_id: int):
+    """
+    Attach parts that came after album was processed to it: they already are next to
+    the original album, parts of reposted album are reposted as replies to the repost.
+    """
+    metrics.inc('album_parts_late', len(messages))
+    if not repost_id:
+        return
+    for msg in messages:
+        msg_type = get_raw_message_type(msg, albums=False)
+        if repost_message(msg, bot, msg_type, None, reply_to_message_id=repost_id):
+            try_delete(bot, Update(0, message=msg), msg)
+
+
+def can_be_processed(msg: TGMessage, chat_settings: Optional[Mapping]) -> bool:
+    """
+    Decide by message itself and chat settings whether message could be processed at all.
+    Doesn't touch DB or redis, so ordinary chatter is discarded as cheap as possible.
+
+    :param chat_settings: cached chat settings or None if chat isn't created yet
+    """
+    text = msg.text or msg.caption
+    if text and text.startswith(MAGIC_MARK_PREFIXES):
+        return True
+    if chat_settings:
+        allowed_types = chat_settings['allowed_types']
+    else:
+        allowed_types = default_allowed_types()
+    if msg.forward_date and 'forward' in allowed_types:
+        return True
+    return get_raw_message_type(msg) in allowed_types
 
 
 @message_handler(Filters.group & ~Filters.reply & ~Filters.status_update)
 def handle_message(update: Update, context: CallbackContext):
     msg: TGMessage = update.effective_message
 
+    if not can_be_processed(msg, chat_config.get_settings(msg.chat_id)):
+        metrics.inc('group_messages_discarded')
+        return
+
     force, anonymous, skip, buttons = process_magic_mark(msg)
     logger.debug(f"force: {force}, anonymous: {anonymous}, skip: {skip}, buttons: {buttons}")
     if skip:
         logger.debug('skipping message processing')
         return
 
-    chat = Chat.objects.from_update(update)
+    chat = get_chat_from_update(update)
     allowed_types = chat.allowed_types
     allow_forward = 'forward' in allowed_types
 
-    msg_type = get_message_type(msg)
     forward = bool(msg.forward_date)
+    if msg.media_group_id:
+        if not (force > 0 or 'album' in allowed_types or forward and allow_forward):
+            return
+        if settings.ALBUM_WINDOW > 0:
+            part = {
+                'message': msg.to_dict(),
+                'anonymous': anonymous,
+                'buttons': buttons,
+                'repost': force > 1,
+            }
+            albums.add_part(msg.media_group_id, part, partial(process_album, context.bot))
+            return
+        # parts aren't collected, every part is processed as a separate message
+        msg_type = get_raw_message_type(msg, albums=False)
+        process_message(update, context.bot, msg_type, chat, anonymous, buttons, repost=force > 1)
+        return
+
+    msg_type = get_message_type(msg)
     logger.debug(f"msg_type: {msg_type}, forward: {forward}")
 
     if force > 0 or msg_type in allowed_types or forward and allow_forward:
-        process_message(update, context, msg_type, chat, anonymous, buttons, repost=force > 1)
+        process_message(update, context.bot, msg_type, chat, anonymous, buttons, repost=force > 1)
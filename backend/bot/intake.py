@@ -0,0 +1,229 @@
+"""
+Long polling of updates that fetches the next batch while the current one is handled.
+
+Telegram forgets updates once `getUpdates` is called with a greater offset, and the prefetch
+does exactly that before the previous batch is handled. So received updates are saved to redis
+list `PENDING_KEY` first, and offset of the next unhandled update is saved to `OFFSET_KEY`
+after every batch. Handlers may still run updates of the batch in other threads, so offset
+doesn't go beyond the lowest update that is not finished (see `Unfinished`).
+After restart pending updates are handled again only if they are beyond the saved offset.
+
+Parameters of the next request depend on backlog: while batches come full, more updates are
+waiting and the next request doesn't wait (`timeout=0`); `limit` shrinks while handlers
+are busy, so prefetched updates don't pile up in memory.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from telegram import Bot
+
+from bot import metrics, redis
+
+logger = logging.getLogger(__name__)
+
+OFFSET_KEY = 'intake:offset'
+PENDING_KEY = 'intake:pending'
+MIN_LIMIT = 10
+MAX_LIMIT = 100
+BATCH_BUCKETS = (0, 1, 5, 10, 25, 50, 100)
+
+
+def get_updates(bot: Bot, offset: Optional[int], limit: int, timeout: int,
+                allowed_updates: List[str] = None) -> List[dict]:
+    """Call `getUpdates`, return updates as decoded JSON."""
+    data = {'limit': limit, 'timeout': timeout}
+    if offset is not None:
+        data['offset'] = offset
+    if allowed_updates is not None:
+        data['allowed_updates'] = allowed_updates
+    return bot.request.post(f'{bot.base_url}/getUpdates', data, timeout=timeout + 5)
+
+
+def next_params(received: int, limit: int, backlog: int) -> Tuple[int, int]:
+    """Return `limit` and `timeout` of the next request."""
+    timeout = 0 if received >= limit else settings.TG_POLL_TIMEOUT
+    limit = max(MIN_LIMIT, MAX_LIMIT - backlog)
+    return limit, timeout
+
+
+def get_date(data: dict) -> Optional[int]:
+    """Unix time when update happened, None if update doesn't tell."""
+    for value in data.values():
+        if isinstance(value, dict):
+            date = value.get('edit_date') or value.get('date')
+            if isinstance(date, int):
+                return date
+
+
+class Unfinished:
+    """IDs of updates which handlers haven't finished yet, for handlers that run in background."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # update ID -> number of handlers
+        self._counts: Dict[int, int] = {}
+
+    def add(self, update_id: int):
+        with self._lock:
+            self._counts[update_id] = self._counts.get(update_id, 0) + 1
+
+    def done(self, update_id: int):
+        with self._lock:
+            self._counts[update_id] -= 1
+            if not self._counts[update_id]:
+                del self._counts[update_id]
+
+    def lowest(self) -> Optional[int]:
+        with self._lock:
+            return min(self._counts, default=None)
+
+
+class PollingIntake:
+    """
+    Calls `handle` with batches of updates in order until stopped.
+    `backlog` returns number of received updates that wait for handlers,
+    `unfinished` returns ID of the lowest update which handlers haven't finished.
+    """
+    def __init__(self, bot: Bot, handle: Callable[[List[dict]], None],
+                 backlog: Callable[[], int] = lambda: 0, allowed_updates: List[str] = None,
+                 unfinished: Callable[[], Optional[int]] = lambda: None):
+        self.bot = bot
+        self.handle = handle
+        self.backlog = backlog
+        self.allowed_updates = allowed_updates
+        self.unfinished = unfinished
+        # one batch is prefetched while the previous one is handled
+        self._batches = queue.Queue(maxsize=1)
+        self._stopped = threading.Event()
+        # offset after the last handled batch and IDs of updates in pending list
+        # which are not committed yet
+        self._offset: Optional[int] = None
+        self._committed: Optional[int] = None
+        self._received: Deque[int] = deque()
+        self._stale = 0
+
+    def restore(self) -> Tuple[Optional[int], List[dict], int]:
+        """
+        Return offset of the next update, updates that were received but not handled
+        before restart and number of entries in pending list.
+        """
+        pipe = redis.rc.pipeline()
+        pipe.get(OFFSET_KEY)
+        pipe.lrange(PENDING_KEY, 0, -1)
+        offset, pending = pipe.execute()
+        offset = int(offset) if offset is not None else None
+        updates = [json.loads(entry) for entry in pending]
+        if offset is not None:
+            updates = [data for data in updates if data['update_id'] >= offset]
+        if updates:
+            offset = updates[-1]['update_id'] + 1
+        return offset, updates, len(pending)
+
+    def commit(self, offset: int, count: int):
+        """Mark `count` oldest pending updates as handled."""
+        pipe = redis.rc.pipeline()
+        pipe.set(OFFSET_KEY, offset)
+        pipe.ltrim(PENDING_KEY, count, -1)
+        pipe.execute()
+
+    def commit_handled(self):
+        """Commit handled updates up to the lowest one which handlers haven't finished."""
+        offset = self._offset
+        if offset is None:
+            return
+        unfinished = self.unfinished()
+        if unfinished is not None:
+            offset = min(offset, unfinished)
+        count, self._stale = self._stale, 0
+        while self._received and self._received[0] < offset:
+            self._received.popleft()
+            count += 1
+        if count or offset != self._committed:
+            self.commit(offset, count)
+            self._committed = offset
+
+    def _put(self, updates: List[dict]) -> bool:
+        while not self._stopped.is_set():
+            try:
+                self._batches.put(updates, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fetch(self, offset: Optional[int]):
+        limit, timeout = MAX_LIMIT, 0
+        while not self._stopped.is_set():
+            try:
+                updates = get_updates(self.bot, offset, limit, timeout, self.allowed_updates)
+                if updates:
+                    # the next request confirms them to Telegram
+                    redis.rc.rpush(PENDING_KEY, *map(json.dumps, updates))
+            except Exception:
+                logger.exception("failed to get updates")
+                self._stopped.wait(1)
+                continue
+            metrics.observe('intake_batch_size', len(updates), buckets=BATCH_BUCKETS)
+            if updates:
+                offset = updates[-1]['update_id'] + 1
+                if not self._put(updates):
+                    return
+            limit, timeout = next_params(len(updates), limit, self.backlog())
+
+    def _handle(self, updates: List[dict]) -> bool:
+        """Handle batch, retry on errors, return False if stopped before it's handled."""
+        now = time.time()
+        for data in updates:
+            date = get_date(data)
+            if date is not None:
+                metrics.observe('intake_lag_seconds', max(0, now - date))
+        while not self._stopped.is_set():
+            try:
+                self.handle(updates)
+                metrics.inc('intake_updates', len(updates))
+                return True
+            except Exception:
+                logger.exception("failed to handle updates")
+                self._stopped.wait(1)
+        return False
+
+    def run(self):
+        """Handle updates until stopped."""
+        self.bot.delete_webhook()
+        offset, updates, pending = self.restore()
+        if updates:
+            logger.info(f"handling {len(updates)} updates received before restart")
+            if not self._handle(updates):
+                return
+        # handled before restart
+        self._stale = pending - len(updates)
+        self._handled(offset, updates)
+        threading.Thread(target=self._fetch, args=(offset,), name='intake', daemon=True).start()
+        while not self._stopped.is_set():
+            try:
+                updates = self._batches.get(timeout=1)
+            except queue.Empty:
+                # handlers may have finished since the last batch
+                self._handled(self._offset, [])
+                continue
+            if not self._handle(updates):
+                continue
+            self._handled(updates[-1]['update_id'] + 1, updates)
+
+    def _handled(self, offset: Optional[int], updates: List[dict]):
+        self._offset = offset
+        self._received.extend(data['update_id'] for data in updates)
+        try:
+            self.commit_handled()
+        except Exception:
+            # later commit saves greater offset, so these won't be handled again
+            logger.exception("failed to save offset")
+
+    def stop(self):
+        """Stop after the current batch, prefetched updates are handled after restart."""
+        self._stopped.set()
@@ -0,0 +1,132 @@
+"""
+Run updates of the same chat one by one and updates of different chats in parallel.
+
+Tasks of every key (chat ID) form a queue, and only one thread at a time runs tasks
+of a key. Keys take turns: after one task the key goes to the end of the line,
+so a busy chat can't occupy all threads. Queue of a key is limited, tasks over the limit
+are dropped and counted, producers that can't drop tasks wait for room with `wait_room`.
+"""
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+from telegram import Update
+
+from bot import metrics
+
+logger = logging.getLogger(__name__)
+
+DEPTH_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+_STOP = object()
+
+
+def get_update_key(update: Update) -> Hashable:
+    """Chat of update, or user for updates w/o chat (inline queries, inline messages)."""
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
+
+
+def get_data_key(data: dict) -> Hashable:
+    """Same as `get_update_key` for decoded JSON of update."""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        if 'from' in value:
+            return value['from']['id']
+    return data.get('update_id')
+
+
+class KeyedExecutor:
+    def __init__(self, workers: int, max_queue=100, name='keyed'):
+        self.max_queue = max_queue
+        self.name = name
+        # key is present while it has tasks or one of its tasks is running
+        self._queues: Dict[Hashable, Deque] = {}
+        # keys that wait for a thread, each key at most once
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._room = threading.Condition(self._lock)
+        self._threads = [
+            threading.Thread(target=self._work, name=f'{name}-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key: Hashable, func: Callable, *args, **kwargs) -> bool:
+        """Queue call of `func` after other calls with the same key, return False if dropped."""
+        with self._lock:
+            tasks = self._queues.get(key)
+            ready = tasks is None
+            if ready:
+                tasks = self._queues[key] = deque()
+            elif len(tasks) >= self.max_queue:
+                metrics.inc(f'{self.name}_dropped')
+                return False
+            tasks.append((func, args, kwargs, time.monotonic()))
+            depth = len(tasks)
+        metrics.observe(f'{self.name}_queue_depth', depth, buckets=DEPTH_BUCKETS)
+        if ready:
+            self._ready.put(key)
+        return True
+
+    def wait_room(self, key: Hashable, timeout: Optional[float] = None) -> bool:
+        """Wait until queue of key can take one more task."""
+        with self._room:
+            return self._room.wait_for(
+                lambda: len(self._queues.get(key, ())) < self.max_queue, timeout
+            )
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            if key is _STOP:
+                return
+            with self._lock:
+                func, args, kwargs, queued = self._queues[key].popleft()
+                self._room.notify_all()
+            metrics.observe(f'{self.name}_wait_seconds', time.monotonic() - queued)
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception(f"task of {key} failed")
+            with self._lock:
+                requeue = bool(self._queues[key])
+                if not requeue:
+                    del self._queues[key]
+                    if not self._queues:
+                        self._idle.notify_all()
+            if requeue:
+                self._ready.put(key)
+
+    def pending(self, key: Hashable = None) -> int:
+        """Number of queued tasks of key (or of all keys), excluding running ones."""
+        with self._lock:
+            if key is not None:
+                return len(self._queues.get(key, ()))
+            return sum(map(len, self._queues.values()))
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all tasks are done."""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._queues, timeout)
+
+    def shutdown(self, wait=True):
+        """Stop threads, if `wait` - after all queued tasks are done."""
+        if wait:
+            self.join()
+        for _ in self._threads:
+            self._ready.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -6,6 +6,8 @@ from telegram import Message as TGMessage
 from bot.utils import clear_buttons
 
 MAGIC_MARK = regex.compile(r'^(?:\.(-|\+|~|`.*`)+|(\+\++|--))')
+# text w/o any of these prefixes can't contain magic marks
+MAGIC_MARK_PREFIXES = ('.', '++', '--')
 
 
 def get_magic_marks(text: str):
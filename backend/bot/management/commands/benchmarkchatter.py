@@ -0,0 +1,126 @@
+import random
+import time
+
+from django.core.management import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from telegram import Bot, Update
+
+from bot import chat_config
+from bot.group_reposting.message_handlers import can_be_processed
+from bot.magic_marks import process_magic_mark
+from bot.upserts import get_chat_from_update
+from bot.utils import get_message_type
+from core.models import Chat
+
+CHAT_ID = -1009999999999
+PHOTO = [{'file_id': 'photo', 'width': 90, 'height': 90}]
+URL_ENTITY = [{'type': 'url', 'offset': 0, 'length': 19}]
+
+# (weight, message fields) of typical group traffic
+TRAFFIC = [
+    (70, {'text': 'just a regular message'}),
+    (8, {'sticker': {'file_id': 'sticker', 'width': 512, 'height': 512}}),
+    (5, {'voice': {'file_id': 'voice', 'duration': 3}}),
+    (5, {'text': 'https://example.com', 'entities': URL_ENTITY}),
+    (5, {'photo': PHOTO}),
+    (3, {'photo': PHOTO, 'media_group_id': None}),
+    (2, {'text': 'forwarded', 'forward_date': 1564646464, 'forward_from': {
+        'id': 2, 'first_name': 'forwarded', 'is_bot': False,
+    }}),
+    (1, {'text': '.+~magic'}),
+    (1, {'text': '--skip'}),
+]
+
+
+def handle_legacy(update: Update):
+    """Message handler's decision stage as it was done before prefilter."""
+    msg = update.effective_message
+    force, anonymous, skip, buttons = process_magic_mark(msg)
+    if skip:
+        return False
+    chat = Chat.objects.from_update(update)
+    allowed_types = chat.allowed_types
+    msg_type = get_message_type(msg)
+    return force > 0 or msg_type in allowed_types or msg.forward_date and 'forward' in allowed_types
+
+
+def handle_prefiltered(update: Update):
+    msg = update.effective_message
+    if not can_be_processed(msg, chat_config.get_settings(msg.chat_id)):
+        return False
+    force, anonymous, skip, buttons = process_magic_mark(msg)
+    if skip:
+        return False
+    chat = get_chat_from_update(update)
+    allowed_types = chat.allowed_types
+    msg_type = get_message_type(msg)
+    return force > 0 or msg_type in allowed_types or msg.forward_date and 'forward' in allowed_types
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare throughput of group message handling w/ and w/o prefilter '
+        'on a realistic traffic mix. Uses configured DB and redis.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=5000, help="Updates per case.")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def make_updates(self, bot, number, seed):
+        rnd = random.Random(seed)
+        weights = [w for w, _ in TRAFFIC]
+        kinds = rnd.choices([fields for _, fields in TRAFFIC], weights=weights, k=number)
+        updates = []
+        for i, fields in enumerate(kinds):
+            fields = dict(fields)
+            if 'media_group_id' in fields:
+                fields['media_group_id'] = f'benchmark-{seed}-{i // 3}'
+            data = {
+                'update_id': i,
+                'message': {
+                    'message_id': i,
+                    'date': 1564646464,
+                    'chat': {'id': CHAT_ID, 'type': 'supergroup', 'title': 'benchmark'},
+                    'from': {'id': 1 + i % 50, 'first_name': f'user {i % 50}', 'is_bot': False},
+                    **fields,
+                },
+            }
+            updates.append(Update.de_json(data, bot))
+        return updates
+
+    def run_case(self, handler, updates):
+        """Return seconds spent, number of updates passed to processing and DB queries."""
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            processed = sum(bool(handler(update)) for update in updates)
+            seconds = time.perf_counter() - start
+        return seconds, processed, len(queries)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        bot = Bot('000000000:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+        Chat.objects.filter(id=CHAT_ID).delete()
+        try:
+            # warm up caches and DB connection
+            self.run_case(handle_prefiltered, self.make_updates(bot, 100, 0))
+            cases = [
+                ('legacy', handle_legacy, options['seed']),
+                ('prefilter', handle_prefiltered, options['seed'] + 1),
+            ]
+            results = {}
+            for name, handler, seed in cases:
+                updates = self.make_updates(bot, number, seed)
+                seconds, processed, queries = self.run_case(handler, updates)
+                results[name] = number / seconds
+                self.stdout.write(
+                    f"{name:>9}: {number / seconds:9.0f} updates/s, "
+                    f"{processed} of {number} passed to processing, "
+                    f"{queries / number:.2f} DB queries per update"
+                )
+        finally:
+            Chat.objects.filter(id=CHAT_ID).delete()
+        self.stdout.write(self.style.SUCCESS(
+            f"speedup x{results['prefilter'] / results['legacy']:.1f}"
+        ))
@@ -0,0 +1,120 @@
+import json
+import random
+import time
+from typing import List
+
+from django.core.management import BaseCommand
+from telegram import Bot, Update
+
+from bot import redis, routing
+from bot.dispatcher import get_handlers
+from bot.management.commands.loadtestapi import TOKEN
+from bot.update_queue import stream_key
+
+USER = {'id': 1, 'first_name': 'user', 'is_bot': False, 'username': 'user', 'language_code': 'en'}
+GROUP = {'id': -1001, 'type': 'supergroup', 'title': 'group', 'username': 'group'}
+CHANNEL = {'id': -1002, 'type': 'channel', 'title': 'channel'}
+PHOTO = [{'file_id': f'photo{i}', 'width': 90 * i, 'height': 90 * i} for i in range(1, 5)]
+ENTITIES = [{'type': 'url', 'offset': 0, 'length': 19}, {'type': 'bold', 'offset': 20, 'length': 4}]
+
+
+def _message(chat, **fields):
+    return {'message_id': 1, 'date': 1564646464, 'chat': chat, 'from': USER, **fields}
+
+
+REPLIED = _message(GROUP, text='https://example.com text', entities=ENTITIES)
+# (weight, update fields) of traffic of a bot in groups and channels before `allowed_updates`
+TRAFFIC = [
+    (40, {'message': _message(GROUP, text='just a regular message')}),
+    (10, {'message': _message(GROUP, text='reply', reply_to_message=REPLIED)}),
+    (8, {'message': _message(GROUP, photo=PHOTO, caption='photo')}),
+    (8, {'edited_message': _message(GROUP, text='edited', edit_date=1564646465)}),
+    (10, {'callback_query': {
+        'id': '1', 'from': USER, 'chat_instance': '1', 'data': 'button',
+        'message': _message(GROUP, text='post', reply_markup={'inline_keyboard': [[
+            {'text': '👍', 'callback_data': 'button'},
+        ]]}),
+    }}),
+    (12, {'channel_post': _message(CHANNEL, photo=PHOTO, caption='post')}),
+    (6, {'edited_channel_post': _message(CHANNEL, text='post', edit_date=1564646465)}),
+    (3, {'poll': {'id': '1', 'question': '?', 'is_closed': False, 'options': [
+        {'text': 'yes', 'voter_count': 1}, {'text': 'no', 'voter_count': 0},
+    ]}}),
+    (3, {'message': _message({'id': 1, 'type': 'private', 'first_name': 'user'}, text='/help')}),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare decoding of all updates to objects with routing them first. '
+        'Uses updates from a file (JSON per line), from update queue or a synthetic mix.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=20000, help="Updates per case.")
+        parser.add_argument('--file', help="Captured updates, one JSON per line.")
+        parser.add_argument('--queue', action='store_true',
+                            help="Use updates of streams of `manage.py runworker`.")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def get_bodies(self, options) -> List[bytes]:
+        number = options['number']
+        if options['file']:
+            with open(options['file'], 'rb') as f:
+                bodies = [line.strip() for line in f if line.strip()]
+        elif options['queue']:
+            bodies = []
+            shard = 0
+            while len(bodies) < number:
+                entries = redis.rc.xrevrange(stream_key(shard), count=number - len(bodies))
+                if not entries and shard:
+                    break
+                bodies.extend(fields[b'update'] for _, fields in entries)
+                shard += 1
+        else:
+            rnd = random.Random(options['seed'])
+            kinds = rnd.choices(
+                [fields for _, fields in TRAFFIC], weights=[w for w, _ in TRAFFIC], k=number
+            )
+            bodies = [
+                json.dumps({'update_id': i, **fields}).encode() for i, fields in enumerate(kinds)
+            ]
+        # repeat captured updates up to the number
+        return (bodies * (number // max(len(bodies), 1) + 1))[:number]
+
+    def run_case(self, bot, bodies, loads, router=None):
+        start = time.perf_counter()
+        decoded = 0
+        for body in bodies:
+            data = loads(body)
+            if router is None or router.accepts(data):
+                Update.de_json(data, bot)
+                decoded += 1
+        return time.perf_counter() - start, decoded
+
+    def handle(self, *args, **options):
+        bodies = self.get_bodies(options)
+        if not bodies:
+            self.stdout.write(self.style.WARNING("No updates to decode."))
+            return
+        bot = Bot(TOKEN)
+        router = routing.Router(get_handlers())
+        cases = [
+            ('eager', json.loads, None),
+            ('routed', json.loads, router),
+        ]
+        if routing.json_backend is not json:
+            cases.append((f'routed+{routing.json_backend.__name__}', routing.loads, router))
+        results = {}
+        for name, loads, case_router in cases:
+            self.run_case(bot, bodies[:1000], loads, case_router)  # warm up
+            seconds, decoded = self.run_case(bot, bodies, loads, case_router)
+            results[name] = len(bodies) / seconds
+            self.stdout.write(
+                f"{name:>14}: {results[name]:9.0f} updates/s, "
+                f"{decoded} of {len(bodies)} decoded to objects"
+            )
+        best = max(results, key=results.get)
+        self.stdout.write(self.style.SUCCESS(
+            f"speedup x{results[best] / results['eager']:.1f} ({best})"
+        ))
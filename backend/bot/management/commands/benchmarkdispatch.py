@@ -0,0 +1,107 @@
+import random
+import time
+
+from django.core.management import BaseCommand
+from telegram import Bot, Update, User as TGUser
+
+from bot import redis
+from bot.dispatcher import get_handlers
+from bot.management.commands.loadtestapi import TOKEN
+from bot.redis import State
+from bot.routing import HandlerIndex
+
+BOT_USER = {'id': 1000, 'first_name': 'bot', 'is_bot': True, 'username': 'reactor_bot'}
+USER = {'id': 1001, 'first_name': 'user', 'is_bot': False}
+# user that is choosing a reaction in private chat
+STATE_USER = {'id': 1002, 'first_name': 'reacting', 'is_bot': False}
+GROUP = {'id': -1001, 'type': 'supergroup', 'title': 'group'}
+
+
+def _private(user):
+    return {'id': user['id'], 'type': 'private', 'first_name': user['first_name']}
+
+
+def _message(chat=GROUP, user=USER, **fields):
+    return {'message_id': 1, 'date': 1564646464, 'chat': chat, 'from': user, **fields}
+
+
+def _command(text, **kwargs):
+    length = len(text.split()[0])
+    return _message(text=text, entities=[{'type': 'bot_command', 'offset': 0, 'length': length}],
+                    **kwargs)
+
+
+# (weight, update fields) of typical traffic
+TRAFFIC = [
+    (55, {'message': _message(text='just a regular message')}),
+    (10, {'message': _message(text='+👍', reply_to_message=_message(user=BOT_USER, text='ok'))}),
+    (5, {'message': _message(text='reply', reply_to_message=_message(text='message'))}),
+    (8, {'message': _message(photo=[{'file_id': 'photo', 'width': 90, 'height': 90}])}),
+    (10, {'callback_query': {
+        'id': '1', 'from': USER, 'chat_instance': '1', 'data': 'button',
+        'message': _message(user=BOT_USER, text='post'),
+    }}),
+    (4, {'edited_message': _message(text='edited', edit_date=1564646465)}),
+    (3, {'message': _message(_private(STATE_USER), STATE_USER, text='👍')}),
+    (2, {'message': _command('/start 123', chat=_private(USER))}),
+    (2, {'message': _command('/settings')}),
+    (1, {'message': _message(_private(USER), text='hello')}),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare selecting handler for an update by checking all handlers in order '
+        'with checking candidates of `HandlerIndex`. Uses configured redis.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=20000, help="Updates per case.")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def make_updates(self, bot, number, seed):
+        rnd = random.Random(seed)
+        weights = [w for w, _ in TRAFFIC]
+        kinds = rnd.choices([fields for _, fields in TRAFFIC], weights=weights, k=number)
+        return [Update.de_json({'update_id': i, **fields}, bot) for i, fields in enumerate(kinds)]
+
+    def run_case(self, select, updates):
+        """Return seconds spent and number of `check_update` calls."""
+        checks = 0
+        start = time.perf_counter()
+        for update in updates:
+            for handler in select(update):
+                checks += 1
+                check = handler.check_update(update)
+                if check is not None and check is not False:
+                    break
+        return time.perf_counter() - start, checks
+
+    def handle(self, *args, **options):
+        number = options['number']
+        bot = Bot(TOKEN)
+        bot.bot = TGUser(**BOT_USER)
+        handlers = [wrapper.handler for wrapper in get_handlers()]
+        index = HandlerIndex(handlers)
+        redis.set_state(STATE_USER['id'], State.reaction)
+        try:
+            cases = [
+                ('linear', lambda update: handlers),
+                ('indexed', index.candidates),
+            ]
+            results = {}
+            for name, select in cases:
+                # the same updates, but new objects, so states are loaded again
+                updates = self.make_updates(bot, number, options['seed'])
+                self.run_case(select, updates[:1000])  # warm up
+                seconds, checks = self.run_case(select, updates)
+                results[name] = seconds / number
+                self.stdout.write(
+                    f"{name:>8}: {results[name] * 1e6:7.1f} µs per update, "
+                    f"{checks / number:4.1f} handlers checked per update"
+                )
+        finally:
+            redis.clear_state(STATE_USER['id'])
+        self.stdout.write(self.style.SUCCESS(
+            f"speedup x{results['linear'] / results['indexed']:.1f}"
+        ))
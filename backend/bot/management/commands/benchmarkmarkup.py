@@ -0,0 +1,63 @@
+import timeit
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from bot.markup import (
+    fluid_merge_keyboards,
+    make_credits_keyboard,
+    make_reactions_keyboard,
+    merge_keyboards,
+    render_reactions_markup,
+)
+
+
+def render_legacy(reactions, max_cols, padding, credits_keyboard, vote_keyboard):
+    """Keyboard rendering as it was done before keyboard templates."""
+    reactions_keyboard = make_reactions_keyboard(reactions, padding=padding, max_cols=max_cols)
+    reactions_keyboard = fluid_merge_keyboards(
+        reactions_keyboard,
+        vote_keyboard,
+        padding=padding,
+        max_cols=max_cols,
+    )
+    return merge_keyboards(credits_keyboard, reactions_keyboard)
+
+
+class Command(BaseCommand):
+    help = 'Compare per-render cost of legacy and template-based reply markup rendering.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=2000, help="Renders per case.")
+        parser.add_argument('-b', '--buttons', type=int, default=settings.MAX_NUM_BUTTONS)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        reactions = [(str(i), i * 137) for i in range(options['buttons'])]
+        credits_keyboard = make_credits_keyboard(from_name='user', from_username='user')
+        vote_keyboard = InlineKeyboardMarkup.from_button(
+            InlineKeyboardButton('➕', url='https://t.me/bot?start=1')
+        )
+
+        self.stdout.write(f"{len(reactions)} buttons, {number} renders per case, µs per render")
+        self.stdout.write(
+            f"{'columns':>7} {'padding':>7} {'vote':>5} {'legacy':>8} {'template':>8}"
+        )
+        total_legacy = total_template = 0
+        for columns in range(1, 7):
+            for padding in (False, True):
+                for vote in (None, vote_keyboard):
+                    case = (reactions, columns, padding, credits_keyboard, vote)
+                    legacy = timeit.timeit(lambda: render_legacy(*case), number=number)
+                    template = timeit.timeit(lambda: render_reactions_markup(*case), number=number)
+                    total_legacy += legacy
+                    total_template += template
+                    self.stdout.write(
+                        f"{columns:7d} {padding!s:>7} {bool(vote)!s:>5} "
+                        f"{legacy / number * 1e6:8.1f} {template / number * 1e6:8.1f}"
+                    )
+        self.stdout.write(self.style.SUCCESS(
+            f"total: legacy {total_legacy:.3f}s, template {total_template:.3f}s, "
+            f"speedup x{total_legacy / total_template:.1f}"
+        ))
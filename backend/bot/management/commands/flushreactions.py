@@ -0,0 +1,31 @@
+import signal
+
+from django.core.management import BaseCommand
+
+from bot.counters import Flusher, flush
+
+
+class Command(BaseCommand):
+    help = 'Persist reactions collected in redis (REACTIONS_BACKEND=redis) into DB.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Keep flushing until stopped.")
+
+    def handle(self, *args, **options):
+        if not options.get('loop'):
+            n = flush()
+            self.stdout.write(self.style.SUCCESS(f"Flushed {n} reactions."))
+            return
+
+        # stop gracefully on SIGTERM as well as on SIGINT
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        flusher = Flusher()
+        flusher.start()
+        self.stdout.write(f"Flushing reactions every {flusher.interval} seconds.")
+        try:
+            flusher.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            flusher.stop()
+            self.stdout.write(self.style.SUCCESS("Flushed remaining reactions."))
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from telegram import Bot
+from telegram.utils.request import Request
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+from bot.api import AsyncRequest, defer
+
+TOKEN = '000000000:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+
+
+class FakeMethodHandler(RequestHandler):
+    """Answers Bot API methods with `true` after a delay, like a remote server would."""
+    def initialize(self, latency, errors):
+        self.latency = latency
+        self.errors = errors
+
+    async def post(self, method):
+        await asyncio.sleep(self.latency)
+        self.set_header('Content-Type', 'application/json')
+        if method in self.errors:
+            self.set_status(400)
+            self.write(json.dumps({'ok': False, 'description': self.errors[method]}))
+        else:
+            self.write(json.dumps({'ok': True, 'result': True}))
+
+
+def start_fake_server(latency, errors: dict = None) -> int:
+    """
+    Run fake Bot API in a background thread, return its port.
+    Methods in `errors` fail with Bad Request and given description.
+    """
+    sockets = bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        app = Application([
+            (r'/bot[^/]+/(\w+)', FakeMethodHandler, {'latency': latency, 'errors': errors or {}}),
+        ])
+        server = HTTPServer(app)
+        server.add_sockets(sockets)
+        asyncio.get_event_loop().run_forever()
+
+    threading.Thread(target=run, name='fake-bot-api', daemon=True).start()
+    return port
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare throughput of Telegram API calls made by handler threads '
+        'with the default transport and with `AsyncRequest`, against a local fake Bot API.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=2000, help="Calls per case.")
+        parser.add_argument('-l', '--latency', type=float, default=0.05,
+                            help="Fake server response time, seconds.")
+        parser.add_argument('-w', '--workers', type=int, default=settings.TG_BOT_WORKERS,
+                            help="Handler threads.")
+        parser.add_argument('-c', '--connections', type=int,
+                            default=settings.TG_API_MAX_CONNECTIONS,
+                            help="Max connections of AsyncRequest.")
+
+    def run_case(self, bot: Bot, call, number, workers):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(lambda i: call(bot, i), range(number)))
+        if isinstance(bot.request, AsyncRequest):
+            bot.request.join()
+        return number / (time.perf_counter() - start)
+
+    def handle(self, *args, **options):
+        number, workers = options['number'], options['workers']
+        port = start_fake_server(options['latency'])
+        base_url = f'http://127.0.0.1:{port}/bot'
+
+        blocking_request = Request(con_pool_size=workers + 4)
+        async_request = AsyncRequest(max_clients=options['connections'])
+        cases = [
+            ('blocking', blocking_request, lambda bot, i: bot.answer_callback_query(str(i))),
+            ('async', async_request, lambda bot, i: bot.answer_callback_query(str(i))),
+            ('deferred', async_request, lambda bot, i: defer(bot.answer_callback_query, str(i))),
+        ]
+        results = {}
+        for name, request, call in cases:
+            bot = Bot(TOKEN, base_url=base_url, request=request)
+            # warm up connections
+            self.run_case(bot, call, workers * 2, workers)
+            results[name] = self.run_case(bot, call, number, workers)
+            self.stdout.write(f"{name:>9}: {results[name]:8.0f} calls/s")
+        async_request.stop()
+        self.stdout.write(self.style.SUCCESS(
+            f"speedup x{results['deferred'] / results['blocking']:.1f} "
+            f"({workers} workers, {options['latency'] * 1000:.0f}ms latency)"
+        ))
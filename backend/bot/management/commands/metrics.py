@@ -0,0 +1,21 @@
+from django.core.management import BaseCommand
+
+from bot import metrics
+
+
+class Command(BaseCommand):
+    help = 'Show bot metrics collected by all processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Reset metrics after showing.")
+
+    def handle(self, *args, **options):
+        values = metrics.get_all()
+        if not values:
+            self.stdout.write(self.style.WARNING("No metrics were collected yet."))
+        just = max(map(len, values), default=0)
+        for name in sorted(values):
+            self.stdout.write(f"{name.ljust(just)}  {values[name]}")
+        if options.get('reset'):
+            metrics.reset()
+            self.stdout.write(self.style.SUCCESS("Metrics were reset."))
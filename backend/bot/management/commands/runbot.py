@@ -1,3 +1,5 @@
+import signal
+
 from django.core.management import BaseCommand
 
 from bot.dispatcher import run
@@ -7,4 +9,6 @@ class Command(BaseCommand):
     help = 'Start bot.'
 
     def handle(self, *args, **options):
+        # stop gracefully on SIGTERM as well as on SIGINT
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
         run()
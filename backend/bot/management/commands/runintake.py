@@ -0,0 +1,25 @@
+import signal
+
+from django.core.management import BaseCommand
+
+from bot.api import make_bot
+from bot.dispatcher import get_handlers
+from bot.routing import get_allowed_updates
+from bot.intake import PollingIntake
+from bot.update_queue import push_many
+
+
+class Command(BaseCommand):
+    help = (
+        'Poll updates and queue them for workers (`manage.py runworker`). '
+        'Replaces `runbot` when bot is scaled to several processes.'
+    )
+
+    def handle(self, *args, **options):
+        intake = PollingIntake(
+            make_bot(), push_many, allowed_updates=get_allowed_updates(get_handlers())
+        )
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: intake.stop())
+        self.stdout.write("Queueing updates...")
+        intake.run()
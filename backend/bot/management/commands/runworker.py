@@ -0,0 +1,19 @@
+import signal
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from bot.dispatcher import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Process updates queued by webhook (WEBHOOK_QUEUE=true).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-t', '--threads', type=int, default=settings.TG_BOT_WORKERS,
+                            help="Number of updates processed at once.")
+
+    def handle(self, *args, **options):
+        # stop gracefully on SIGTERM as well as on SIGINT
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        run_worker(options['threads'])
@@ -5,6 +5,9 @@ from django.core.management import BaseCommand
 from django.conf import settings
 from telegram import Bot
 
+from bot.dispatcher import get_handlers
+from bot.routing import get_allowed_updates
+
 
 class Command(BaseCommand):
     help = 'If WEBHOOK_URL is specified - setup webhook, otherwise - remove webhook.'
@@ -12,9 +15,11 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         bot = Bot(settings.TG_BOT_TOKEN)
         if settings.WEBHOOK_URL:
-            bot.set_webhook(settings.WEBHOOK_URL)
+            allowed_updates = get_allowed_updates(get_handlers())
+            bot.set_webhook(settings.WEBHOOK_URL, allowed_updates=allowed_updates)
             truncated_hook = urlparse(settings.WEBHOOK_URL).netloc
             self.stdout.write(self.style.SUCCESS(f"Webhook was set up. Host: {truncated_hook}."))
+            self.stdout.write(f"Allowed updates: {', '.join(allowed_updates)}.")
         else:
             bot.delete_webhook()
             self.stdout.write(self.style.WARNING(f"Webhook was removed."))
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+from redis import ResponseError
+
+from bot import redis
+from bot.sharding import assign, get_workers
+from bot.update_queue import GROUP, entry_age, stream_key
+
+
+class Command(BaseCommand):
+    help = 'Show queued updates of every shard: owner, length, pending and lag.'
+
+    def get_lag(self, stream, last_delivered) -> float:
+        """Age of the oldest entry that wasn't delivered to workers yet."""
+        for entry_id, _ in redis.rc.xrange(stream, min=last_delivered, count=2):
+            if entry_id != last_delivered:
+                return entry_age(entry_id)
+        return 0.0
+
+    def handle(self, *args, **options):
+        workers = get_workers()
+        owners = {
+            shard: worker
+            for worker, shards in assign(settings.UPDATES_SHARDS, workers).items()
+            for shard in shards
+        }
+        self.stdout.write(f"{len(workers)} workers: {' '.join(workers)}")
+        self.stdout.write(f"{'shard':>5}  {'length':>7}  {'pending':>7}  {'lag, s':>7}  owner")
+        for shard in range(settings.UPDATES_SHARDS):
+            stream = stream_key(shard)
+            try:
+                groups = redis.rc.xinfo_groups(stream)
+            except ResponseError:
+                groups = []  # no stream yet
+            group = next((g for g in groups if g['name'].decode() == GROUP), None)
+            length = redis.rc.xlen(stream)
+            pending = group['pending'] if group else 0
+            lag = self.get_lag(stream, group['last-delivered-id']) if group else 0.0
+            line = (
+                f"{shard:>5}  {length:>7}  {pending:>7}  {lag:>7.1f}  "
+                f"{owners.get(shard, '-')}"
+            )
+            if lag > settings.UPDATES_WORKER_TIMEOUT:
+                line = self.style.WARNING(line)
+            self.stdout.write(line)
@@ -0,0 +1,57 @@
+import os
+import resource
+import time
+
+from django.core.management import BaseCommand
+from telegram import Bot, Chat as TGChat, Message as TGMessage, Update, User as TGUser
+from telegram.ext import CallbackContext, Dispatcher
+
+from bot.context_data import bound_context_data
+from bot.management.commands.loadtestapi import TOKEN
+
+
+def get_rss() -> int:
+    """Resident memory of the process in bytes (peak one if current isn't available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay updates of distinct users and chats through context creation of dispatcher '
+        'and show how resident memory changes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=1000000, help="Distinct users.")
+        parser.add_argument('--unbounded', action='store_true',
+                            help="Keep default storage of python-telegram-bot.")
+        parser.add_argument('--samples', type=int, default=10)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        dp = Dispatcher(Bot(TOKEN), None, workers=0, use_context=True)
+        if not options['unbounded']:
+            bound_context_data(dp)
+        step = max(number // options['samples'], 1)
+        start_rss = get_rss()
+        start = time.perf_counter()
+        for i in range(1, number + 1):
+            user = TGUser(i, 'user', False)
+            chat = TGChat(-i, TGChat.GROUP)
+            update = Update(i, message=TGMessage(i, user, None, chat))
+            context = CallbackContext.from_update(update, dp)
+            context.user_data['seen'] = i
+            if i % step == 0:
+                self.stdout.write(
+                    f"{i:>9} users: rss {get_rss() / 2 ** 20:7.1f} MiB, "
+                    f"{len(dp.user_data)} user_data, {len(dp.chat_data)} chat_data"
+                )
+        growth = (get_rss() - start_rss) / 2 ** 20
+        self.stdout.write(self.style.SUCCESS(
+            f"{number / (time.perf_counter() - start):.0f} updates/s, "
+            f"rss grew by {growth:.1f} MiB"
+        ))
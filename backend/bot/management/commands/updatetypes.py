@@ -0,0 +1,36 @@
+from django.core.management import BaseCommand
+
+from bot import metrics
+from bot.dispatcher import get_handlers
+from bot.routing import get_allowed_updates
+
+PREFIX = 'update_type:'
+
+
+class Command(BaseCommand):
+    help = (
+        'Show received updates by type and share of updates that no handler can process, '
+        'they are not requested since `allowed_updates` is set.'
+    )
+
+    def handle(self, *args, **options):
+        counts = {
+            name[len(PREFIX):]: value
+            for name, value in metrics.get_all().items()
+            if name.startswith(PREFIX)
+        }
+        total = sum(counts.values())
+        if not total:
+            self.stdout.write(self.style.WARNING("No updates were counted yet."))
+            return
+        allowed = set(get_allowed_updates(get_handlers()))
+        just = max(map(len, counts))
+        for kind, count in sorted(counts.items(), key=lambda e: -e[1]):
+            status = 'handled' if kind in allowed else 'discarded'
+            self.stdout.write(
+                f"{kind.ljust(just)}  {count:>9}  {count / total:6.1%}  {status}"
+            )
+        discarded = sum(count for kind, count in counts.items() if kind not in allowed)
+        self.stdout.write(self.style.SUCCESS(
+            f"{discarded} of {total} updates ({discarded / total:.1%}) were discarded"
+        ))
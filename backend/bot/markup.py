@@ -1,8 +1,13 @@
+import hashlib
+import json
+from functools import lru_cache
 from typing import Optional, Tuple
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, Bot
 
-from core.models import Chat, Message, Button
+from bot.chat_config import get_message_chat
+from bot.counters import get_reactions
+from core.models import Chat, Message
 
 EMPTY_CB_DATA = '~'
 
@@ -147,27 +152,32 @@ def fluid_merge_keyboards(*keyboards: Optional[InlineKeyboardMarkup], max_cols:
     return InlineKeyboardMarkup(ks)
 
 
+def format_count(count: int) -> str:
+    count_text = str(count)
+    if count > 1000:
+        if count % 1000 >= 100:
+            count_text = f'{count / 1000:.1f}k'
+        else:
+            count_text = f'{count // 1000}k'
+    return count_text
+
+
+@lru_cache(maxsize=4096)
+def make_reaction_button(text: str, count: int, blank=False) -> InlineKeyboardButton:
+    """Buttons are cached, so they must not be mutated."""
+    payload = EMPTY_CB_DATA if blank else f"button:{text}"
+    if count > 0:
+        text = f'{text} {format_count(count)}'
+    return InlineKeyboardButton(text, callback_data=payload)
+
+
 def gen_buttons(rates: list, blank=False, sort=False):
-    for i, rate in enumerate(rates):
-        if isinstance(rate, str):
-            rates[i] = (rate, 0)
+    rates = [(rate, 0) if isinstance(rate, str) else rate for rate in rates]
 
     if sort:
         rates.sort(key=lambda e: -e[1])
 
-    result = []
-    for text, count in rates:
-        payload = EMPTY_CB_DATA if blank else f"button:{text}"
-        count_text = str(count)
-        if count > 1000:
-            if count % 1000 >= 100:
-                count_text = f'{count / 1000:.1f}k'
-            else:
-                count_text = f'{count // 1000}k'
-        if count > 0:
-            text = f'{text} {count_text}'
-        result.append(InlineKeyboardButton(text, callback_data=payload))
-    return result
+    return [make_reaction_button(text, count, blank) for text, count in rates]
 
 
 def split_to_columns(lines: list, max_cols: int):
@@ -195,6 +205,64 @@ def make_reactions_keyboard(rates: list, padding=False, max_cols=5, blank=False,
     return InlineKeyboardMarkup(keyboard)
 
 
+VOTE_SLOT = 'vote'
+
+
+@lru_cache(maxsize=1024)
+def compile_keyboard_template(
+    num_buttons: int, max_cols: int, padding: bool, vote: bool, credits_rows: int
+) -> Tuple[Tuple, ...]:
+    """
+    Precompute layout of reactions part of the keyboard.
+
+    Layout is the same as produced by `make_reactions_keyboard` + `fluid_merge_keyboards` with
+    vote keyboard + `merge_keyboards` with credits keyboard, but it depends only on the shape
+    of the keyboard and is calculated once per chat settings.
+    Slot is either an index of reaction, `VOTE_SLOT` or static padding button.
+    """
+    slots = list(range(num_buttons))
+    if vote:
+        slots.append(VOTE_SLOT)
+    if padding:
+        extend_with_padding(slots, max_cols)
+    rows = split_to_columns(slots, max_cols)
+    rows = rows[:max(10 - credits_rows, 0)]  # telegram limit is 10x10
+    return tuple(tuple(row) for row in rows)
+
+
+def render_reactions_markup(
+    reactions: list,
+    max_cols: int,
+    padding=False,
+    credits_keyboard: InlineKeyboardMarkup = None,
+    vote_keyboard: InlineKeyboardMarkup = None,
+) -> Optional[InlineKeyboardMarkup]:
+    """Render reactions using cached keyboard template. Only count labels are generated."""
+    credits_rows = credits_keyboard.inline_keyboard if credits_keyboard else []
+    vote_button = vote_keyboard and vote_keyboard.inline_keyboard[0][0]
+    template = compile_keyboard_template(
+        len(reactions), max_cols, padding, bool(vote_button), len(credits_rows)
+    )
+    buttons = gen_buttons(reactions)
+    rows = [*credits_rows]
+    for row in template:
+        rows.append([
+            buttons[slot] if isinstance(slot, int) else
+            vote_button if slot == VOTE_SLOT else slot
+            for slot in row
+        ])
+    if not rows:
+        return
+    return InlineKeyboardMarkup(rows)
+
+
+def markup_fingerprint(reply_markup: Optional[InlineKeyboardMarkup]) -> str:
+    """Short hash that is equal for markups that look the same in telegram."""
+    data = reply_markup.to_dict() if reply_markup else None
+    data = json.dumps(data, sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(data.encode()).hexdigest()
+
+
 def make_reply_markup(
     update: Update,
     bot: Bot,
@@ -205,12 +273,12 @@ def make_reply_markup(
 ) -> Tuple[Optional[Chat], InlineKeyboardMarkup]:
     if not chat:
         if message:
-            chat = message.chat
+            chat = get_message_chat(message)
         else:
             chat, _ = Chat.objects.get_or_create(id=update.effective_message.chat_id)
     if reactions is None:
         if message:
-            reactions = Button.objects.reactions(**message.ids)
+            reactions = get_reactions(message)
         elif chat:
             reactions = chat.buttons
         else:
@@ -219,14 +287,12 @@ def make_reply_markup(
     # message doesn't have chat and it wasn't provided as arg
     # which means that we are creating keyboard for inline post
     if not chat:
-        max_cols = 5
         vote_keyboard = make_vote_keyboard(bot, message and message.inline_message_id)
-        reactions_keyboard = make_reactions_keyboard(reactions, max_cols=max_cols)
-        reply_markup = fluid_merge_keyboards(
-            reactions_keyboard,
-            vote_keyboard,
-            max_cols=max_cols,
+        reply_markup = render_reactions_markup(
+            reactions,
+            max_cols=5,
             padding=True,
+            vote_keyboard=vote_keyboard,
         )
         return None, reply_markup
 
@@ -243,16 +309,11 @@ def make_reply_markup(
 
     vote_keyboard = make_vote_keyboard(bot, message and message.inline_message_id)
     credits_keyboard = make_credits_keyboard(**credits)
-    reactions_keyboard = make_reactions_keyboard(
+    reply_markup = render_reactions_markup(
         reactions,
-        padding=chat.add_padding,
         max_cols=chat.columns,
-    )
-    reactions_keyboard = fluid_merge_keyboards(
-        reactions_keyboard,
-        vote_keyboard,
         padding=chat.add_padding,
-        max_cols=chat.columns,
+        credits_keyboard=credits_keyboard,
+        vote_keyboard=vote_keyboard,
     )
-    reply_markup = merge_keyboards(credits_keyboard, reactions_keyboard)
     return chat, reply_markup
@@ -0,0 +1,106 @@
+"""
+Coalesce keyboard edits of the same message.
+
+The first click opens a window of `MARKUP_UPDATE_WINDOW` seconds and edits markup immediately.
+Clicks within the window (from any process) only mark the message as dirty.
+When the window closes, the process that opened it re-renders markup with the latest counts
+and sends a single edit for all of them, opening the next window.
+"""
+import logging
+import threading
+from typing import Callable
+
+from django.conf import settings
+from django.db import connection
+
+from bot import metrics, redis
+
+logger = logging.getLogger(__name__)
+
+ACQUIRE_SCRIPT = """
+-- KEYS: window, pending
+-- ARGV: window in ms
+if redis.call('SET', KEYS[1], 1, 'NX', 'PX', ARGV[1]) then
+    return 1
+end
+redis.call('SET', KEYS[2], 1, 'PX', ARGV[1] * 10)
+return 0
+"""
+
+RELEASE_SCRIPT = """
+-- KEYS: window, pending
+-- ARGV: window in ms
+if redis.call('DEL', KEYS[2]) == 1 then
+    redis.call('SET', KEYS[1], 1, 'PX', ARGV[1])
+    return 1
+end
+redis.call('DEL', KEYS[1])
+return 0
+"""
+
+acquire_script = redis.rc.register_script(ACQUIRE_SCRIPT)
+release_script = redis.rc.register_script(RELEASE_SCRIPT)
+
+
+class MarkupUpdater:
+    def __init__(self, window: float = None):
+        self._window = window
+
+    @property
+    def window(self) -> float:
+        return settings.MARKUP_UPDATE_WINDOW if self._window is None else self._window
+
+    def _keys(self, key):
+        return [f'markup:window:{key}', f'markup:pending:{key}']
+
+    def _acquire(self, key) -> bool:
+        """Open window for message or mark it as dirty if window is already open."""
+        args = [int(self.window * 1000)]
+        return bool(acquire_script(keys=self._keys(key), args=args, client=redis.rc))
+
+    def _release(self, key) -> bool:
+        """Close window. If message is dirty - open next window and return True."""
+        args = [int(self.window * 1000)]
+        return bool(release_script(keys=self._keys(key), args=args, client=redis.rc))
+
+    def _edit(self, edit: Callable, *args):
+        try:
+            edit(*args)
+        except Exception:
+            logger.exception("failed to update markup")
+        metrics.inc('markup_edits_sent')
+
+    def _close_window(self, key, edit: Callable):
+        try:
+            if self._release(key):
+                self._edit(edit)
+                self._schedule_close(key, edit)
+        finally:
+            connection.close()
+
+    def _schedule_close(self, key, edit: Callable):
+        timer = threading.Timer(self.window, self._close_window, args=(key, edit))
+        timer.daemon = True
+        timer.start()
+
+    def schedule(self, key, edit: Callable, *args):
+        """
+        Edit markup of message `key` now or as soon as its window closes.
+
+        :param key: unique message ID
+        :param edit: renders and sends markup. When edit is delayed it is called w/o arguments,
+            so it should fetch the latest counts by itself.
+        :param args: arguments for immediate edit (eg: counts that were just calculated)
+        """
+        metrics.inc('markup_edits_requested')
+        if self.window <= 0:
+            self._edit(edit, *args)
+            return
+        if self._acquire(key):
+            self._edit(edit, *args)
+            self._schedule_close(key, edit)
+        else:
+            metrics.inc('markup_edits_coalesced')
+
+
+markup_updater = MarkupUpdater()
@@ -0,0 +1,151 @@
+"""
+Memoize function results for a limited time.
+
+- at most `maxsize` results are kept, least recently used ones are evicted
+- concurrent calls with the same arguments share a single call of function (single-flight)
+- expired result can be served for `stale_ttl` more seconds while it's refreshed in background
+- hits, misses, stale hits and evictions are counted in `cache.stats` and `bot.metrics`
+"""
+import functools
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, NamedTuple
+
+from bot import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry(NamedTuple):
+    value: object
+    expires: float
+    stale_until: float
+
+
+class _Flight:
+    """Function call that is in progress, other callers wait for its result."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    def __init__(self, func: Callable, ttl: float, maxsize=1024, stale_ttl: float = 0, name=None,
+                 key: Callable = None):
+        self.func = func
+        self.key = key
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stale_ttl = stale_ttl
+        self.name = name or func.__name__
+        self.stats = Counter()
+        self._data = OrderedDict()
+        self._flights: Dict[object, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def make_key(self, args, kwargs):
+        if self.key is not None:
+            return self.key(*args, **kwargs)
+        return args + tuple(sorted(kwargs.items())) if kwargs else args
+
+    def _report(self, stat, value=1):
+        # `stats` are counted under the lock, metrics w/o it as they may be flushed
+        metrics.inc(f'{self.name}_cache_{stat}', value)
+
+    def _store(self, key, value):
+        now = time.monotonic()
+        entry = _Entry(value, now + self.ttl, now + self.ttl + self.stale_ttl)
+        with self._lock:
+            self._data[key] = entry
+            self._data.move_to_end(key)
+            evicted = 0
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                evicted += 1
+            if evicted:
+                self.stats['evictions'] += evicted
+        if evicted:
+            self._report('evictions', evicted)
+
+    def _load(self, key, flight: _Flight, args, kwargs):
+        try:
+            flight.value = self.func(*args, **kwargs)
+            self._store(key, flight.value)
+        except Exception as e:
+            flight.error = e
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def _refresh(self, key, flight: _Flight, args, kwargs):
+        self._load(key, flight, args, kwargs)
+        if flight.error:
+            logger.error(f"failed to refresh {self.name}{args}: {flight.error!r}")
+
+    def __call__(self, *args, **kwargs):
+        key = self.make_key(args, kwargs)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and now < entry.stale_until:
+                self._data.move_to_end(key)
+            refresh = entry is not None and entry.expires <= now < entry.stale_until
+            fresh = entry is not None and now < entry.expires
+            flight = self._flights.get(key)
+            leader = flight is None and not fresh
+            if leader:
+                flight = self._flights[key] = _Flight()
+            stat = 'hits' if fresh else 'stale_hits' if refresh else 'misses'
+            self.stats[stat] += 1
+
+        self._report(stat)
+        if fresh:
+            return entry.value
+        if refresh:
+            if leader:
+                threading.Thread(
+                    target=self._refresh, args=(key, flight, args, kwargs), daemon=True
+                ).start()
+            return entry.value
+
+        if leader:
+            self._load(key, flight, args, kwargs)
+        else:
+            flight.done.wait()
+        if flight.error:
+            raise flight.error
+        return flight.value
+
+    def invalidate(self, *args, **kwargs):
+        with self._lock:
+            self._data.pop(self.make_key(args, kwargs), None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def memoize(ttl: float, maxsize=1024, stale_ttl: float = 0, name=None, key: Callable = None):
+    """
+    Decorator that caches results of function in `TTLCache`.
+    Cache is available as `cache` attribute of decorated function.
+    `key` makes cache key of arguments, by default all arguments are the key.
+    """
+    def decorator(func):
+        cache = TTLCache(func, ttl, maxsize=maxsize, stale_ttl=stale_ttl, name=name, key=key)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return cache(*args, **kwargs)
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
@@ -0,0 +1,82 @@
+"""
+Lightweight counters shared by all bot processes.
+
+Values are accumulated in memory and periodically added to redis hash `metrics`
+with a single pipeline, so counting doesn't add redis round trips to hot handlers.
+Use `manage.py metrics` to display them.
+"""
+import atexit
+import logging
+import time
+from collections import Counter
+from threading import Lock
+from typing import Dict
+
+from django.conf import settings
+
+from bot import redis
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = 'metrics'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_counters = Counter()
+_lock = Lock()
+_flushed = time.monotonic()
+
+
+def inc(name: str, value=1):
+    with _lock:
+        _counters[name] += value
+        due = time.monotonic() - _flushed >= settings.METRICS_FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def observe(name: str, value: float, buckets=DEFAULT_BUCKETS):
+    """Add value to the cumulative histogram `name` (eg: latency in seconds)."""
+    inc(f'{name}:count')
+    inc(f'{name}:sum', value)
+    for bucket in buckets:
+        if value <= bucket:
+            inc(f'{name}:le={bucket}')
+    inc(f'{name}:le=inf')
+
+
+def flush():
+    global _flushed
+    with _lock:
+        counters = dict(_counters)
+        _counters.clear()
+        _flushed = time.monotonic()
+    if not counters:
+        return
+    try:
+        pipe = redis.rc.pipeline(transaction=False)
+        for name, value in counters.items():
+            if isinstance(value, int):
+                pipe.hincrby(METRICS_KEY, name, value)
+            else:
+                pipe.hincrbyfloat(METRICS_KEY, name, value)
+        pipe.execute()
+    except Exception:
+        logger.exception("failed to flush metrics")
+
+
+def get_all() -> Dict[str, float]:
+    flush()
+    res = {}
+    for name, value in redis.rc.hgetall(METRICS_KEY).items():
+        value = float(value)
+        res[name.decode()] = int(value) if value.is_integer() else value
+    return res
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+    redis.rc.delete(METRICS_KEY)
+
+
+atexit.register(flush)
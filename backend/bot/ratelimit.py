@@ -0,0 +1,221 @@
+"""
+Outbound rate limiting of Bot API calls.
+
+Every call of a limited method waits for a token of the global bucket (`TG_RATE_GLOBAL` per
+second) and of its chat's bucket (`TG_RATE_GROUP` per minute in groups, `TG_RATE_PRIVATE`
+per second in private chats). Waiting calls are served by lanes: callback query answers first,
+then sending (reposts), then edits of markup. A call that is blocked by its own chat's bucket
+doesn't hold back calls to other chats.
+
+`RetryAfter` pauses the chat (or all chats if call has no chat) for given time
+and the call is retried up to `TG_RATE_RETRIES` times.
+"""
+import logging
+import threading
+import time
+from itertools import count
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from telegram.error import RetryAfter
+
+from bot import metrics
+
+logger = logging.getLogger(__name__)
+
+LANE_ANSWER = 0
+LANE_SEND = 1
+LANE_EDIT = 2
+LANE_NAMES = ('answer', 'send', 'edit')
+
+ANSWER_METHODS = ('answerCallbackQuery', 'answerInlineQuery')
+# messages that can be sent to group at once, before its per minute rate applies
+GROUP_BURST = 3
+# max number of idle chat buckets kept in memory
+MAX_CHAT_BUCKETS = 10000
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def classify(method: str) -> Tuple[Optional[int], bool]:
+    """Return lane of API method (None - not limited) and whether it's limited per chat."""
+    if method in ANSWER_METHODS:
+        return LANE_ANSWER, False
+    if method.startswith(('send', 'forward')):
+        return LANE_SEND, True
+    if method.startswith('edit'):
+        return LANE_EDIT, True
+    if method == 'deleteMessage':
+        return LANE_SEND, False
+    return None, False
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now) -> float:
+        """Seconds until a token is available, 0 if it's available now."""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+
+    def is_idle(self, now) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class _Waiter:
+    __slots__ = ('lane', 'seq', 'chat_id', 'limit_chat')
+
+    def __init__(self, lane, seq, chat_id, limit_chat):
+        self.lane = lane
+        self.seq = seq
+        self.chat_id = chat_id
+        self.limit_chat = limit_chat
+
+
+class Scheduler:
+    """Grants permissions to make API calls in order of lanes, within rate limits."""
+    def __init__(self, global_rate: float, group_rate: float, private_rate: float):
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.group_rate = group_rate
+        self.private_rate = private_rate
+        self.chats: Dict[int, TokenBucket] = {}
+        self._waiters = []
+        self._seq = count()
+        self._cond = threading.Condition()
+
+    def _chat_bucket(self, chat_id) -> Optional[TokenBucket]:
+        if chat_id is None:
+            return
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= MAX_CHAT_BUCKETS:
+                now = time.monotonic()
+                self.chats = {k: b for k, b in self.chats.items() if not b.is_idle(now)}
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, capacity=GROUP_BURST)
+            else:
+                bucket = TokenBucket(self.private_rate, capacity=1)
+            self.chats[chat_id] = bucket
+        return bucket
+
+    def _chat_delay(self, waiter: _Waiter, now) -> float:
+        bucket = self._chat_bucket(waiter.chat_id)
+        if bucket is None:
+            return 0.0
+        if waiter.limit_chat:
+            return bucket.delay(now)
+        # not counted, but paused chat is respected
+        return max(0.0, bucket.blocked_until - now)
+
+    def _delay(self, waiter: _Waiter, now) -> float:
+        """Seconds until waiter can go, 0 - it can go now."""
+        chat_delay = self._chat_delay(waiter, now)
+        if chat_delay:
+            return chat_delay
+        for other in self._waiters:
+            if other is waiter:
+                break
+            if not self._chat_delay(other, now):
+                # waiter with higher priority goes first
+                return self.global_bucket.delay(now) or 1 / self.global_bucket.rate
+        return self.global_bucket.delay(now)
+
+    def acquire(self, lane: int, chat_id=None, limit_chat=True) -> float:
+        """
+        Wait for permission to make a call, return waited time in seconds.
+        If `limit_chat` is False, call doesn't use chat's bucket, but waits while chat is paused.
+        """
+        start = time.monotonic()
+        with self._cond:
+            waiter = _Waiter(lane, next(self._seq), chat_id, limit_chat)
+            metrics.observe('api_queue_depth', len(self._waiters), buckets=DEPTH_BUCKETS)
+            self._waiters.append(waiter)
+            self._waiters.sort(key=lambda w: (w.lane, w.seq))
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._delay(waiter, now)
+                    if not delay:
+                        break
+                    self._cond.wait(delay)
+                self.global_bucket.take(now)
+                bucket = self._chat_bucket(chat_id)
+                if bucket and limit_chat:
+                    bucket.take(now)
+            finally:
+                self._waiters.remove(waiter)
+                self._cond.notify_all()
+        waited = time.monotonic() - start
+        metrics.observe(f'api_queue_seconds_{LANE_NAMES[lane]}', waited)
+        return waited
+
+    def pause(self, chat_id, seconds: float):
+        """Stop calls to chat (or all calls if `chat_id` is None) for some time."""
+        with self._cond:
+            until = time.monotonic() + seconds
+            bucket = self._chat_bucket(chat_id) or self.global_bucket
+            bucket.block(until)
+            self._cond.notify_all()
+
+
+def _get_chat_id(data: dict) -> Optional[int]:
+    chat_id = data.get('chat_id')
+    if isinstance(chat_id, int):
+        return chat_id
+    if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+        return int(chat_id)
+    # inline messages and @channel usernames are limited only globally
+
+
+class RateLimitedRequest:
+    """Wraps `Request`, so every call of bot goes through `Scheduler`."""
+    def __init__(self, request, scheduler: Scheduler, retries: int):
+        self.request = request
+        self.scheduler = scheduler
+        self.retries = retries
+
+    def __getattr__(self, name):
+        return getattr(self.request, name)
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        lane, per_chat = classify(method)
+        if lane is None:
+            return self.request.post(url, data, timeout)
+        chat_id = _get_chat_id(data)
+        for attempt in range(self.retries + 1):
+            self.scheduler.acquire(lane, chat_id, limit_chat=per_chat)
+            try:
+                return self.request.post(url, dict(data), timeout)
+            except RetryAfter as e:
+                metrics.inc('api_retry_after')
+                logger.warning(f"{method} to {chat_id}: retry after {e.retry_after}s")
+                self.scheduler.pause(chat_id, e.retry_after)
+                if attempt == self.retries:
+                    raise
+
+
+def make_scheduler() -> Scheduler:
+    return Scheduler(
+        global_rate=settings.TG_RATE_GLOBAL,
+        group_rate=settings.TG_RATE_GROUP / 60,
+        private_rate=settings.TG_RATE_PRIVATE,
+    )
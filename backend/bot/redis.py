@@ -1,14 +1,20 @@
 import json
 import logging
+import threading
+import weakref
+from contextlib import contextmanager
 from enum import Enum, auto
+from typing import Optional
 
 import redis
 from django.conf import settings
+from telegram import Message as TGMessage, Update
 
 logger = logging.getLogger(__name__)
 rc = redis.Redis.from_url(settings.REDIS_URL)
 
 STATE_EXPIRY = 60 * 60
+MARKUP_FINGERPRINT_EXPIRY = 24 * 60 * 60
 
 
 class State(Enum):
@@ -23,11 +29,57 @@ class State(Enum):
 
 def save_media_group(media_group, expire=60):
     """Save media_group to redis storage and return True if it didn't exist yet."""
-    key = f'media_group:{media_group}'
-    if rc.exists(key):
-        return False
-    rc.set(key, 1, ex=expire)
-    return True
+    return bool(rc.set(f'media_group:{media_group}', 1, ex=expire, nx=True))
+
+
+CLAIM_FINGERPRINT_SCRIPT = """
+-- KEYS: fingerprint
+-- ARGV: fingerprint, expire
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+CONFIRM_FINGERPRINT_SCRIPT = """
+-- KEYS: fingerprint
+-- ARGV: fingerprint, 1 if markup was sent
+local ours = redis.call('GET', KEYS[1]) == ARGV[1]
+if ARGV[2] == '1' then
+    -- concurrent edit was claimed while ours was sent, which one is displayed is unknown
+    if not ours then
+        redis.call('DEL', KEYS[1])
+    end
+elseif ours then
+    redis.call('DEL', KEYS[1])
+end
+"""
+
+claim_fingerprint_script = rc.register_script(CLAIM_FINGERPRINT_SCRIPT)
+confirm_fingerprint_script = rc.register_script(CONFIRM_FINGERPRINT_SCRIPT)
+
+
+def _markup_key(message_id):
+    return f'markup:sent:{message_id}'
+
+
+def claim_markup_fingerprint(message_id, fingerprint, expire=MARKUP_FINGERPRINT_EXPIRY) -> bool:
+    """
+    Record fingerprint of markup that is going to be sent.
+    Returns False if the same markup is already displayed (or being sent).
+    """
+    args = [fingerprint, expire]
+    return bool(claim_fingerprint_script(keys=[_markup_key(message_id)], args=args, client=rc))
+
+
+def confirm_markup_fingerprint(message_id, fingerprint, sent: bool):
+    """
+    Keep claimed fingerprint only if markup was sent and no other markup was claimed meanwhile,
+    otherwise displayed markup is unknown and the next edit isn't skipped.
+    """
+    args = [fingerprint, int(sent)]
+    confirm_fingerprint_script(keys=[_markup_key(message_id)], args=args, client=rc)
 
 
 def _state_key(user):
@@ -35,42 +87,151 @@ def _state_key(user):
     return f'state:{user}'
 
 
+class StateSession:
+    """
+    State of a single user during processing of a single update.
+    Whole state hash is loaded once on first read, changes are written back by `commit`
+    in a single pipeline.
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.key = _state_key(user_id)
+        self._data = None
+        self._changed = {}
+        self._deleted = set()
+        self._lock = threading.Lock()
+
+    @property
+    def data(self) -> dict:
+        with self._lock:
+            if self._data is None:
+                self._data = {k.decode(): v.decode() for k, v in rc.hgetall(self.key).items()}
+            return self._data
+
+    def get(self, key, default=None):
+        if key in self._deleted:
+            return default
+        if key in self._changed:
+            return self._changed[key]
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self._deleted.discard(key)
+        self._changed[key] = str(value)
+
+    def delete(self, key):
+        existed = self.get(key) is not None
+        self._changed.pop(key, None)
+        self._deleted.add(key)
+        return int(existed)
+
+    def commit(self):
+        if not self._changed and not self._deleted:
+            return
+        pipe = rc.pipeline()
+        if self._changed:
+            pipe.hmset(self.key, self._changed)
+            pipe.expire(self.key, STATE_EXPIRY)
+        if self._deleted:
+            pipe.hdel(self.key, *self._deleted)
+        pipe.execute()
+        if self._data is not None:
+            for key in self._deleted:
+                self._data.pop(key, None)
+            self._data.update(self._changed)
+        self._changed = {}
+        self._deleted = set()
+
+
+# sessions of messages that are being processed, shared by filters and handlers
+_sessions = weakref.WeakKeyDictionary()
+_sessions_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_session(message: TGMessage) -> Optional[StateSession]:
+    """Return state session of message's sender, the same one for all filters and handlers."""
+    user = message and message.from_user
+    if not user:
+        return
+    with _sessions_lock:
+        session = _sessions.get(message)
+        if session is None:
+            session = _sessions[message] = StateSession(user.id)
+        return session
+
+
+@contextmanager
+def state_session(update: Update):
+    """Serve state functions from update's session and write changes back at the end."""
+    previous = getattr(_local, 'session', None)
+    session = get_session(update.effective_message)
+    _local.session = session
+    try:
+        yield session
+    finally:
+        _local.session = previous
+        # nested handler calls share session of the outermost one
+        if session and session is not previous:
+            with _sessions_lock:
+                _sessions.pop(update.effective_message, None)
+            session.commit()
+
+
+def _get_session(user) -> Optional[StateSession]:
+    session = getattr(_local, 'session', None)
+    if session and str(session.user_id) == str(getattr(user, 'id', user)):
+        return session
+
+
 def set_state(user, state: State):
-    key = _state_key(user)
-    rc.hset(key, 'state', str(state))
-    rc.expire(key, STATE_EXPIRY)
+    set_key(user, 'state', str(state))
 
 
 def set_key(user, key, value):
-    state_key = _state_key(user)
     if isinstance(value, (dict, list, tuple)):
         value = json.dumps(value)
-    rc.hset(state_key, key, value)
-    rc.expire(state_key, STATE_EXPIRY)
+    session = _get_session(user)
+    if session:
+        session.set(key, value)
+        return
+    state_key = _state_key(user)
+    pipe = rc.pipeline()
+    pipe.hset(state_key, key, value)
+    pipe.expire(state_key, STATE_EXPIRY)
+    pipe.execute()
+
+
+def _get_value(user, key):
+    session = _get_session(user)
+    if session:
+        return session.get(key)
+    value = rc.hget(_state_key(user), key)
+    return value and value.decode()
 
 
 def get_key(user, key, default=None):
-    state_key = _state_key(user)
-    value = rc.hget(state_key, key)
+    value = _get_value(user, key)
     if not value:
         return default
-    return value.decode()
+    return value
 
 
 def get_json(user, key, default=None):
-    state_key = _state_key(user)
-    value = rc.hget(state_key, key)
+    value = _get_value(user, key)
     if not value:
         return default
-    return json.loads(value.decode())
+    return json.loads(value)
 
 
 def check_state(user, state: State):
-    key = _state_key(user)
-    stored_state = rc.hget(key, 'state')
-    return bool(stored_state and stored_state.decode() == str(state))
+    stored_state = _get_value(user, 'state')
+    return bool(stored_state and stored_state == str(state))
 
 
 def clear_state(user):
+    session = _get_session(user)
+    if session:
+        return session.delete('state')
     key = _state_key(user)
     return rc.hdel(key, 'state')
@@ -0,0 +1,246 @@
+"""
+Route updates by decoded JSON before building `telegram.Update`.
+
+`Update.de_json` builds the whole object graph of an update (users, chats, entities, photo
+sizes, replied messages), though many updates are matched by no handler. `Router` peeks at
+kind of update and type of its chat and only updates that some handler can take are decoded
+to objects and passed to dispatcher. Routes are derived from handlers and their filters,
+they may let through updates that no handler takes, but never drop ones that a handler takes.
+
+`HandlerIndex` picks handlers that dispatcher checks for an update: the ones that take
+its kind and chat, its command (only command handlers of that command), and whose filters
+agree with whether message is a reply (to bot) and with user's state.
+
+JSON is decoded by `orjson` if it's installed, otherwise by standard `json`.
+"""
+from typing import Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from telegram import Message as TGMessage, Update
+from telegram.ext import (
+    CallbackQueryHandler,
+    ChosenInlineResultHandler,
+    CommandHandler,
+    Filters,
+    Handler,
+    InlineQueryHandler,
+    MessageHandler,
+)
+from telegram.ext.filters import BaseFilter, InvertedFilter, MergedFilter
+
+from bot import redis
+from bot.filters import ReplyToBot, StateFilter, reply_to_bot
+from bot.wrapper import HandlerWrapper
+
+try:
+    import orjson as json_backend
+except ImportError:
+    import json as json_backend
+
+Route = Tuple[str, Optional[str]]  # kind of update, type of chat
+
+GROUP_CHATS = ('group', 'supergroup')
+CHATS = ('private',) + GROUP_CHATS
+MESSAGE_KINDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+UPDATE_KINDS = MESSAGE_KINDS + (
+    'inline_query', 'chosen_inline_result', 'callback_query', 'shipping_query',
+    'pre_checkout_query', 'poll',
+)
+# features of message that filters may require
+REPLY = 'reply'
+REPLY_TO_BOT = 'reply_to_bot'
+STATE = 'state'
+
+
+def _routes(kinds, chats) -> FrozenSet[Route]:
+    return frozenset((kind, chat) for kind in kinds for chat in chats)
+
+
+MESSAGE_ROUTES = (
+    _routes(('message', 'edited_message'), CHATS)
+    | _routes(('channel_post', 'edited_channel_post'), ('channel',))
+)
+# filters that pass exactly these updates
+UPDATE_FILTERS = {
+    Filters.update: MESSAGE_ROUTES,
+    Filters.update.message: _routes(('message',), CHATS),
+    Filters.update.edited_message: _routes(('edited_message',), CHATS),
+    Filters.update.messages: _routes(('message', 'edited_message'), CHATS),
+    Filters.update.channel_post: _routes(('channel_post',), ('channel',)),
+    Filters.update.edited_channel_post: _routes(('edited_channel_post',), ('channel',)),
+    Filters.update.channel_posts: _routes(('channel_post', 'edited_channel_post'), ('channel',)),
+}
+# filters that pass only some of these updates
+NARROW_FILTERS = {
+    Filters.private: _routes(('message', 'edited_message'), ('private',)),
+    Filters.group: _routes(('message', 'edited_message'), GROUP_CHATS),
+    # service messages of groups, they can't be edited
+    Filters.status_update.new_chat_members: _routes(('message',), GROUP_CHATS),
+    Filters.status_update.left_chat_member: _routes(('message',), GROUP_CHATS),
+}
+HANDLER_UPDATES = {
+    CallbackQueryHandler: 'callback_query',
+    InlineQueryHandler: 'inline_query',
+    ChosenInlineResultHandler: 'chosen_inline_result',
+}
+# processed before dispatcher, see `admins.apply_chat_member_update`
+RAW_UPDATES = ('chat_member', 'my_chat_member')
+
+
+def loads(body):
+    return json_backend.loads(body)
+
+
+def dumps(data) -> bytes:
+    res = json_backend.dumps(data)
+    return res.encode() if isinstance(res, str) else res
+
+
+def filter_routes(f: BaseFilter) -> FrozenSet[Route]:
+    """Message updates that filter can pass (it may pass less, but not more)."""
+    if isinstance(f, MergedFilter):
+        base = filter_routes(f.base_filter)
+        if f.and_filter:
+            return base & filter_routes(f.and_filter)
+        return base | filter_routes(f.or_filter)
+    if isinstance(f, InvertedFilter):
+        if f.f in UPDATE_FILTERS:
+            return MESSAGE_ROUTES - UPDATE_FILTERS[f.f]
+        return MESSAGE_ROUTES
+    return UPDATE_FILTERS.get(f) or NARROW_FILTERS.get(f) or MESSAGE_ROUTES
+
+
+def get_routes(handlers: Iterable[HandlerWrapper]) -> FrozenSet[Route]:
+    """Updates that can be taken by handlers, chat of non-message updates is None."""
+    res = set()
+    for wrapper in handlers:
+        handler = wrapper.handler
+        if isinstance(handler, (CommandHandler, MessageHandler)):
+            res |= filter_routes(handler.filters)
+        else:
+            res.add((HANDLER_UPDATES[type(handler)], None))
+    return frozenset(res)
+
+
+def get_allowed_updates(handlers: Iterable[HandlerWrapper]) -> List[str]:
+    """Kinds of updates that can be processed by handlers, other ones aren't requested."""
+    return sorted({kind for kind, _ in get_routes(handlers)} | set(RAW_UPDATES))
+
+
+def get_update_type(data: dict) -> str:
+    """Kind of update: 'message', 'callback_query', etc."""
+    return next((key for key in data if key != 'update_id'), 'unknown')
+
+
+def peek(data: dict) -> Route:
+    kind = get_update_type(data)
+    value = data.get(kind)
+    chat = value.get('chat') if isinstance(value, dict) else None
+    return kind, chat.get('type') if isinstance(chat, dict) else None
+
+
+class Router:
+    def __init__(self, handlers: Iterable[HandlerWrapper]):
+        self.routes = get_routes(handlers)
+        self.kinds = {kind for kind, _ in self.routes}
+
+    def accepts(self, data: dict) -> bool:
+        """Whether update can be taken by some handler."""
+        kind, chat = peek(data)
+        if kind not in self.kinds:
+            return False
+        # unknown chat type - let handlers decide
+        return chat not in CHATS + ('channel',) or (kind, chat) in self.routes
+
+
+def filter_requirements(f: BaseFilter) -> Dict[str, object]:
+    """Values of message features that filter requires (it may require more)."""
+    if isinstance(f, MergedFilter):
+        base = filter_requirements(f.base_filter)
+        if f.and_filter:
+            return {**base, **filter_requirements(f.and_filter)}
+        other = filter_requirements(f.or_filter)
+        return {k: v for k, v in base.items() if k in other and other[k] == v}
+    if isinstance(f, InvertedFilter):
+        if f.f is Filters.reply:
+            return {REPLY: False}
+        if isinstance(f.f, ReplyToBot):
+            return {REPLY_TO_BOT: False}
+        return {}
+    if f is Filters.reply:
+        return {REPLY: True}
+    if isinstance(f, ReplyToBot):
+        return {REPLY: True, REPLY_TO_BOT: True}
+    if isinstance(f, StateFilter._StateFilter):
+        return {STATE: str(f.state)}
+    return {}
+
+
+def get_kind(update: Update) -> Optional[str]:
+    return next((kind for kind in UPDATE_KINDS if getattr(update, kind, None)), None)
+
+
+def get_command(message: TGMessage) -> Optional[str]:
+    """Command of message the same way `CommandHandler` gets it, without bot's username."""
+    entities = message.entities
+    if message.text and entities and entities[0].type == 'bot_command' and not entities[0].offset:
+        return message.text[1:entities[0].length].split('@')[0].lower()
+
+
+def get_feature(message: TGMessage, name: str):
+    if name == REPLY:
+        return bool(message.reply_to_message)
+    if name == REPLY_TO_BOT:
+        return bool(reply_to_bot.filter(message))
+    # loaded once for all filters and handlers of message
+    session = redis.get_session(message)
+    return session and session.get('state')
+
+
+class _Entry(NamedTuple):
+    handler: Handler
+    commands: Optional[FrozenSet[str]]
+    requires: Dict[str, object]
+
+
+class HandlerIndex:
+    """Candidate handlers of updates in the order they are checked by dispatcher."""
+    def __init__(self, handlers: List[Handler]):
+        self.handlers = handlers
+        self.routes: Dict[Route, List[_Entry]] = {}
+        for handler in handlers:
+            if isinstance(handler, (CommandHandler, MessageHandler)):
+                routes = filter_routes(handler.filters)
+                requires = filter_requirements(handler.filters)
+            else:
+                routes = {(HANDLER_UPDATES[type(handler)], None)}
+                requires = {}
+            commands = frozenset(handler.command) if isinstance(handler, CommandHandler) else None
+            for route in routes:
+                self.routes.setdefault(route, []).append(_Entry(handler, commands, requires))
+
+    def candidates(self, update: Update) -> Iterator[Handler]:
+        kind = get_kind(update)
+        if kind is None:
+            yield from self.handlers
+            return
+        if kind not in MESSAGE_KINDS:
+            yield from (entry.handler for entry in self.routes.get((kind, None), ()))
+            return
+        route = (kind, update.effective_chat.type)
+        if route not in MESSAGE_ROUTES:
+            # unknown chat type - check all handlers
+            yield from self.handlers
+            return
+        message = update.effective_message
+        command = get_command(message)
+        features = {}
+        for entry in self.routes.get(route, ()):
+            if entry.commands is not None and command not in entry.commands:
+                continue
+            for name, value in entry.requires.items():
+                if name not in features:
+                    features[name] = get_feature(message, name)
+                if features[name] != value:
+                    break
+            else:
+                yield entry.handler
@@ -0,0 +1,83 @@
+"""
+Split processing of updates between worker processes.
+
+Updates are spread over `UPDATES_SHARDS` redis streams by chat (jump consistent hash),
+so all updates of a chat go to the same shard. Shards are spread over live workers
+by rendezvous hashing: every worker heartbeats into sorted set `WORKERS_KEY` and computes
+the same assignment from the same list of workers, so when a worker joins or leaves
+only the shards it takes or gives up are moved.
+"""
+import hashlib
+import logging
+import time
+import zlib
+from typing import Dict, Hashable, List
+
+from django.conf import settings
+
+from bot import redis
+
+logger = logging.getLogger(__name__)
+
+WORKERS_KEY = 'workers:alive'
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping, Veach): only 1/n of keys move when n-th bucket is added."""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def shard_of(key: Hashable) -> int:
+    if not isinstance(key, int):
+        key = zlib.crc32(str(key).encode())
+    return jump_hash(key & 0xffffffffffffffff, settings.UPDATES_SHARDS)
+
+
+def _weight(shard: int, worker: str) -> int:
+    return int.from_bytes(hashlib.md5(f'{shard}:{worker}'.encode()).digest()[:8], 'big')
+
+
+def assign(shards: int, workers: List[str]) -> Dict[str, List[int]]:
+    """Map workers to their shards, every shard goes to the worker with the highest weight."""
+    res = {worker: [] for worker in workers}
+    if not workers:
+        return res
+    for shard in range(shards):
+        res[max(workers, key=lambda w: _weight(shard, w))].append(shard)
+    return res
+
+
+def get_workers() -> List[str]:
+    """Names of workers that sent heartbeat recently."""
+    since = time.time() - settings.UPDATES_WORKER_TIMEOUT
+    return sorted(w.decode() for w in redis.rc.zrangebyscore(WORKERS_KEY, since, '+inf'))
+
+
+class Membership:
+    def __init__(self, name: str):
+        self.name = name
+        self.shards: List[int] = []
+
+    def heartbeat(self) -> List[int]:
+        """Tell others that worker is alive, return its shards (assignment could change)."""
+        now = time.time()
+        pipe = redis.rc.pipeline()
+        pipe.zadd(WORKERS_KEY, {self.name: now})
+        pipe.zremrangebyscore(WORKERS_KEY, '-inf', now - settings.UPDATES_WORKER_TIMEOUT)
+        pipe.zrange(WORKERS_KEY, 0, -1)
+        workers = sorted(w.decode() for w in pipe.execute()[2])
+        shards = assign(settings.UPDATES_SHARDS, workers)[self.name]
+        if shards != self.shards:
+            logger.info(f"{self.name} ({len(workers)} workers) takes shards {shards}")
+            self.shards = shards
+        return shards
+
+    def leave(self):
+        """Give shards to other workers right away."""
+        redis.rc.zrem(WORKERS_KEY, self.name)
+        self.shards = []
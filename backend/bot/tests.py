@@ -1,10 +1,21 @@
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from unittest.mock import Mock
+from unittest.mock import ANY, Mock
 
 import pytest
 from django.conf import settings
-from telegram import Bot, Message as TGMessage, CallbackQuery, InlineKeyboardMarkup
-from telegram.ext import CommandHandler, MessageHandler, Filters
+from telegram import (
+    Bot, Message as TGMessage, CallbackQuery, InlineKeyboardMarkup, InputFile, InputMediaPhoto,
+    Chat as TGChat, Update, User as TGUser,
+)
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import (
+    CallbackContext, CallbackQueryHandler, CommandHandler, MessageHandler, Filters,
+)
 
 from bot.channel_publishing import (
     command_create,
@@ -13,6 +24,7 @@ from bot.channel_publishing import (
     handle_create_start,
     handle_create_buttons,
 )
+from bot.context_data import ContextData, bound_context_data
 from bot.channel_reaction import command_start, handle_reaction_response
 from bot.core import handle_button_callback, handle_empty_callback
 from bot.core.commands import (
@@ -29,19 +41,40 @@ from bot.core.edit_command import (
     change_allowed_types,
     command_edit,
 )
-from bot.dispatcher import extract_handlers, inspect_handlers, sort_by_type
+from bot.dispatcher import (
+    IndexedDispatcher,
+    extract_handlers,
+    get_handlers,
+    inspect_handlers,
+    run_keyed,
+    setup_dispatcher,
+    sort_by_type,
+)
+from bot.filters import StateFilter, reply_to_bot
 from bot.group_reaction import handle_reaction_reply, handle_magic_reply
 from bot.group_reposting import handle_message
+from bot.group_reposting import albums
+from bot.group_reposting.message_handlers import can_be_processed, process_album
+from bot.keyed_executor import KeyedExecutor, get_data_key
 from bot.magic_marks import clear_magic_marks, get_magic_marks, process_magic_mark, restore_text
 from bot.markup import (
     gen_buttons, make_credits_keyboard, make_reactions_keyboard, make_reply_markup, merge_keyboards,
-    split_to_columns, flatten_list, fluid_merge_keyboards, EMPTY_CB_DATA
+    split_to_columns, flatten_list, fluid_merge_keyboards, markup_fingerprint, EMPTY_CB_DATA,
+    render_reactions_markup, compile_keyboard_template, make_vote_keyboard
+)
+from bot.management.commands import benchmarkdispatch
+from bot.management.commands.loadtestapi import TOKEN, start_fake_server
+from bot.markup_updater import MarkupUpdater
+from bot.memoize import memoize
+from bot import (
+    admins, api, chat_config, counters, intake, metrics, ratelimit, redis, routing, sharding,
+    update_queue, upserts,
 )
-from bot import redis
 from bot.stats import command_reactions, command_champions
-from bot.utils import clear_buttons
+from bot.utils import clear_buttons, edit_reply_markup
+from bot.views import process_update_view
 from bot.wrapper import HandlerWrapper
-from core.models import Chat, Message, User, MessageToPublish, Button
+from core.models import Chat, Message, User, MessageToPublish, Button, Reaction
 from stats.models import TopPosters, PopularReactions
 
 
@@ -232,6 +265,39 @@ class TestMarkup:
         assert split_to_columns([1, 2, 3, 4], 3) == [[1, 2, 3], [4]]
         assert split_to_columns([1, 2, 3, 4], 2) == [[1, 2], [3, 4]]
 
+    def test_compile_keyboard_template(self):
+        template = compile_keyboard_template(5, 3, False, True, 0)
+        assert template == ((0, 1, 2), (3, 4, 'vote'))
+        template = compile_keyboard_template(4, 3, True, False, 1)
+        assert template[0] == (0, 1, 2)
+        assert template[1][0] == 3
+        assert [b.callback_data for b in template[1][1:]] == [EMPTY_CB_DATA] * 2
+        # telegram limit
+        assert len(compile_keyboard_template(25, 1, False, True, 1)) == 9
+
+    @pytest.mark.parametrize('padding', [False, True])
+    @pytest.mark.parametrize('columns', range(1, 7))
+    def test_render_reactions_markup(self, columns, padding):
+        bot = Mock(username='bot')
+        credits = make_credits_keyboard(**self.user)
+        for vote in (None, make_vote_keyboard(bot, '1')):
+            for credits_keyboard in (None, credits):
+                for n in range(settings.MAX_NUM_BUTTONS + 1):
+                    reactions = [(str(i), i * 137) for i in range(n)]
+                    legacy = merge_keyboards(
+                        credits_keyboard,
+                        fluid_merge_keyboards(
+                            make_reactions_keyboard(reactions, padding, columns),
+                            vote,
+                            max_cols=columns,
+                            padding=padding,
+                        ),
+                    )
+                    markup = render_reactions_markup(
+                        reactions, columns, padding, credits_keyboard, vote
+                    )
+                    assert (markup and markup.to_dict()) == (legacy and legacy.to_dict())
+
 
 @pytest.mark.usefixtures(
     'create_update',
@@ -784,6 +850,119 @@ class TestGroupReposting:
         handle_message(update, context)
         assert Message.objects.count() == 0
 
+    def test_album(self, mocker, settings):
+        settings.ALBUM_WINDOW = 1.5
+        chat = self.create_chat(allowed_types=['album'], repost=True)
+        parts = []
+        mocker.patch.object(albums, 'add_part', side_effect=lambda _, part, __: parts.append(part))
+        for i in range(2):
+            photo = [{'file_id': f'photo{i}', 'width': 1, 'height': 1}]
+            msg = self.create_tg_message(
+                chat=chat.tg, media_group_id='1', photo=photo, caption=f'.~{i}' if i else None
+            )
+            handle_message(self.create_update(message=msg), self.create_context())
+        assert len(parts) == 2
+        assert Message.objects.count() == 0
+
+        album = [self.create_tg_message(chat=chat.tg) for _ in range(2)]
+        mocker.patch.object(Bot, 'send_media_group', return_value=album)
+        mocker.patch.object(Bot, 'send_message', return_value=self.create_tg_message(chat=chat.tg))
+        mocker.patch.object(albums, 'get_saved', return_value=None)
+        mocker.patch.object(albums, 'mark_saved')
+        process_album(self.create_bot(), parts)
+
+        chat_id, media = Bot.send_media_group.call_args[0]
+        assert [m.media for m in media] == ['photo0', 'photo1']
+        assert Bot.send_message.call_args[1]['reply_to_message_id'] == album[0].message_id
+        message = Message.objects.get()
+        assert message.anonymous
+        albums.mark_saved.assert_called_once_with('1', album[0].message_id)
+
+    def make_album_part(self, chat, i):
+        photo = [{'file_id': f'photo{i}', 'width': 1, 'height': 1}]
+        msg = self.create_tg_message(chat=chat.tg, media_group_id='1', photo=photo)
+        return {'message': msg.to_dict(), 'anonymous': False, 'buttons': None, 'repost': False}
+
+    def test_album_of_one_part(self, mocker):
+        chat = self.create_chat(allowed_types=['album'], repost=True)
+        sent = self.create_tg_message(chat=chat.tg)
+        mocker.patch.object(Bot, 'send_photo', return_value=sent)
+        mocker.patch.object(Bot, 'send_media_group')
+        mocker.patch.object(albums, 'get_saved', return_value=None)
+        mocker.patch.object(albums, 'mark_saved')
+        process_album(self.create_bot(), [self.make_album_part(chat, 0)])
+
+        # sendMediaGroup needs at least 2 items, the part is reposted as a single message
+        Bot.send_media_group.assert_not_called()
+        assert Bot.send_photo.call_args[1]['photo'] == 'photo0'
+        assert Bot.send_photo.call_args[1]['reply_markup'] is not None
+        assert Message.objects.get().message_id == str(sent.message_id)
+        albums.mark_saved.assert_called_once_with('1', sent.message_id)
+
+    def test_album_late_part(self, mocker):
+        chat = self.create_chat(allowed_types=['album'], repost=True)
+        mocker.patch.object(Bot, 'send_photo', return_value=self.create_tg_message(chat=chat.tg))
+        mocker.patch.object(Bot, 'send_media_group')
+        mocker.patch.object(albums, 'get_saved', return_value=5)
+        part = self.make_album_part(chat, 2)
+        process_album(self.create_bot(), [part])
+
+        # attached to the repost of album w/o another reactions message
+        Bot.send_media_group.assert_not_called()
+        Bot.send_message.assert_not_called()
+        assert Bot.send_photo.call_args[1]['reply_to_message_id'] == 5
+        assert Bot.send_photo.call_args[1]['reply_markup'] is None
+        assert Message.objects.count() == 0
+        Bot.delete_message.assert_called_once_with(
+            chat_id=chat.tg.id, message_id=part['message']['message_id']
+        )
+
+        # album wasn't reposted, part is already next to it
+        albums.get_saved.return_value = 0
+        process_album(self.create_bot(), [part])
+        assert Bot.send_photo.call_count == 1
+
+    def test_album_wo_window(self, mocker, settings):
+        settings.ALBUM_WINDOW = 0
+        chat = self.create_chat(allowed_types=['album'], repost=True)
+        mocker.patch.object(albums, 'add_part')
+        sent = [self.create_tg_message(chat=chat.tg) for _ in range(2)]
+        mocker.patch.object(Bot, 'send_photo', side_effect=sent)
+        for i in range(2):
+            photo = [{'file_id': f'photo{i}', 'width': 1, 'height': 1}]
+            msg = self.create_tg_message(chat=chat.tg, media_group_id='1', photo=photo)
+            handle_message(self.create_update(message=msg), self.create_context())
+        albums.add_part.assert_not_called()
+        assert Bot.send_photo.call_count == 2
+        assert Message.objects.count() == 2
+
+    def test_can_be_processed(self):
+        chat = {'allowed_types': ('photo',)}
+        assert not can_be_processed(self.create_tg_message(text='text'), chat)
+        assert can_be_processed(self.create_tg_message(text='.+text'), chat)
+        assert can_be_processed(self.create_tg_message(text='++text'), chat)
+        assert not can_be_processed(self.create_tg_message(text='+text'), chat)
+        photo = [{'file_id': '1', 'width': 1, 'height': 1}]
+        assert can_be_processed(self.create_tg_message(photo=photo), chat)
+        # chat doesn't exist yet: default settings
+        assert can_be_processed(self.create_tg_message(text='https://t.me', entities=[
+            {'type': 'url', 'offset': 0, 'length': 12}
+        ]), None)
+
+    def test_discard_chatter(self, mocker, settings, django_assert_num_queries):
+        settings.CHAT_CACHE_SIZE = 10
+        mocker.patch.object(chat_config, 'start_listener')
+        chat = self.create_chat()
+        chat_config._set_local(str(chat.id), chat_config._dump(chat), chat_config._get_generation())
+        msg = self.create_tg_message(chat=chat.tg, text='text')
+        update = self.create_update(message=msg)
+        context = self.create_context()
+
+        with django_assert_num_queries(0):
+            handle_message(update, context)
+        assert redis.rc.method_calls == []
+        chat_config.forget_local()
+
 
 @pytest.mark.django_db
 @pytest.mark.usefixtures(
@@ -1004,6 +1183,69 @@ class TestCoreCallbackQueries:
         cs = message.button_set.values_list('count', flat=True)
         assert list(cs) == [0, 1]
 
+    @pytest.mark.parametrize('fast_ack', [True, False])
+    def test_cb_ack(self, mocker, settings, fast_ack):
+        settings.CALLBACK_FAST_ACK = fast_ack
+        message = self.create_message(buttons=['a', 'b'])
+        update = self.create_update(callback_query='button:a', message=message.tg)
+        context = self.create_context(match=['button:a', 'a'])
+        answer = mocker.patch.object(Bot, 'answer_callback_query')
+        answered_before_toggle = []
+
+        def toggle(**kwargs):
+            answered_before_toggle.append(answer.call_count)
+            return Mock(), Mock(text='a'), [('a', 1)]
+
+        mocker.patch('bot.core.query_callback_handlers.toggle_reaction', side_effect=toggle)
+        mocker.patch('bot.core.query_callback_handlers.markup_updater')
+        mocker.spy(metrics, 'observe')
+
+        handle_button_callback(update, context)
+
+        assert answer.call_count == 1
+        if fast_ack:
+            assert answered_before_toggle == [1]
+            assert answer.call_args == mocker.call(update.callback_query.id)
+            metrics.observe.assert_called_once_with('callback_ack_seconds_fast', mocker.ANY)
+        else:
+            assert answered_before_toggle == [0]
+            assert answer.call_args[0][1] == "You reacted with a."
+            metrics.observe.assert_called_once_with('callback_ack_seconds_full', mocker.ANY)
+
+    def test_cb_ack_rejected(self, mocker, settings):
+        """Reaction with a button on keyboard is rejected only if buttons were added meanwhile."""
+        settings.CALLBACK_FAST_ACK = True
+        settings.MAX_NUM_BUTTONS = 2
+        mocker.spy(metrics, 'inc')
+        message = self.create_message(buttons=['a', 'b'])
+        update = self.create_update(callback_query='button:a', message=message.tg)
+        context = self.create_context(match=['button:a', 'a'])
+        answer = mocker.patch.object(Bot, 'answer_callback_query')
+        mocker.patch(
+            'bot.core.query_callback_handlers.toggle_reaction', return_value=(None, None, None)
+        )
+        updater = mocker.patch('bot.core.query_callback_handlers.markup_updater')
+
+        handle_button_callback(update, context)
+        answer.assert_called_once_with(update.callback_query.id)
+        metrics.inc.assert_any_call('callback_rejected_after_ack')
+        # user sees it in refreshed markup
+        assert updater.schedule.call_count == 1
+
+    def test_cb_ack_before_db(self, mocker, settings):
+        settings.CALLBACK_FAST_ACK = True
+        update = self.create_update(callback_query='button:a')
+        context = self.create_context(match=['button:a', 'a'])
+        calls = Mock()
+        mocker.patch.object(Bot, 'answer_callback_query', calls.answer)
+        queryset = mocker.patch.object(Message.objects, 'prefetch_related').return_value
+        queryset.get_by_ids = calls.get_by_ids
+        calls.get_by_ids.side_effect = Message.DoesNotExist
+
+        handle_button_callback(update, context)
+        assert [c[0] for c in calls.mock_calls] == ['answer', 'get_by_ids']
+        calls.answer.assert_called_once_with(update.callback_query.id)
+
     def test_empty_cb(self, mocker):
         update = self.create_update(callback_query=EMPTY_CB_DATA)
         context = self.create_context()
@@ -1071,3 +1313,1342 @@ class TestDispatch:
         assert handlers[0].handler_class == CommandHandler
         assert handlers[1].handler_class == CommandHandler
         assert handlers[2].handler_class == MessageHandler
+
+    def test_run_keyed(self, create_update):
+        executor = KeyedExecutor(1, name='test')
+        dp = Mock()
+        error = ValueError()
+        release = threading.Event()
+        unfinished = intake.Unfinished()
+
+        def fail(update, context):
+            release.wait(5)
+            raise error
+
+        callback = run_keyed(fail, dp, executor, unfinished)
+        update = create_update()
+        callback(update, None)
+        assert unfinished.lowest() == update.update_id
+        release.set()
+        executor.join()
+        dp.dispatch_error.assert_called_once_with(update, error)
+        assert unfinished.lowest() is None
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestRouting:
+    def test_filter_routes(self):
+        messages = {'message', 'edited_message'}
+        posts = {'channel_post', 'edited_channel_post'}
+
+        def kinds(f):
+            return {kind for kind, _ in routing.filter_routes(f)}
+
+        assert routing.filter_routes(Filters.all) == routing.MESSAGE_ROUTES
+        assert routing.filter_routes(Filters.private & Filters.text) == {
+            ('message', 'private'), ('edited_message', 'private'),
+        }
+        assert routing.filter_routes(~Filters.private) == routing.MESSAGE_ROUTES
+        assert kinds(Filters.update.channel_posts | Filters.update.message) == posts | {'message'}
+        assert kinds(Filters.update & ~Filters.update.edited_message) == posts | {'message'}
+        assert kinds(Filters.private | Filters.group) == messages
+        assert routing.filter_routes(Filters.update.channel_post & Filters.group) == set()
+
+    def test_get_allowed_updates(self):
+        handlers = [
+            HandlerWrapper(Mock(), False, CommandHandler, command='a', filters=Filters.group),
+            HandlerWrapper(Mock(), False, CallbackQueryHandler),
+        ]
+        assert routing.get_allowed_updates(handlers) == [
+            'callback_query', 'chat_member', 'edited_message', 'message', 'my_chat_member',
+        ]
+        # bot doesn't process channel posts
+        assert routing.get_allowed_updates(get_handlers()) == [
+            'callback_query', 'chat_member', 'chosen_inline_result', 'edited_message',
+            'inline_query', 'message', 'my_chat_member',
+        ]
+
+    def test_router(self):
+        router = routing.Router([
+            HandlerWrapper(Mock(), False, CommandHandler, command='a', filters=Filters.private),
+            HandlerWrapper(Mock(), False, CallbackQueryHandler),
+        ])
+        assert router.accepts({'update_id': 1, 'message': {'chat': {'type': 'private'}}})
+        assert not router.accepts({'update_id': 1, 'message': {'chat': {'type': 'group'}}})
+        assert not router.accepts({'update_id': 1, 'poll': {'id': '1'}})
+        assert router.accepts({'update_id': 1, 'callback_query': {'id': '1'}})
+        # handlers decide on updates that router doesn't know
+        assert router.accepts({'update_id': 1, 'message': {'chat': {'type': 'new'}}})
+
+    def test_process_update(self, mocker):
+        de_json = mocker.patch('bot.update_queue.Update.de_json')
+        router = routing.Router([HandlerWrapper(Mock(), False, CallbackQueryHandler)])
+        dispatcher = Mock()
+        update_queue.process_update(dispatcher, {'update_id': 1, 'message': {}}, router)
+        de_json.assert_not_called()
+        data = {'update_id': 2, 'callback_query': {'id': '1'}}
+        update_queue.process_update(dispatcher, data, router)
+        de_json.assert_called_once_with(data, dispatcher.bot)
+        dispatcher.process_update.assert_called_once_with(de_json.return_value)
+
+    def test_filter_requirements(self):
+        assert routing.filter_requirements(
+            Filters.group & Filters.reply & reply_to_bot & Filters.text
+        ) == {routing.REPLY: True, routing.REPLY_TO_BOT: True}
+        assert routing.filter_requirements(Filters.group & ~Filters.reply) == {
+            routing.REPLY: False,
+        }
+        assert routing.filter_requirements(
+            Filters.private & (Filters.text | Filters.sticker) & StateFilter.reaction
+        ) == {routing.STATE: 'reaction'}
+        assert routing.filter_requirements(Filters.reply | Filters.text) == {}
+        assert routing.filter_requirements(~(Filters.reply & Filters.text)) == {}
+
+    @pytest.mark.parametrize('fields', [fields for _, fields in benchmarkdispatch.TRAFFIC])
+    def test_index_picks_the_same_handler(self, fields):
+        redis.rc.hgetall.side_effect = lambda key: (
+            {b'state': b'reaction'} if key == f"state:{benchmarkdispatch.STATE_USER['id']}" else {}
+        )
+        bot = Bot(TOKEN)
+        bot.bot = TGUser(**benchmarkdispatch.BOT_USER)
+        handlers = [wrapper.handler for wrapper in get_handlers()]
+        index = routing.HandlerIndex(handlers)
+
+        def first(candidates, update):
+            matched = (h for h in candidates if h.check_update(update) not in (None, False))
+            return next(matched, None)
+
+        update = Update.de_json({'update_id': 1, **fields}, bot)
+        candidates = list(index.candidates(update))
+        assert first(candidates, update) is first(handlers, update)
+        assert len(candidates) < len(handlers)
+
+    def test_candidates(self):
+        wrappers = [
+            HandlerWrapper(Mock(), False, CommandHandler, command='a'),
+            HandlerWrapper(Mock(), False, CommandHandler, command=['b', 'c']),
+            HandlerWrapper(Mock(), False, MessageHandler, filters=Filters.reply),
+            HandlerWrapper(Mock(), False, MessageHandler, filters=Filters.all),
+        ]
+        a, bc, reply, other = [w.handler for w in wrappers]
+        index = routing.HandlerIndex([a, bc, reply, other])
+        bot = Bot(TOKEN)
+        chat = {'id': 1, 'type': 'private'}
+        command = {'type': 'bot_command', 'offset': 0, 'length': 2}
+
+        def candidates(**fields):
+            message = {'message_id': 1, 'date': 1, 'chat': chat, **fields}
+            return list(index.candidates(Update.de_json({'update_id': 1, 'message': message}, bot)))
+
+        assert candidates(text='/c@bot', entities=[command]) == [bc, other]
+        assert candidates(text='c', reply_to_message={'message_id': 2, 'date': 1, 'chat': chat}) \
+            == [reply, other]
+        assert candidates(text='text') == [other]
+        # unknown chat type
+        chat = {'id': 1, 'type': 'new'}
+        assert candidates(text='text') == [a, bc, reply, other]
+
+    def test_indexed_dispatcher(self, settings):
+        settings.HANDLER_INDEX = True
+        callback = Mock(side_effect=[None, ValueError])
+        dp = IndexedDispatcher(Bot(TOKEN), None, workers=0, use_context=True)
+        dp.add_handler(CallbackQueryHandler(callback))
+        dp.index = routing.HandlerIndex([dp.handlers[0][0]])
+        update = Update.de_json({'update_id': 1, 'callback_query': {
+            'id': '1', 'from': {'id': 1, 'first_name': 'user', 'is_bot': False},
+            'chat_instance': '1', 'data': 'data',
+        }}, dp.bot)
+        dp.process_update(update)
+        assert callback.call_args[0][0] is update
+        # errors don't escape
+        dp.process_update(update)
+        assert callback.call_count == 2
+
+    def test_json_backend(self):
+        data = {'update_id': 1, 'message': {'text': 'привет'}}
+        assert routing.loads(routing.dumps(data)) == data
+        assert routing.get_update_type({'update_id': 1}) == 'unknown'
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures('mock_redis', 'create_user', 'create_message')
+class TestCounters:
+    def test_toggle_reaction_db_backend(self):
+        user = self.create_user()
+        msg = self.create_message(buttons=['a', 'b'])
+        reaction, button, reactions = counters.toggle_reaction(user.tg, **msg.ids, button_text='a')
+        assert reaction is not None and button.count == 1
+        assert reactions == [('a', 1), ('b', 0)]
+        assert redis.rc.method_calls == []
+
+    def test_get_reactions_db_backend(self):
+        msg = self.create_message(buttons=['a', 'b'])
+        assert counters.get_reactions(msg) == [('a', 0), ('b', 0)]
+
+    def test_persist(self):
+        u1, u2, u3 = self.create_user(), self.create_user(), self.create_user()
+        msg = self.create_message(buttons=['a'])
+        Button.objects.create(message=msg, index=1, text='b', count=1)
+        Reaction.objects.react(u3.tg, **msg.ids, button_text='b')
+        assert Button.objects.get(message=msg, text='b').count == 2
+
+        changes = {
+            u1.id: ['a', None, 'user', None],
+            u2.id: ['c', None, 'user', None],
+            u3.id: ['', None, 'user', None],
+            '4242': ['c', 'new', 'new user', None],  # unknown user
+        }
+        counters.persist(msg.id, changes, [('a', 1), ('c', 2)])
+
+        buttons = Button.objects.filter(message=msg).order_by('index')
+        assert list(buttons.values_list('text', 'count')) == [('a', 1), ('c', 2)]
+        reactions = Reaction.objects.filter(message=msg).values_list('user_id', 'button__text')
+        assert sorted(reactions) == sorted([(u1.id, 'a'), (u2.id, 'c'), ('4242', 'c')])
+        assert User.objects.filter(id='4242', username='new').exists()
+
+    def test_persist_recount(self):
+        u1, u2 = self.create_user(), self.create_user()
+        msg = self.create_message(buttons=['a', 'b'])
+        changes = {u1.id: ['a', None, 'u', None], u2.id: ['a', None, 'u', None]}
+        counters.persist(msg.id, changes, None)
+        buttons = Button.objects.filter(message=msg).order_by('index')
+        assert list(buttons.values_list('text', 'count')) == [('a', 2), ('b', 0)]
+
+    def test_persist_recount_new_buttons(self, settings):
+        settings.MAX_NUM_BUTTONS = 3
+        u1, u2, u3 = self.create_user(), self.create_user(), self.create_user()
+        msg = self.create_message(buttons=['a', 'b'])
+        changes = {
+            u1.id: ['c', None, 'u', None],
+            u2.id: ['c', None, 'u', None],
+            u3.id: ['d', None, 'u', None],  # no room for it
+        }
+        counters.persist(msg.id, changes, None)
+        buttons = Button.objects.filter(message=msg).order_by('index')
+        assert list(buttons.values_list('text', 'count')) == [('a', 0), ('b', 0), ('c', 2)]
+
+    def test_toggle_reaction_expired_state(self, mocker, settings):
+        settings.REACTIONS_BACKEND = 'redis'
+        mocker.patch.object(counters, 'toggle_script', side_effect=[None, [1, b'a', b'1']])
+        state = Mock()
+        mocker.patch.object(counters, 'flush_message', state.flush_message)
+        mocker.patch.object(counters, 'load', state.load)
+        user = self.create_user()
+        reaction, button, reactions = counters.toggle_reaction(user.tg, -1, 1, None, 'a')
+        assert reactions == [('a', 1)]
+        # pending changes are persisted before DB snapshot is loaded
+        assert state.mock_calls == [mocker.call.flush_message('-1_1'), mocker.call.load('-1_1')]
+
+    def test_persist_deleted_message(self):
+        user = self.create_user()
+        counters.persist('1_1', {user.id: ['a', None, 'u', None]}, [('a', 1)])
+        assert Reaction.objects.count() == 0
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestMetrics:
+    def test_inc(self, settings):
+        settings.METRICS_FLUSH_INTERVAL = 1000
+        metrics.flush()
+        redis.rc.reset_mock()
+        metrics.inc('a')
+        metrics.inc('a', 2)
+        metrics.inc('b', 0.5)
+        assert redis.rc.pipeline.call_count == 0
+
+        metrics.flush()
+        pipe = redis.rc.pipeline.return_value
+        pipe.hincrby.assert_called_once_with(metrics.METRICS_KEY, 'a', 3)
+        pipe.hincrbyfloat.assert_called_once_with(metrics.METRICS_KEY, 'b', 0.5)
+
+    def test_observe(self, mocker):
+        mocker.patch.object(metrics, 'inc')
+        metrics.observe('latency', 0.03, buckets=(0.01, 0.05, 0.1))
+        names = [c[0][0] for c in metrics.inc.call_args_list]
+        assert names == [
+            'latency:count',
+            'latency:sum',
+            'latency:le=0.05',
+            'latency:le=0.1',
+            'latency:le=inf',
+        ]
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestMarkupUpdater:
+    def test_no_window(self):
+        edit = Mock()
+        MarkupUpdater(window=0).schedule('1', edit, 'counts')
+        edit.assert_called_once_with('counts')
+
+    def test_coalesce(self, mocker):
+        updater = MarkupUpdater(window=1)
+        mocker.patch.object(updater, '_schedule_close')
+        mocker.patch.object(updater, '_acquire').side_effect = [True, False, False]
+        mocker.patch.object(metrics, 'inc')
+        edit = Mock()
+
+        for i in range(3):
+            updater.schedule('1', edit, i)
+
+        edit.assert_called_once_with(0)
+        assert updater._schedule_close.call_count == 1
+        metrics.inc.assert_any_call('markup_edits_coalesced')
+
+    def test_close_window(self, mocker):
+        updater = MarkupUpdater(window=1)
+        mocker.patch.object(updater, '_schedule_close')
+        mocker.patch.object(updater, '_release').side_effect = [True, False]
+        edit = Mock()
+
+        # message is dirty: send the latest markup and open next window
+        updater._close_window('1', edit)
+        edit.assert_called_once_with()
+        assert updater._schedule_close.call_count == 1
+
+        # nothing changed since last edit
+        updater._close_window('1', edit)
+        assert edit.call_count == 1
+        assert updater._schedule_close.call_count == 1
+
+
+@pytest.mark.usefixtures('mock_redis', 'mock_bot', 'create_bot')
+class TestEditReplyMarkup:
+    def test_markup_fingerprint(self):
+        assert markup_fingerprint(make_reactions_keyboard(['a', 'b'])) == markup_fingerprint(
+            make_reactions_keyboard(['a', 'b'])
+        )
+        assert markup_fingerprint(make_reactions_keyboard(['a', 'b'])) != markup_fingerprint(
+            make_reactions_keyboard([('a', 1), 'b'])
+        )
+        assert markup_fingerprint(None) != markup_fingerprint(make_reactions_keyboard([]))
+
+    def test_edit_reply_markup(self, mocker):
+        bot = self.create_bot()
+        mocker.spy(Bot, 'edit_message_reply_markup')
+        markup = make_reactions_keyboard(['a', 'b'])
+        fingerprint = markup_fingerprint(markup)
+        mocker.patch.object(redis, 'claim_markup_fingerprint').return_value = True
+        mocker.patch.object(redis, 'confirm_markup_fingerprint')
+
+        assert edit_reply_markup(bot, '1_2', markup, chat_id='1', message_id='2')
+        assert Bot.edit_message_reply_markup.call_count == 1
+        redis.claim_markup_fingerprint.assert_called_once_with('1_2', fingerprint)
+        redis.confirm_markup_fingerprint.assert_called_once_with('1_2', fingerprint, True)
+
+        # same markup is already displayed
+        redis.claim_markup_fingerprint.return_value = False
+        assert not edit_reply_markup(bot, '1_2', markup, chat_id='1', message_id='2')
+        assert Bot.edit_message_reply_markup.call_count == 1
+
+        # failed edit
+        redis.claim_markup_fingerprint.return_value = True
+        Bot.edit_message_reply_markup.side_effect = BadRequest('Message to edit not found')
+        with pytest.raises(BadRequest):
+            edit_reply_markup(bot, '1_2', markup, chat_id='1', message_id='2')
+        redis.confirm_markup_fingerprint.assert_called_with('1_2', fingerprint, False)
+
+    def test_markup_fingerprint_scripts(self, real_redis):
+        key = 'markup:sent:1_2'
+        assert redis.claim_markup_fingerprint('1_2', 'a')
+        assert 0 < real_redis.ttl(key) <= redis.MARKUP_FINGERPRINT_EXPIRY
+        # the same markup is being sent
+        assert not redis.claim_markup_fingerprint('1_2', 'a')
+        redis.confirm_markup_fingerprint('1_2', 'a', True)
+        assert real_redis.get(key) == b'a'
+        assert not redis.claim_markup_fingerprint('1_2', 'a')
+
+        # not sent: the next edit isn't skipped
+        assert redis.claim_markup_fingerprint('1_2', 'b')
+        redis.confirm_markup_fingerprint('1_2', 'b', False)
+        assert real_redis.get(key) is None
+
+        # concurrent edit claimed while ours was sent: displayed markup is unknown
+        assert redis.claim_markup_fingerprint('1_2', 'a')
+        assert redis.claim_markup_fingerprint('1_2', 'b')
+        redis.confirm_markup_fingerprint('1_2', 'a', True)
+        assert real_redis.get(key) is None
+
+        # failed edit doesn't drop fingerprint of concurrent one
+        assert redis.claim_markup_fingerprint('1_2', 'a')
+        assert redis.claim_markup_fingerprint('1_2', 'b')
+        redis.confirm_markup_fingerprint('1_2', 'a', False)
+        assert real_redis.get(key) == b'b'
+
+
+@pytest.mark.usefixtures('mock_redis', 'create_user', 'create_chat')
+class TestUpserts:
+    def test_fingerprint_cache(self):
+        cache = upserts.FingerprintCache('test', maxsize=2, use_redis=True)
+        redis.rc.get.return_value = None
+        assert not cache.check('1', 'a')
+        cache.store('1', 'a')
+        redis.rc.set.assert_called_once()
+        assert cache.check('1', 'a')
+        assert not cache.check('1', 'b')
+
+        # least recently used fingerprint is evicted, but redis still knows it
+        cache.store('2', 'a')
+        cache.store('3', 'a')
+        assert '1' not in cache._data
+        redis.rc.get.return_value = b'a'
+        assert cache.check('1', 'a')
+
+    @pytest.mark.django_db
+    def test_get_user_and_chat(self, mocker):
+        user = self.create_user()
+        chat = self.create_chat()
+        for cache in (upserts.user_cache, upserts.chat_cache):
+            mocker.patch.object(cache, '_maxsize', 10)
+            mocker.patch.object(cache, '_use_redis', False)
+        mocker.spy(User.objects, 'from_tg_user')
+        mocker.spy(Chat.objects, 'from_tg_chat')
+
+        assert upserts.get_user(user.tg) == user
+        assert upserts.get_user(user.tg) == user
+        assert upserts.get_chat(chat.tg) == chat
+        assert upserts.get_chat(chat.tg) == chat
+        assert User.objects.from_tg_user.call_count == 1
+        assert Chat.objects.from_tg_chat.call_count == 1
+
+        tg_user = user.tg
+        tg_user.username = 'renamed'
+        assert upserts.get_user(tg_user).username == 'renamed'
+        assert User.objects.get(id=user.id).username == 'renamed'
+        assert User.objects.from_tg_user.call_count == 2
+
+        upserts.user_cache.clear()
+        upserts.chat_cache.clear()
+
+
+@pytest.mark.usefixtures('mock_redis', 'create_chat')
+class TestChatConfig:
+    @pytest.fixture(autouse=True)
+    def local_cache(self, settings, mocker):
+        settings.CHAT_CACHE_SIZE = 10
+        mocker.patch.object(chat_config, 'start_listener')
+        yield
+        chat_config.forget_local()
+
+    def test_get_chat_from_redis(self):
+        values = dict(id='1', title='chat', type='group', buttons=['a'], columns=2)
+        data = [values.get(name) for name in chat_config._field_names]
+        redis.rc.get.return_value = json.dumps(data).encode()
+
+        chat = chat_config.get_chat(1)
+        assert chat.id == '1' and chat.buttons == ['a'] and chat.columns == 2
+        chat.buttons.append('b')  # doesn't affect cached values
+        assert chat_config.get_chat('1').buttons == ['a']
+        assert redis.rc.get.call_count == 1
+
+        chat_config.forget_local('1')
+        chat_config.get_chat('1')
+        assert redis.rc.get.call_count == 2
+
+    def test_invalidate(self):
+        chat_config._set_local('1', '["1"]', chat_config._get_generation())
+        chat_config.invalidate('1')
+        assert chat_config._get_local('1') is None
+        pipe = redis.rc.pipeline.return_value
+        pipe.delete.assert_called_once_with('chat:config:1')
+        pipe.publish.assert_called_once_with(chat_config.CHANNEL, '1')
+
+    def test_invalidated_while_loading(self):
+        def get(key):
+            # concurrent save publishes invalidation after value was read
+            chat_config.forget_local('1')
+            return b'["1"]'
+
+        redis.rc.get.side_effect = get
+        assert chat_config.get_settings('1')['id'] == '1'
+        assert chat_config._get_local('1') is None
+        redis.rc.get.side_effect = None
+        redis.rc.get.return_value = b'["1"]'
+        chat_config.get_settings('1')
+        assert chat_config._get_local('1') is not None
+
+    def test_listener_stop(self, mocker):
+        mocker.spy(chat_config, 'forget_local')
+        pubsub = redis.rc.pubsub.return_value
+        messages = iter([None, {'data': b'1'}])
+        pubsub.get_message.side_effect = lambda timeout: next(messages, None)
+        listener = chat_config.Listener()
+        listener.start()
+        while pubsub.get_message.call_count < 3:
+            pass
+        assert chat_config.forget_local.call_args_list == [mocker.call(), mocker.call('1')]
+        listener.stop()
+        assert not listener.is_alive()
+        pubsub.close.assert_called_once()
+
+    @pytest.mark.django_db
+    def test_invalidate_on_save(self, mocker):
+        mocker.patch('django.db.transaction.on_commit', side_effect=lambda f: f())
+        redis.rc.get.return_value = None
+        chat = self.create_chat(columns=3)
+        assert chat_config.get_chat(chat.id).columns == 3
+
+        chat.columns = 5
+        chat.save()
+        pipe = redis.rc.pipeline.return_value
+        pipe.publish.assert_called_with(chat_config.CHANNEL, str(chat.id))
+        assert chat_config.get_chat(chat.id).columns == 5
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestMemoize:
+    def test_hits_and_evictions(self):
+        func = Mock(side_effect=lambda x: x * 2)
+        cached = memoize(ttl=60, maxsize=2, name='test')(func)
+        assert cached(1) == 2
+        assert cached(1) == 2
+        assert func.call_count == 1
+
+        cached(2)
+        cached(3)  # evicts 1
+        assert len(cached.cache) == 2
+        cached(1)
+        assert func.call_count == 4
+        assert cached.cache.stats == {'hits': 1, 'misses': 4, 'evictions': 2}
+
+    def test_stats_under_load(self):
+        cached = memoize(ttl=60, maxsize=10, name='test')(lambda x: x)
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(cached, [i % 20 for i in range(20000)]))
+        stats = cached.cache.stats
+        assert stats['hits'] + stats['misses'] == 20000
+        assert 0 < stats['evictions'] <= stats['misses']
+
+    def test_expired(self):
+        func = Mock(return_value=1)
+        cached = memoize(ttl=0, name='test')(func)
+        cached('a')
+        cached('a')
+        assert func.call_count == 2
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def load(key):
+            started.set()
+            release.wait(5)
+            return key
+
+        func = Mock(side_effect=load)
+        cached = memoize(ttl=60, name='test')(func)
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            futures = [executor.submit(cached, 'a') for _ in range(5)]
+            started.wait(5)
+            release.set()
+            assert [f.result() for f in futures] == ['a'] * 5
+        assert func.call_count == 1
+
+    def test_error_is_not_cached(self):
+        func = Mock(side_effect=[ValueError, 1])
+        cached = memoize(ttl=60, name='test')(func)
+        with pytest.raises(ValueError):
+            cached()
+        assert cached() == 1
+
+    def test_stale_while_revalidate(self):
+        refreshed = threading.Event()
+
+        def load():
+            if func.call_count > 1:
+                refreshed.set()
+            return func.call_count
+
+        func = Mock(side_effect=load)
+        cached = memoize(ttl=0, stale_ttl=60, name='test')(func)
+        assert cached() == 1
+        # expired value is served while it's being refreshed
+        assert cached() == 1
+        assert refreshed.wait(5)
+        assert cached.cache.stats['stale_hits'] >= 1
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestAdmins:
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        admins.get_admin_ids.cache.clear()
+        admins.get_bot_status.cache.clear()
+        yield
+        admins.get_admin_ids.cache.clear()
+        admins.get_bot_status.cache.clear()
+
+    def make_bot(self, *ids):
+        bot = Mock()
+        bot.get_chat_administrators.return_value = [Mock(user=Mock(id=i)) for i in ids]
+        return bot
+
+    def test_get_admin_ids_from_redis(self):
+        bot = self.make_bot()
+        redis.rc.smembers.return_value = {b'-', b'1', b'2'}
+        assert admins.get_admin_ids(bot, 10) == {1, 2}
+        assert admins.get_admin_ids(bot, 10) == {1, 2}
+        assert redis.rc.smembers.call_count == 1
+        bot.get_chat_administrators.assert_not_called()
+
+    def test_get_admin_ids_fetch(self):
+        bot = self.make_bot(1, 2)
+        redis.rc.smembers.return_value = set()
+        assert admins.get_admin_ids(bot, 10) == {1, 2}
+        pipe = redis.rc.pipeline.return_value
+        pipe.sadd.assert_called_once_with('admins:10', admins.PLACEHOLDER, 1, 2)
+
+    def test_refresh_on_miss(self):
+        bot = self.make_bot(1, 3)
+        redis.rc.smembers.return_value = {b'-', b'1'}
+        redis.rc.set.return_value = True
+        assert admins.is_chat_admin(bot, 3, 10)
+        assert bot.get_chat_administrators.call_count == 1
+
+        # cooldown
+        redis.rc.set.return_value = None
+        assert not admins.is_chat_admin(bot, 4, 10)
+        assert bot.get_chat_administrators.call_count == 1
+
+    def test_verify_demoted(self, mocker):
+        mocker.patch.object(admins, 'set_admin')
+        bot = self.make_bot()
+        bot.get_chat_member.return_value = Mock(status='member')
+        redis.rc.smembers.return_value = {b'-', b'1'}
+        assert admins.is_chat_admin(bot, 1, 10)
+        bot.get_chat_member.assert_not_called()
+        assert not admins.is_chat_admin(bot, 1, 10, verify=True)
+        bot.get_chat_member.assert_called_once_with(10, 1)
+        admins.set_admin.assert_called_once_with(10, 1, False)
+
+        bot.get_chat_member.return_value = Mock(status='administrator')
+        assert admins.is_chat_admin(bot, 1, 10, verify=True)
+
+    def test_apply_chat_member_update(self, mocker):
+        mocker.patch.object(admins, 'set_admin')
+        assert not admins.apply_chat_member_update({'update_id': 1, 'message': {}})
+        data = {
+            'update_id': 1,
+            'chat_member': {
+                'chat': {'id': 10},
+                'new_chat_member': {'user': {'id': 3}, 'status': 'administrator'},
+            },
+        }
+        assert admins.apply_chat_member_update(data)
+        admins.set_admin.assert_called_once_with(10, 3, True)
+        data['chat_member']['old_chat_member'] = {'user': {'id': 3}, 'status': 'administrator'}
+        data['chat_member']['new_chat_member']['status'] = 'member'
+        admins.apply_chat_member_update(data)
+        admins.set_admin.assert_called_with(10, 3, False)
+        # neither old nor new status is admin
+        data['chat_member']['old_chat_member']['status'] = 'left'
+        assert admins.apply_chat_member_update(data)
+        assert admins.set_admin.call_count == 2
+
+    def test_bot_status(self, mocker):
+        bot = self.make_bot(1, 2)
+        bot.id = 2
+        redis.rc.get.return_value = None
+        assert admins.get_bot_status(bot, 10)
+        pipe = redis.rc.pipeline.return_value
+        pipe.set.assert_called_once_with('admins:bot:10', 1, ex=settings.ADMIN_CACHE_EXPIRY)
+        # chats where bot isn't admin don't refresh admin list
+        redis.rc.get.return_value = b'0'
+        assert not admins.get_bot_status(bot, 11)
+        assert not admins.get_bot_status(bot, 11)
+        assert bot.get_chat_administrators.call_count == 1
+        assert redis.rc.get.call_count == 2
+
+        mocker.patch.object(admins, 'set_admin')
+        admins.apply_chat_member_update({'update_id': 1, 'my_chat_member': {
+            'chat': {'id': 11},
+            'old_chat_member': {'user': {'id': 2}, 'status': 'member'},
+            'new_chat_member': {'user': {'id': 2}, 'status': 'administrator'},
+        }})
+        redis.rc.set.assert_called_once_with('admins:bot:11', 1, ex=settings.ADMIN_CACHE_EXPIRY)
+        admins.set_admin.assert_called_once_with(11, 2, True)
+        redis.rc.get.return_value = b'1'
+        assert admins.get_bot_status(bot, 11)
+
+    def test_set_admin(self):
+        bot = self.make_bot()
+        redis.rc.smembers.return_value = {b'-', b'1'}
+        admins.get_admin_ids(bot, 10)
+        admins.get_admin_ids(bot, 11)
+        admins.set_admin(10, 2, True)
+        # only the chat's local entry is dropped
+        redis.rc.smembers.return_value = {b'-', b'1', b'2'}
+        assert admins.get_admin_ids(bot, 10) == {1, 2}
+        assert admins.get_admin_ids(bot, 11) == {1}
+
+
+@pytest.mark.usefixtures('mock_redis', 'create_update', 'create_tg_message')
+class TestStateSession:
+    def test_filters_share_session(self):
+        from bot.filters import StateFilter
+        redis.rc.hgetall.return_value = {b'state': b'create_buttons', b'message_id': b'1'}
+        msg = self.create_tg_message(text='text')
+        assert not StateFilter.reaction.filter(msg)
+        assert not StateFilter.create_start.filter(msg)
+        assert StateFilter.create_buttons.filter(msg)
+        assert redis.rc.hgetall.call_count == 1
+
+    def test_state_session(self):
+        redis.rc.hgetall.return_value = {b'state': b'reaction', b'message_id': b'1'}
+        update = self.create_update()
+        user = update.effective_user
+        with redis.state_session(update):
+            assert redis.check_state(user, redis.State.reaction)
+            assert redis.get_key(user.id, 'message_id') == '1'
+            redis.set_state(user.id, redis.State.create_start)
+            redis.set_key(user.id, 'buttons', ['a'])
+            assert redis.get_json(user.id, 'buttons') == ['a']
+            assert redis.check_state(user.id, redis.State.create_start)
+            assert redis.rc.pipeline.call_count == 0
+
+        assert redis.rc.hgetall.call_count == 1
+        assert redis.rc.hget.call_count == 0
+        pipe = redis.rc.pipeline.return_value
+        pipe.hmset.assert_called_once_with(
+            f'state:{user.id}', {'state': 'create_start', 'buttons': '["a"]'}
+        )
+        pipe.expire.assert_called_once_with(f'state:{user.id}', redis.STATE_EXPIRY)
+        assert pipe.execute.call_count == 1
+
+    def test_no_session(self):
+        redis.set_state(1, redis.State.reaction)
+        pipe = redis.rc.pipeline.return_value
+        pipe.hset.assert_called_once_with('state:1', 'state', 'reaction')
+        assert pipe.execute.call_count == 1
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestAlbums:
+    def test_add_part(self, settings, mocker):
+        settings.ALBUM_WINDOW = 1.5
+        timer = mocker.patch('threading.Timer')
+        mocker.patch.object(albums, 'add_script', side_effect=[1, 0])
+        mocker.patch.object(albums, 'complete_overdue')
+        on_complete = Mock()
+        assert albums.add_part('1', {'message': {'message_id': 1}}, on_complete)
+        timer.assert_called_once_with(1.5, albums._complete_in_timer, args=('1', on_complete))
+        assert not albums.add_part('1', {'message': {'message_id': 2}}, on_complete)
+        assert timer.call_count == 1
+        assert albums.complete_overdue.call_count == 2
+
+    def test_complete(self, mocker):
+        parts = [{'message': {'message_id': i}} for i in (2, 1)]
+        mocker.patch.object(albums, 'take_script', side_effect=[
+            [json.dumps(p).encode() for p in parts],
+            [],  # taken by another process
+        ])
+        on_complete = Mock()
+        albums.complete('1', on_complete)
+        on_complete.assert_called_once_with(sorted(parts, key=lambda p: p['message']['message_id']))
+        albums.complete('1', on_complete)
+        assert on_complete.call_count == 1
+
+    def test_scripts(self, settings, mocker, real_redis):
+        settings.ALBUM_WINDOW = 1.5
+        mocker.patch('threading.Timer')
+        on_complete = Mock()
+        assert albums.add_part('1', {'message': {'message_id': 2}}, on_complete)
+        assert not albums.add_part('1', {'message': {'message_id': 1}}, on_complete)
+        assert real_redis.zscore(albums.DUE_KEY, '1')
+        assert albums.take_parts('1') == [{'message': {'message_id': i}} for i in (1, 2)]
+        # taken by another process
+        assert albums.take_parts('1') == []
+        assert real_redis.zscore(albums.DUE_KEY, '1') is None
+        assert albums.get_saved('1') is None
+        albums.mark_saved('1', 5)
+        # late part claims album again
+        assert albums.add_part('1', {'message': {'message_id': 3}}, on_complete)
+        assert albums.take_parts('1') == [{'message': {'message_id': 3}}]
+        assert albums.get_saved('1') == 5
+        on_complete.assert_not_called()
+
+    def test_complete_overdue(self, settings, mocker):
+        settings.ALBUM_WINDOW = 1.5
+        mocker.patch.object(albums, 'complete')
+        redis.rc.zrangebyscore.return_value = [b'1', b'2']
+        on_complete = Mock()
+        albums.complete_overdue(on_complete)
+        assert albums.complete.call_args_list == [
+            mocker.call('1', on_complete), mocker.call('2', on_complete),
+        ]
+
+
+@pytest.fixture(scope='class')
+def api_bot():
+    port = start_fake_server(0.01, errors={'deleteMessage': 'message to delete not found'})
+    request = api.AsyncRequest(max_clients=10)
+    yield Bot(TOKEN, base_url=f'http://127.0.0.1:{port}/bot', request=request)
+    request.stop()
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestAsyncRequest:
+    def test_blocking_call(self, api_bot):
+        assert api_bot.answer_callback_query('1', 'text') is True
+        with pytest.raises(BadRequest, match='message to delete not found'):
+            api_bot.delete_message(1, 1)
+
+    def test_deferred_call(self, api_bot, mocker):
+        mocker.spy(metrics, 'inc')
+        with api.deferred():
+            assert api_bot.delete_message(1, 1) is True
+            assert api.is_deferred()
+        assert not api.is_deferred()
+        assert api.defer(api_bot.answer_callback_query, '1') is True
+        assert api_bot.request.join(5)
+        metrics.inc.assert_any_call('api_deferred_errors')
+        assert metrics.inc.call_args_list.count(mocker.call('api_deferred_calls')) == 2
+
+    def test_json_body(self):
+        media = [InputMediaPhoto('file_id', caption='caption')]
+        body = json.loads(api.make_json_body({'chat_id': 1, 'media': media}))
+        assert body == {'chat_id': 1, 'media': [{
+            'type': 'photo', 'media': 'file_id', 'caption': 'caption',
+        }]}
+        assert api.make_json_body({'photo': InputFile(io.BytesIO(b'1'), filename='1.jpg')}) is None
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestRateLimit:
+    def test_classify(self):
+        assert ratelimit.classify('answerCallbackQuery') == (ratelimit.LANE_ANSWER, False)
+        assert ratelimit.classify('sendPhoto') == (ratelimit.LANE_SEND, True)
+        assert ratelimit.classify('editMessageReplyMarkup') == (ratelimit.LANE_EDIT, True)
+        assert ratelimit.classify('getUpdates') == (None, False)
+
+    def test_lanes(self):
+        scheduler = ratelimit.Scheduler(global_rate=4, group_rate=1, private_rate=1)
+        for _ in range(4):
+            scheduler.acquire(ratelimit.LANE_SEND)
+        order = []
+
+        def call(lane):
+            scheduler.acquire(lane)
+            order.append(lane)
+
+        threads = [
+            threading.Thread(target=call, args=(lane,))
+            for lane in (ratelimit.LANE_EDIT, ratelimit.LANE_SEND, ratelimit.LANE_ANSWER)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert order == [ratelimit.LANE_ANSWER, ratelimit.LANE_SEND, ratelimit.LANE_EDIT]
+
+    def test_chat_limit(self):
+        scheduler = ratelimit.Scheduler(global_rate=100, group_rate=2, private_rate=1)
+        for _ in range(ratelimit.GROUP_BURST):
+            assert scheduler.acquire(ratelimit.LANE_SEND, -1) < 0.01
+        blocked = threading.Thread(target=scheduler.acquire, args=(ratelimit.LANE_SEND, -1))
+        blocked.start()
+        # other chats aren't held back
+        assert scheduler.acquire(ratelimit.LANE_EDIT, -2) < 0.01
+        assert scheduler.acquire(ratelimit.LANE_SEND, -1, limit_chat=False) < 0.01
+        blocked.join()
+        assert scheduler.acquire(ratelimit.LANE_SEND, -1) > 0.3
+
+    def test_retry_after(self):
+        request = Mock()
+        request.post.side_effect = [RetryAfter(0.1), True]
+        scheduler = ratelimit.Scheduler(global_rate=100, group_rate=60, private_rate=1)
+        limited = ratelimit.RateLimitedRequest(request, scheduler, retries=1)
+        data = {'chat_id': -1, 'text': 'text'}
+        assert limited.post('https://api/bot1/sendMessage', data) is True
+        assert request.post.call_count == 2
+        request.post.assert_called_with('https://api/bot1/sendMessage', data, None)
+        assert scheduler.chats[-1].blocked_until > 0
+
+        request.post.side_effect = RetryAfter(0.01)
+        with pytest.raises(RetryAfter):
+            limited.post('https://api/bot1/sendMessage', data)
+        # not limited methods aren't retried
+        request.post.reset_mock()
+        with pytest.raises(RetryAfter):
+            limited.post('https://api/bot1/getUpdates', {})
+        assert request.post.call_count == 1
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestUpdateQueue:
+    def test_parse(self):
+        assert update_queue.parse(b'{"update_id": 1, "message": {}}') == {
+            'update_id': 1, 'message': {},
+        }
+        assert update_queue.parse(b'{"message": {}}') is None
+        assert update_queue.parse(b'[1]') is None
+        assert update_queue.parse(b'not json') is None
+
+    def test_webhook(self, rf, settings):
+        settings.WEBHOOK_QUEUE = True
+        body = b'{"update_id": 1}'
+        response = process_update_view(rf.post('/', body, content_type='application/json'))
+        assert response.status_code == 200
+        redis.rc.xadd.assert_called_once_with(
+            update_queue.stream_key(sharding.shard_of(1)), {'update': body},
+            maxlen=settings.UPDATES_STREAM_MAXLEN,
+        )
+        response = process_update_view(rf.post('/', b'{}', content_type='application/json'))
+        assert response.status_code == 400
+        assert redis.rc.xadd.call_count == 1
+
+    def test_poll(self, mocker, settings):
+        settings.UPDATES_CLAIM_IDLE = 60
+        settings.UPDATES_MAX_DELIVERIES = 3
+        settings.UPDATES_SHARDS = 1
+        redis.rc.pipeline.return_value.execute.return_value = [1, 0, [b'test']]
+        stream = update_queue.stream_key(0)
+        process = mocker.patch('bot.update_queue.process_update')
+        redis.rc.xpending_range.return_value = [
+            {'message_id': b'1-0', 'time_since_delivered': 1000, 'times_delivered': 1},
+            {'message_id': b'2-0', 'time_since_delivered': 70000, 'times_delivered': 3},
+            {'message_id': b'3-0', 'time_since_delivered': 70000, 'times_delivered': 1},
+        ]
+        redis.rc.xclaim.return_value = [(b'3-0', {b'update': b'{"update_id": 3}'})]
+        redis.rc.xreadgroup.return_value = [
+            [stream.encode(), [(b'4-0', {b'update': b'{"update_id": 4}'})]],
+        ]
+        dispatcher = Mock()
+        worker = update_queue.Worker(dispatcher, threads=2, name='test')
+        worker.poll()
+        worker.shutdown()
+
+        redis.rc.xgroup_create.assert_called_once_with(
+            stream, update_queue.GROUP, id='0', mkstream=True
+        )
+        redis.rc.xclaim.assert_called_once_with(
+            stream, update_queue.GROUP, 'test', 60000, [b'3-0']
+        )
+        # the rest of capacity is left for new updates
+        redis.rc.xreadgroup.assert_called_once_with(
+            update_queue.GROUP, 'test', {stream: '>'}, count=3, block=1000
+        )
+        assert process.call_args_list == [
+            mocker.call(dispatcher, {'update_id': 3}, None),
+            mocker.call(dispatcher, {'update_id': 4}, None),
+        ]
+        acked = {c[0][2] for c in redis.rc.xack.call_args_list}
+        assert acked == {b'2-0', b'3-0', b'4-0'}  # 2-0 was dropped
+        redis.rc.zrem.assert_called_once_with(sharding.WORKERS_KEY, 'test')
+
+    def test_worker_without_shards(self, settings):
+        settings.UPDATES_SHARDS = 1
+        # the only shard is assigned to the other worker
+        other = next(w for w in ('a', 'b', 'c') if sharding.assign(1, ['test', w])[w])
+        redis.rc.pipeline.return_value.execute.return_value = [1, 0, [b'test', other.encode()]]
+        worker = update_queue.Worker(Mock(), threads=1, name='test')
+        worker.poll(block_ms=0)
+        assert worker.streams == []
+        redis.rc.xreadgroup.assert_not_called()
+        worker.shutdown()
+
+    def test_heartbeat_while_busy(self, mocker, settings):
+        settings.UPDATES_WORKER_TIMEOUT = 0.03
+        redis.rc.pipeline.return_value.execute.return_value = [1, 0, [b'test']]
+        heartbeat = mocker.spy(sharding.Membership, 'heartbeat')
+        worker = update_queue.Worker(Mock(), threads=1, name='test')
+        worker.start_heartbeat()
+        # all threads are busy, poll would wait for them
+        slots = worker._take_slots()
+        time.sleep(0.1)
+        assert heartbeat.call_count > 2
+        worker._release_slots(slots)
+        worker.shutdown()
+        calls = heartbeat.call_count
+        time.sleep(0.05)
+        assert heartbeat.call_count == calls
+
+    def test_update_type(self, mocker):
+        mocker.spy(metrics, 'inc')
+        mocker.patch('bot.update_queue.Update')
+        update_queue.process_update(Mock(), {'update_id': 1, 'edited_message': {}})
+        metrics.inc.assert_any_call('update_type:edited_message')
+
+    def test_push_many(self, settings):
+        settings.UPDATES_SHARDS = 4
+        pipe = redis.rc.pipeline.return_value
+        update_queue.push_many([
+            {'update_id': 1, 'message': {'chat': {'id': -100}}},
+            {'update_id': 2, 'message': {'chat': {'id': -100}}},
+        ])
+        streams = {c[0][0] for c in pipe.xadd.call_args_list}
+        # updates of a chat go to the same shard
+        assert streams == {update_queue.stream_key(sharding.shard_of(-100))}
+        pipe.execute.assert_called_once_with()
+
+    def test_failed_update_stays_pending(self, mocker):
+        mocker.patch('bot.update_queue.process_update', side_effect=ValueError)
+        worker = update_queue.Worker(Mock(), threads=1, name='test')
+        slots = worker._take_slots()
+        assert slots == worker.capacity
+        worker._release_slots(slots - 1)
+        worker.submit('updates:0', [(b'1-0', {b'update': b'{"update_id": 1}'})])
+        worker.shutdown()
+        redis.rc.xack.assert_not_called()
+        # slot was freed
+        assert worker._take_slots() == worker.capacity
+
+    def test_backpressure(self, mocker):
+        release = threading.Event()
+        processed = []
+
+        def process(dispatcher, data, router):
+            release.wait(5)
+            processed.append(data['update_id'])
+
+        mocker.patch('bot.update_queue.process_update', side_effect=process)
+        mocker.spy(metrics, 'inc')
+        worker = update_queue.Worker(Mock(), threads=1, name='test')
+        worker._executor.max_queue = 1
+        entries = [
+            (f'{i}-0'.encode(), {b'update': json.dumps({
+                'update_id': i, 'message': {'chat': {'id': -1}},
+            }).encode()})
+            for i in range(1, 4)
+        ]
+        worker._take_slots()
+        threading.Timer(0.1, release.set).start()
+        # waits for the chat's queue instead of leaving updates pending
+        worker.submit('updates:0', entries)
+        worker.shutdown()
+        assert processed == [1, 2, 3]
+        assert mocker.call('queued_updates_backpressure') in metrics.inc.call_args_list
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestIntake:
+    def test_next_params(self, settings):
+        settings.TG_POLL_TIMEOUT = 10
+        # more updates are waiting
+        assert intake.next_params(100, 100, backlog=0) == (100, 0)
+        assert intake.next_params(5, 100, backlog=0) == (100, 10)
+        # handlers are busy
+        assert intake.next_params(5, 100, backlog=60) == (40, 10)
+        assert intake.next_params(10, 10, backlog=500) == (intake.MIN_LIMIT, 0)
+
+    def test_get_date(self):
+        assert intake.get_date({'update_id': 1, 'message': {'date': 5}}) == 5
+        assert intake.get_date({'update_id': 1, 'edited_message': {'date': 5, 'edit_date': 7}}) == 7
+        assert intake.get_date({'update_id': 1, 'callback_query': {'id': '1'}}) is None
+
+    def test_restore(self):
+        pending = [json.dumps({'update_id': i}).encode() for i in (4, 5)]
+        pipe = redis.rc.pipeline.return_value
+        pipe.execute.return_value = [b'5', pending]
+        polling = intake.PollingIntake(Mock(), Mock())
+        # 4 was handled before restart
+        assert polling.restore() == (6, [{'update_id': 5}], 2)
+        pipe.execute.return_value = [None, []]
+        assert polling.restore() == (None, [], 0)
+
+    def test_run(self, mocker, settings):
+        settings.TG_POLL_TIMEOUT = 10
+        batches = [[{'update_id': 1}, {'update_id': 2}], [{'update_id': 3}]]
+        responses = iter(batches)
+        prefetched = threading.Event()
+        handled = []
+
+        def get_updates(url, data, timeout):
+            if data.get('offset') == 3:
+                prefetched.set()
+            return next(responses, [])
+
+        def handle(updates):
+            if updates[0]['update_id'] == 1:
+                # the next batch is fetched while this one is handled
+                assert prefetched.wait(5)
+            handled.append(updates)
+            if len(handled) == 2:
+                polling.stop()
+
+        bot = Mock(base_url='https://api/bot1')
+        bot.request.post.side_effect = get_updates
+        pipe = redis.rc.pipeline.return_value
+        pipe.execute.return_value = [None, []]
+        polling = intake.PollingIntake(bot, handle, allowed_updates=['message'])
+        polling.run()
+
+        bot.delete_webhook.assert_called_once_with()
+        assert handled == batches
+        assert bot.request.post.call_args_list[:2] == [
+            mocker.call('https://api/bot1/getUpdates', {
+                'limit': 100, 'timeout': 0, 'allowed_updates': ['message'],
+            }, timeout=5),
+            mocker.call('https://api/bot1/getUpdates', {
+                'limit': 100, 'timeout': 10, 'offset': 3, 'allowed_updates': ['message'],
+            }, timeout=15),
+        ]
+        redis.rc.rpush.assert_any_call(
+            intake.PENDING_KEY, '{"update_id": 1}', '{"update_id": 2}'
+        )
+        assert pipe.set.call_args_list == [
+            mocker.call(intake.OFFSET_KEY, 3), mocker.call(intake.OFFSET_KEY, 4),
+        ]
+        assert pipe.ltrim.call_args_list == [
+            mocker.call(intake.PENDING_KEY, 2, -1), mocker.call(intake.PENDING_KEY, 1, -1),
+        ]
+
+    def test_commit_handled(self, mocker):
+        commit = mocker.patch.object(intake.PollingIntake, 'commit')
+        unfinished = intake.Unfinished()
+        polling = intake.PollingIntake(Mock(), Mock(), unfinished=unfinished.lowest)
+        for update_id in (2, 4):
+            unfinished.add(update_id)
+        polling._handled(5, [{'update_id': i} for i in range(1, 5)])
+        commit.assert_called_once_with(2, 1)
+        unfinished.done(2)
+        polling._handled(5, [])
+        commit.assert_called_with(4, 2)
+        unfinished.done(4)
+        polling._handled(6, [{'update_id': 5}])
+        commit.assert_called_with(6, 2)
+        # nothing changed
+        polling._handled(6, [])
+        assert commit.call_count == 3
+
+    def test_failed_batch_is_retried(self, mocker):
+        polling = intake.PollingIntake(Mock(), Mock(side_effect=[ValueError, None]))
+        mocker.patch.object(polling._stopped, 'wait')
+        assert polling._handle([{'update_id': 1}])
+        assert polling.handle.call_count == 2
+        polling.stop()
+        assert not polling._handle([{'update_id': 1}])
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestSharding:
+    def test_shard_of(self, settings):
+        settings.UPDATES_SHARDS = 8
+        chats = range(-1000, 1000)
+        shards = [sharding.shard_of(chat) for chat in chats]
+        assert shards == [sharding.shard_of(chat) for chat in chats]
+        assert set(shards) == set(range(8))
+        assert sharding.shard_of('abc') == sharding.shard_of('abc')
+        # adding a shard moves only keys that go to the new shard
+        settings.UPDATES_SHARDS = 9
+        for chat, shard in zip(chats, shards):
+            assert sharding.shard_of(chat) in (shard, 8)
+
+    def test_assign(self):
+        workers = ['a', 'b', 'c']
+        before = sharding.assign(64, workers)
+        assert sorted(sum(before.values(), [])) == list(range(64))
+        assert all(before.values())
+        after = sharding.assign(64, workers + ['d'])
+        # new worker takes shards from others, the rest stay in place
+        for worker in workers:
+            assert set(after[worker]) <= set(before[worker])
+        assert after['d']
+        assert sharding.assign(4, []) == {}
+
+    def test_membership(self, settings):
+        settings.UPDATES_SHARDS = 4
+        settings.UPDATES_WORKER_TIMEOUT = 10
+        pipe = redis.rc.pipeline.return_value
+        pipe.execute.return_value = [1, 0, [b'a']]
+        membership = sharding.Membership('a')
+        assert membership.heartbeat() == [0, 1, 2, 3]
+        pipe.zadd.assert_called_once_with(sharding.WORKERS_KEY, {'a': ANY})
+        pipe.execute.return_value = [1, 0, [b'a', b'b']]
+        assert membership.heartbeat() == sharding.assign(4, ['a', 'b'])['a']
+        membership.leave()
+        redis.rc.zrem.assert_called_once_with(sharding.WORKERS_KEY, 'a')
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestWebhookReply:
+    def test_respond(self):
+        request = Mock()
+        bot = Bot(TOKEN, request=api.WebhookReplyRequest(request))
+        api.respond(bot.answer_callback_query, '1')
+        assert request.post.call_count == 1
+
+        with api.webhook_reply() as reply:
+            bot.delete_message(1, 1)  # not allowed to respond
+            assert api.respond(bot.answer_callback_query, '1', 'text') is True
+            assert not api.can_respond()
+            api.respond(bot.answer_callback_query, '2')
+        assert reply.data == {
+            'method': 'answerCallbackQuery', 'callback_query_id': '1', 'text': 'text',
+        }
+        assert request.post.call_count == 3
+        assert not api.can_respond()
+
+    def test_edit_reply_markup(self, mocker):
+        bot = Mock()
+        markup = InlineKeyboardMarkup([])
+        redis.rc.get.return_value = None
+        mocker.spy(metrics, 'observe')
+        with api.webhook_reply():
+            assert edit_reply_markup(bot, 'msg', markup, chat_id=1, message_id=1)
+        bot.edit_message_reply_markup.assert_called_once_with(
+            reply_markup=markup, chat_id=1, message_id=1
+        )
+        # response time of telegram is unknown
+        metrics.observe.assert_not_called()
+
+    def test_view(self, rf, settings, mocker):
+        settings.WEBHOOK_QUEUE = False
+
+        def process_update(dispatcher, data, router):
+            api.respond(dispatcher.bot.answer_callback_query, data['callback_query']['id'])
+
+        dispatcher = Mock(bot=Bot(TOKEN, request=api.WebhookReplyRequest(Mock())))
+        mocker.patch('bot.views.dispatcher', dispatcher, create=True)
+        mocker.patch('bot.views.router', None, create=True)
+        mocker.patch('bot.update_queue.process_update', side_effect=process_update)
+        body = json.dumps({'update_id': 1, 'callback_query': {'id': '5'}})
+        response = process_update_view(rf.post('/', body, content_type='application/json'))
+        assert response.status_code == 200
+        assert json.loads(response.content) == {
+            'method': 'answerCallbackQuery', 'callback_query_id': '5',
+        }
+
+
+@pytest.mark.usefixtures('mock_redis')
+class TestKeyedExecutor:
+    def test_order_within_key(self):
+        executor = KeyedExecutor(4, name='test')
+        done = {1: [], 2: []}
+        for i in range(50):
+            for key in done:
+                executor.submit(key, done[key].append, i)
+        executor.shutdown()
+        assert done == {1: list(range(50)), 2: list(range(50))}
+
+    def test_keys_in_parallel(self):
+        executor = KeyedExecutor(2, name='test')
+        release = threading.Event()
+        executor.submit('hot', release.wait, 5)
+        executor.submit('hot', release.wait, 5)
+        other = threading.Event()
+        executor.submit('other', other.set)
+        # hot key occupies one thread only
+        assert other.wait(5)
+        assert executor.pending('hot') == 1
+        release.set()
+        assert executor.join(5)
+
+    def test_key_takes_turns(self):
+        executor = KeyedExecutor(1, name='test')
+        release = threading.Event()
+        order = []
+        executor.submit('hot', release.wait, 5)
+        for i in range(2):
+            executor.submit('hot', order.append, f'hot {i}')
+        executor.submit('other', order.append, 'other')
+        release.set()
+        executor.shutdown()
+        # other key doesn't wait for the whole queue of hot key
+        assert order == ['other', 'hot 0', 'hot 1']
+
+    def test_queue_limit(self, mocker):
+        mocker.spy(metrics, 'inc')
+        executor = KeyedExecutor(1, max_queue=2, name='test')
+        release = threading.Event()
+        assert executor.submit(1, release.wait, 5)
+        # first task may be still in queue
+        while executor.pending(1):
+            pass
+        assert executor.submit(1, list)
+        assert executor.submit(1, list)
+        assert not executor.submit(1, list)
+        assert executor.submit(2, list)
+        assert metrics.inc.call_args_list.count(mocker.call('test_dropped')) == 1
+        release.set()
+        executor.shutdown()
+
+    def test_wait_room(self):
+        executor = KeyedExecutor(1, max_queue=1, name='test')
+        release = threading.Event()
+        executor.submit(1, release.wait, 5)
+        while executor.pending(1):
+            pass
+        executor.submit(1, list)
+        assert not executor.wait_room(1, timeout=0.01)
+        assert executor.wait_room(2, timeout=0)
+        release.set()
+        assert executor.wait_room(1, timeout=5)
+        executor.shutdown()
+
+    def test_get_data_key(self):
+        chat = {'id': -1}
+        user = {'id': 1}
+        assert get_data_key({'update_id': 1, 'message': {'chat': chat, 'from': user}}) == -1
+        assert get_data_key({'update_id': 1, 'callback_query': {
+            'from': user, 'message': {'chat': chat},
+        }}) == -1
+        assert get_data_key({'update_id': 1, 'callback_query': {
+            'from': user, 'inline_message_id': 'a',
+        }}) == 1
+        assert get_data_key({'update_id': 1, 'inline_query': {'from': user}}) == 1
+        assert get_data_key({'update_id': 5}) == 5
+
+
+class TestContextData:
+    def test_size(self):
+        data = ContextData('test', 2, 60)
+        data[1]['a'] = 1
+        data[2]['b'] = 2
+        assert data[1] == {'a': 1}
+        # 2 is the least recently used
+        data[3]['c'] = 3
+        assert sorted(data) == [1, 3]
+        assert data[2] == {}
+        assert len(data) == 2
+
+    def test_ttl(self, mocker):
+        mocker.spy(metrics, 'inc')
+        now = mocker.patch('time.monotonic', return_value=100)
+        data = ContextData('test', 10, 60)
+        data[1]['a'] = 1
+        data[2]['b'] = 2
+        now.return_value = 150
+        assert data[1] == {'a': 1}
+        now.return_value = 211
+        assert data[1] == {}
+        data[3]['c'] = 3
+        assert sorted(data) == [1, 3]
+        # 2 is expired, evictions are counted at most once a second
+        assert metrics.inc.call_args_list == [mocker.call('test_evicted', 1)]
+
+    def test_contains(self, mocker):
+        now = mocker.patch('time.monotonic', return_value=100)
+        data = ContextData('test', 1, 60)
+        data[1]['a'] = 1
+        # lookups don't add entries, so they don't evict 1
+        assert 2 not in data
+        assert data.get(2) is None
+        assert data.get(1) == {'a': 1}
+        assert 1 in data
+        assert list(data) == [1]
+        now.return_value = 161
+        assert 1 not in data
+        assert data.get(1, 'default') == 'default'
+
+    def test_no_size(self):
+        data = ContextData('test', 0, 60)
+        data[1]['a'] = 1
+        data[2] = {'b': 2}
+        assert data[1] == {}
+        assert not len(data)
+
+    def test_dispatcher(self, settings):
+        settings.CONTEXT_DATA_SIZE = 100
+        settings.CONTEXT_DATA_TTL = 3600
+        dp = IndexedDispatcher(Bot(TOKEN), None, workers=0, use_context=True)
+        setup_dispatcher(dp)
+        assert isinstance(dp.user_data, ContextData)
+        for i in range(1, 1001):
+            message = TGMessage(i, TGUser(i, 'user', False), None, TGChat(-i, TGChat.GROUP))
+            context = CallbackContext.from_update(Update(i, message=message), dp)
+            context.user_data['seen'] = i
+            context.chat_data['seen'] = i
+        assert len(dp.user_data) == len(dp.chat_data) == 100
+        assert dp.user_data[1000] == {'seen': 1000}
+        bound_context_data(dp)
+        assert not len(dp.user_data)
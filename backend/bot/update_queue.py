@@ -0,0 +1,272 @@
+"""
+Durable queue of updates received by webhook or polling intake.
+
+Webhook view (or `manage.py runintake`) only validates an update and appends it to redis stream
+of its chat's shard (see `bot.sharding`), so Telegram gets its response before any processing.
+`Worker` processes updates of its shards as a member of consumer group `GROUP` and acknowledges
+them after processing. Updates of a chat are processed in order (see `bot.keyed_executor`),
+but when a shard moves to another worker, the new owner may start before the old one finishes.
+Entries that weren't acknowledged for `UPDATES_CLAIM_IDLE` seconds (worker died or hung)
+are claimed by other workers, entries that were delivered `UPDATES_MAX_DELIVERIES` times
+are dropped.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+from redis import ResponseError
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from bot import admins, metrics, redis, routing
+from bot.keyed_executor import KeyedExecutor, get_data_key
+from bot.routing import Router, get_update_type
+from bot.sharding import Membership, shard_of
+
+logger = logging.getLogger(__name__)
+
+STREAM = 'updates'
+GROUP = 'workers'
+# number of oldest pending entries checked for being stuck
+CLAIM_SCAN = 100
+
+
+def parse(body: bytes) -> Optional[dict]:
+    """Return decoded update or None if it isn't an update."""
+    try:
+        data = routing.loads(body)
+    except ValueError:
+        return
+    if isinstance(data, dict) and isinstance(data.get('update_id'), int):
+        return data
+
+
+def stream_key(shard: int) -> str:
+    return f'{STREAM}:{shard}'
+
+
+def push(body: bytes, data: dict, pipe=None):
+    """Append update to stream of its shard, `data` is decoded `body`."""
+    stream = stream_key(shard_of(get_data_key(data)))
+    (pipe or redis.rc).xadd(stream, {'update': body}, maxlen=settings.UPDATES_STREAM_MAXLEN)
+
+
+def push_many(updates: List[dict]):
+    pipe = redis.rc.pipeline(transaction=False)
+    for data in updates:
+        push(routing.dumps(data), data, pipe)
+    pipe.execute()
+
+
+def entry_age(entry_id) -> float:
+    """Seconds since entry was added to stream (its ID starts with timestamp in ms)."""
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    return max(0.0, time.time() - int(entry_id.split('-')[0]) / 1000)
+
+
+def process_update(dispatcher: Dispatcher, data: dict, router: Router = None):
+    """Process decoded update, only updates accepted by `router` are decoded to objects."""
+    metrics.inc(f'update_type:{get_update_type(data)}')
+    if admins.apply_chat_member_update(data):
+        # python-telegram-bot doesn't know these updates
+        return
+    if router is not None and not router.accepts(data):
+        metrics.inc('updates_unrouted')
+        return
+    update = Update.de_json(data, dispatcher.bot)
+    dispatcher.process_update(update)
+
+
+class Worker:
+    """
+    Consumer of streams of its shards that processes up to `threads` updates at once
+    and holds at most twice as many (while they wait for other updates of their chats).
+    """
+    def __init__(self, dispatcher: Dispatcher, threads: int, name: str = None,
+                 router: Router = None):
+        self.dispatcher = dispatcher
+        self.router = router
+        self.threads = threads
+        self.capacity = threads * 2
+        self.name = name or f'{socket.gethostname()}-{os.getpid()}'
+        self._executor = KeyedExecutor(
+            threads, max_queue=settings.CHAT_QUEUE_SIZE, name='queued_updates'
+        )
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._stopped = threading.Event()
+        self._claimed_at = 0.0
+        self.membership = Membership(self.name)
+        self.streams: List[str] = []
+        self._heartbeat: Optional[threading.Thread] = None
+        self._left = threading.Event()
+
+    @staticmethod
+    def ensure_group(stream):
+        try:
+            redis.rc.xgroup_create(stream, GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def rebalance(self):
+        """Send heartbeat and switch to the shards that are assigned to worker now."""
+        streams = [stream_key(shard) for shard in self.membership.heartbeat()]
+        if streams != self.streams:
+            for stream in set(streams) - set(self.streams):
+                self.ensure_group(stream)
+            metrics.inc('shard_rebalances')
+            self.streams = streams
+            # take over entries of the previous owner
+            self._claimed_at = 0.0
+
+    def start_heartbeat(self):
+        """
+        Join workers and keep sending heartbeats from a separate thread,
+        so worker isn't dropped while it waits for busy threads.
+        """
+        self.rebalance()
+        self._heartbeat = threading.Thread(
+            target=self._send_heartbeats, name=f'{self.name}-heartbeat', daemon=True
+        )
+        self._heartbeat.start()
+
+    def _send_heartbeats(self):
+        while not self._left.wait(settings.UPDATES_WORKER_TIMEOUT / 3):
+            try:
+                self.rebalance()
+            except Exception:
+                logger.exception("failed to send heartbeat")
+
+    def _process(self, stream, entry_id, data: dict):
+        try:
+            process_update(self.dispatcher, data, self.router)
+            metrics.inc('queued_updates_processed')
+        except Exception:
+            # stays pending and will be redelivered
+            logger.exception(f"failed to process update {entry_id}")
+            metrics.inc('queued_updates_failed')
+            return
+        finally:
+            close_old_connections()
+            self._slots.release()
+        redis.rc.xack(stream, GROUP, entry_id)
+
+    def submit(self, stream, entries):
+        for entry_id, fields in entries:
+            data = fields and parse(fields[b'update'])
+            if data is None:
+                # trimmed from stream before it was processed, dropped after max deliveries
+                if fields:
+                    logger.error(f"invalid update {entry_id}: {fields}")
+                if entry_id is not None:
+                    redis.rc.xack(stream, GROUP, entry_id)
+                self._slots.release()
+                continue
+            metrics.observe('shard_lag_seconds', entry_age(entry_id))
+            key = get_data_key(data)
+            while not self._executor.submit(key, self._process, stream, entry_id, data):
+                # too many updates of the chat: stop reading until one of them is processed,
+                # redelivered entry would be processed after later updates of the chat
+                metrics.inc('queued_updates_backpressure')
+                self._executor.wait_room(key)
+
+    def _take_slots(self) -> int:
+        """Wait for a free thread and take all free ones, return their number."""
+        self._slots.acquire()
+        count = 1
+        while count < self.capacity and self._slots.acquire(blocking=False):
+            count += 1
+        return count
+
+    def _release_slots(self, count):
+        for _ in range(count):
+            self._slots.release()
+
+    def claim_stuck(self, stream, count: int) -> int:
+        """Take over entries that other workers didn't acknowledge in time, return their number."""
+        idle = int(settings.UPDATES_CLAIM_IDLE * 1000)
+        pending = redis.rc.xpending_range(stream, GROUP, '-', '+', CLAIM_SCAN)
+        stuck = []
+        for entry in pending:
+            if entry['time_since_delivered'] < idle:
+                continue
+            entry_id, deliveries = entry['message_id'], entry['times_delivered']
+            if deliveries >= settings.UPDATES_MAX_DELIVERIES:
+                logger.error(f"dropping update {entry_id} after {deliveries} deliveries")
+                metrics.inc('queued_updates_dropped')
+                redis.rc.xack(stream, GROUP, entry_id)
+                continue
+            stuck.append(entry_id)
+            if len(stuck) == count:
+                break
+        if not stuck:
+            return 0
+        entries = redis.rc.xclaim(stream, GROUP, self.name, idle, stuck)
+        metrics.inc('queued_updates_redelivered', len(entries))
+        self.submit(stream, entries)
+        return len(entries)
+
+    def poll(self, block_ms=1000):
+        """Read new entries (or claim stuck ones) for free threads and process them."""
+        if self._heartbeat is None:
+            self.start_heartbeat()
+        # may be switched by heartbeat thread
+        streams = self.streams
+        if not streams:
+            # more workers than shards, stand by
+            self._stopped.wait(block_ms / 1000)
+            return
+
+        slots = self._take_slots()
+        now = time.monotonic()
+        try:
+            if now - self._claimed_at >= settings.UPDATES_CLAIM_IDLE / 2:
+                self._claimed_at = now
+                for stream in streams:
+                    slots -= self.claim_stuck(stream, slots)
+                    if not slots:
+                        return
+            # count is per stream
+            count = -(-slots // len(streams))
+            response = redis.rc.xreadgroup(
+                GROUP, self.name, {stream: '>' for stream in streams},
+                count=count, block=block_ms,
+            )
+            for stream, entries in response or ():
+                if isinstance(stream, bytes):
+                    stream = stream.decode()
+                taken = min(slots, len(entries))
+                slots -= taken
+                for _ in range(len(entries) - taken):
+                    # entries are already delivered to this worker, wait for free threads
+                    self._slots.acquire()
+                self.submit(stream, entries)
+        finally:
+            self._release_slots(slots)
+
+    def run(self):
+        logger.info(f"worker {self.name} started with {self.threads} threads")
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("failed to read updates")
+                self._stopped.wait(1)
+
+    def stop(self):
+        self._stopped.set()
+
+    def shutdown(self):
+        """Wait for updates in progress and give shards to other workers."""
+        self._executor.shutdown(wait=True)
+        self._left.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        self.membership.leave()
+
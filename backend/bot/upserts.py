@@ -0,0 +1,149 @@
+"""
+Create or update users and chats only when their telegram data has changed.
+
+Fingerprints of (username, names, type) of rows that are known to be stored in DB are kept
+in an in-process LRU and, optionally, in redis so that they are shared by all processes.
+On a hit user is built in memory w/o touching DB and chat is taken from `bot.chat_config`.
+"""
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+from django.db.models.signals import post_delete
+from telegram import Chat as TGChat, Update, User as TGUser
+
+from bot import chat_config, metrics, redis
+from core.models import Chat, User
+
+logger = logging.getLogger(__name__)
+
+
+def make_fingerprint(*values) -> str:
+    return hashlib.md5(json.dumps(values).encode()).hexdigest()
+
+
+class FingerprintCache:
+    def __init__(self, name: str, maxsize: int = None, use_redis: bool = None):
+        self.name = name
+        self._maxsize = maxsize
+        self._use_redis = use_redis
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def maxsize(self) -> int:
+        return settings.UPSERT_CACHE_SIZE if self._maxsize is None else self._maxsize
+
+    @property
+    def use_redis(self) -> bool:
+        return settings.UPSERT_CACHE_REDIS if self._use_redis is None else self._use_redis
+
+    def _redis_key(self, key):
+        return f'upsert:{self.name}:{key}'
+
+    def _remember(self, key, fingerprint):
+        with self._lock:
+            self._data[key] = fingerprint
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def check(self, key, fingerprint) -> bool:
+        """Return True if row `key` is known to be stored with the same fingerprint."""
+        with self._lock:
+            hit = self._data.get(key) == fingerprint
+            if hit:
+                self._data.move_to_end(key)
+        if not hit and self.use_redis:
+            try:
+                stored = redis.rc.get(self._redis_key(key))
+            except Exception:
+                logger.exception("failed to get upsert fingerprint")
+                stored = None
+            hit = stored is not None and stored.decode() == fingerprint
+            if hit:
+                self._remember(key, fingerprint)
+                metrics.inc(f'{self.name}_upsert_redis_hits')
+        metrics.inc(f'{self.name}_upsert_hits' if hit else f'{self.name}_upsert_misses')
+        return hit
+
+    def store(self, key, fingerprint):
+        self._remember(key, fingerprint)
+        if self.use_redis:
+            try:
+                redis.rc.set(
+                    self._redis_key(key), fingerprint, ex=settings.UPSERT_CACHE_EXPIRY
+                )
+            except Exception:
+                logger.exception("failed to store upsert fingerprint")
+
+    def forget(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        if self.use_redis:
+            try:
+                redis.rc.delete(self._redis_key(key))
+            except Exception:
+                logger.exception("failed to delete upsert fingerprint")
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+user_cache = FingerprintCache('user')
+chat_cache = FingerprintCache('chat')
+
+
+def get_user(u: TGUser) -> User:
+    """Same as `User.objects.from_tg_user` but writes only if user's data has changed."""
+    key = str(u.id)
+    fingerprint = make_fingerprint(u.username, u.first_name, u.last_name)
+    if user_cache.check(key, fingerprint):
+        return User.from_db(
+            'default',
+            ['id', 'username', 'first_name', 'last_name'],
+            [key, u.username, u.first_name, u.last_name],
+        )
+    user = User.objects.from_tg_user(u)
+    user_cache.store(key, fingerprint)
+    return user
+
+
+def get_chat(tg_chat: TGChat) -> Chat:
+    """Same as `Chat.objects.from_tg_chat` but writes only if chat's data has changed."""
+    key = str(tg_chat.id)
+    fingerprint = make_fingerprint(
+        tg_chat.type, tg_chat.username, tg_chat.title, tg_chat.first_name, tg_chat.last_name
+    )
+    if chat_cache.check(key, fingerprint):
+        chat = chat_config.get_chat(key)
+        if chat is not None:
+            return chat
+        chat_cache.forget(key)
+    chat = Chat.objects.from_tg_chat(tg_chat)
+    chat_cache.store(key, fingerprint)
+    return chat
+
+
+def get_user_from_update(update: Update) -> User:
+    return get_user(update.effective_user)
+
+
+def get_chat_from_update(update: Update) -> Chat:
+    return get_chat(update.effective_chat)
+
+
+def forget_user(sender, instance: User, **kwargs):
+    user_cache.forget(str(instance.id))
+
+
+def forget_chat(sender, instance: Chat, **kwargs):
+    chat_cache.forget(str(instance.id))
+
+
+post_delete.connect(forget_user, sender=User, dispatch_uid='upserts_forget_user')
+post_delete.connect(forget_chat, sender=Chat, dispatch_uid='upserts_forget_chat')
@@ -1,41 +1,52 @@
+import time
+
 from django.conf import settings
 from django.utils.datastructures import OrderedSet
 from emoji import UNICODE_EMOJI
-from telegram import Bot, Message as TGMessage, Update, User as TGUser
+from telegram import Bot, InlineKeyboardMarkup, Message as TGMessage, Update, User as TGUser
+from telegram.error import BadRequest
 
-from bot.mwt import MWT
+from bot import admins, api, metrics, redis
+from bot.markup import markup_fingerprint
 from bot.redis import save_media_group
-from core.models import Chat, User
+from bot.upserts import get_chat, get_user
+
+# moving average of edit_message_reply_markup duration, used to estimate saved time
+_edit_markup_seconds = 0.0
 
 
-@MWT(timeout=60)
 def get_admin_ids(bot, chat_id):
-    """Returns a set of admin IDs for a given chat. Results are cached for 1 minute."""
-    return {admin.user.id for admin in bot.get_chat_administrators(chat_id)}
+    """Returns a set of admin IDs for a given chat. Results are cached in redis."""
+    return admins.get_admin_ids(bot, chat_id)
 
 
-def user_is_chat_admin(bot, user_id, chat_id):
-    return user_id in get_admin_ids(bot, chat_id)
+def user_is_chat_admin(bot, user_id, chat_id, verify=False):
+    return admins.is_chat_admin(bot, user_id, chat_id, verify=verify)
 
 
 def user_is_admin(bot, update: Update):
-    return user_is_chat_admin(bot, update.effective_user.id, update.effective_chat.id)
+    """Used by admin-only handlers, so user's status is confirmed by telegram."""
+    return user_is_chat_admin(
+        bot, update.effective_user.id, update.effective_chat.id, verify=True
+    )
 
 
 def bot_is_admin(bot, update):
-    return user_is_chat_admin(bot, bot.id, update.effective_chat.id)
+    return admins.get_bot_status(bot, update.effective_chat.id)
 
 
 def try_delete(bot, update, msg):
     if bot_is_admin(bot, update):
-        msg.delete()
+        api.defer(msg.delete)
 
 
-def get_message_type(msg: TGMessage):
-    if msg.media_group_id:
-        if save_media_group(msg.media_group_id):
-            return 'album'
-        return
+def get_raw_message_type(msg: TGMessage, albums=True):
+    """
+    Same as `get_message_type` but w/o side effects: every message of album is 'album'
+    (unless `albums` is False).
+    """
+    if albums and msg.media_group_id:
+        return 'album'
     if any((e['type'] == 'url' for e in msg.entities)):
         return 'link'
     for field in settings.MESSAGE_TYPES:
@@ -43,15 +54,23 @@ def get_message_type(msg: TGMessage):
             return field
 
 
+def get_message_type(msg: TGMessage):
+    if msg.media_group_id:
+        if save_media_group(msg.media_group_id):
+            return 'album'
+        return
+    return get_raw_message_type(msg)
+
+
 def get_forward_from(msg: TGMessage):
     if msg.forward_from:
         u: TGUser = msg.forward_from
-        return User.objects.from_tg_user(u)
+        return get_user(u)
 
 
 def get_forward_from_chat(msg: TGMessage):
     if msg.forward_from_chat:
-        return Chat.objects.from_tg_chat(msg.forward_from_chat)
+        return get_chat(msg.forward_from_chat)
 
 
 def clear_buttons(buttons: list, emojis=False):
@@ -61,9 +80,10 @@ def clear_buttons(buttons: list, emojis=False):
     return buttons
 
 
-def repost_message(msg: TGMessage, bot: Bot, msg_type, reply_markup):
+def repost_message(msg: TGMessage, bot: Bot, msg_type, reply_markup, reply_to_message_id=None):
     config = {
         'chat_id': msg.chat_id,
+        'reply_to_message_id': reply_to_message_id,
         'text': msg.text_html,
         'caption': msg.caption_html,
         'disable_notification': True,
@@ -96,3 +116,52 @@ def repost_message(msg: TGMessage, bot: Bot, msg_type, reply_markup):
     else:
         sent_msg = None
     return sent_msg
+
+
+def edit_reply_markup(
+    bot: Bot,
+    key,
+    reply_markup: InlineKeyboardMarkup,
+    respond=True,
+    **ids,
+):
+    """
+    Edit markup of the message unless the same markup is already displayed.
+
+    :param key: unique message ID, used as a key for fingerprint of the last sent markup
+    :param respond: edit may be sent as response to webhook request (its errors aren't raised)
+    :param ids: chat_id, message_id and inline_message_id for telegram
+    :return: True if markup was sent to telegram
+    """
+    global _edit_markup_seconds
+    fingerprint = markup_fingerprint(reply_markup)
+    if not redis.claim_markup_fingerprint(key, fingerprint):
+        metrics.inc('markup_edits_skipped')
+        metrics.inc('markup_edits_skipped_seconds', _edit_markup_seconds)
+        return False
+
+    if respond and api.can_respond():
+        # sent as response to webhook request, telegram doesn't report its result,
+        # so claimed fingerprint is kept
+        api.respond(bot.edit_message_reply_markup, reply_markup=reply_markup, **ids)
+        return True
+
+    sent = False
+    start = time.monotonic()
+    try:
+        bot.edit_message_reply_markup(reply_markup=reply_markup, **ids)
+        sent = True
+    except BadRequest as e:
+        if 'not modified' not in str(e):
+            raise
+        sent = True
+        metrics.inc('markup_edits_not_modified')
+    finally:
+        elapsed = time.monotonic() - start
+        if _edit_markup_seconds:
+            _edit_markup_seconds = 0.9 * _edit_markup_seconds + 0.1 * elapsed
+        else:
+            _edit_markup_seconds = elapsed
+        metrics.observe('markup_edit_seconds', elapsed)
+        redis.confirm_markup_fingerprint(key, fingerprint, sent)
+    return True
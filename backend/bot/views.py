@@ -1,23 +1,29 @@
-import json
-
 from django.conf import settings
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from telegram import Update, Bot
-from telegram.ext import Dispatcher
-
-from bot.dispatcher import setup_dispatcher
+from bot import api, routing, update_queue
+from bot.dispatcher import IndexedDispatcher, setup_dispatcher
 
-if settings.WEBHOOK_URL:
-    bot = Bot(settings.TG_BOT_TOKEN)
-    dispatcher = Dispatcher(bot, update_queue=None, use_context=True)
-    setup_dispatcher(dispatcher, inspect=False)
+if settings.WEBHOOK_URL and not settings.WEBHOOK_QUEUE:
+    bot = api.make_bot()
+    dispatcher = IndexedDispatcher(bot, update_queue=None, use_context=True)
+    router = routing.Router(setup_dispatcher(dispatcher, inspect=False))
 
 
 @csrf_exempt
 def process_update_view(request: HttpRequest):
     if request.method == 'POST':
-        data = json.loads(request.body)
-        update = Update.de_json(data, bot)
-        dispatcher.process_update(update)
+        if settings.WEBHOOK_QUEUE:
+            data = update_queue.parse(request.body)
+            if data is None:
+                return HttpResponseBadRequest()
+            # processed by `manage.py runworker`
+            update_queue.push(request.body, data)
+        else:
+            with api.webhook_reply() as reply:
+                data = routing.loads(request.body)
+                update_queue.process_update(dispatcher, data, router)
+            if reply.data is not None:
+                # Telegram makes this call by itself
+                return JsonResponse(reply.data)
     return HttpResponse()
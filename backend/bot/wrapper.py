@@ -10,7 +10,7 @@ from telegram.ext import (
     run_async,
 )
 
-from . import utils
+from . import redis, utils
 
 
 class HandlerWrapper:
@@ -20,12 +20,13 @@ class HandlerWrapper:
             logger = logging.getLogger(func.__module__)
             logger.debug(f"☎️  CALLING: {func.__name__:30s}")
             logger.debug(f"📑\n{update}")
-            if admin_required:
-                if utils.user_is_admin(context.bot, update):
+            with redis.state_session(update):
+                if admin_required:
+                    if utils.user_is_admin(context.bot, update):
+                        return func(update, context)
+                    update.message.reply_text("Only admin can use this command.")
+                else:
                     return func(update, context)
-                update.message.reply_text("Only admin can use this command.")
-            else:
-                return func(update, context)
 
         if use_async:
             callback = run_async(callback)
@@ -0,0 +1,24 @@
+from django.core.management import BaseCommand
+
+from core.models import Message
+
+
+class Command(BaseCommand):
+    help = 'Rebuild snapshots of button counts stored on messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--missing', action='store_true', help="Only messages without snapshot."
+        )
+        parser.add_argument('-b', '--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        qs = Message.objects.all()
+        if options.get('missing'):
+            qs = qs.filter(button_counts__isnull=True)
+        ids = list(qs.order_by('date').values_list('id', flat=True))
+        batch_size = options.get('batch_size')
+        total = 0
+        for i in range(0, len(ids), batch_size):
+            total += Message.objects.filter(id__in=ids[i:i + batch_size]).rebuild_button_counts()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt button counts of {total} messages."))
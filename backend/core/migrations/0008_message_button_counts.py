@@ -0,0 +1,137 @@
+from importlib import import_module
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+previous = import_module('core.migrations.0007_toggle_reaction')
+
+TOGGLE_REACTION_SQL = """
+CREATE OR REPLACE FUNCTION core_toggle_reaction(
+    p_user_id text,
+    p_username text,
+    p_first_name text,
+    p_last_name text,
+    p_message_id text,
+    p_text text,
+    p_max_buttons integer
+) RETURNS json AS $$
+DECLARE
+    v_button core_button%ROWTYPE;
+    v_button_id integer;
+    v_old_button_id integer;
+    v_reaction_id integer;
+    v_index integer;
+    v_buttons json;
+BEGIN
+    INSERT INTO core_user (id, username, first_name, last_name)
+    VALUES (p_user_id, p_username, p_first_name, p_last_name)
+    ON CONFLICT (id) DO NOTHING;
+
+    -- serialize reactions to the message to keep its button counts snapshot consistent
+    PERFORM 1 FROM core_message WHERE id = p_message_id FOR NO KEY UPDATE;
+
+    LOOP
+        SELECT id INTO v_button_id FROM core_button
+        WHERE message_id = p_message_id AND text = p_text;
+
+        IF v_button_id IS NULL THEN
+            SELECT coalesce(max(index) + 1, 0) INTO v_index
+            FROM core_button WHERE message_id = p_message_id;
+            IF v_index < p_max_buttons THEN
+                INSERT INTO core_button (message_id, index, text, count, permanent)
+                VALUES (p_message_id, v_index, p_text, 0, false)
+                ON CONFLICT (message_id, text) DO NOTHING;
+            END IF;
+            SELECT id INTO v_button_id FROM core_button
+            WHERE message_id = p_message_id AND text = p_text;
+            IF v_button_id IS NULL THEN
+                -- too many buttons
+                RETURN NULL;
+            END IF;
+        END IF;
+
+        SELECT id, button_id INTO v_reaction_id, v_old_button_id FROM core_reaction
+        WHERE user_id = p_user_id AND message_id = p_message_id
+        FOR UPDATE;
+
+        -- lock buttons in the same order in every transaction to avoid deadlocks
+        PERFORM 1 FROM core_button
+        WHERE id IN (v_button_id, v_old_button_id)
+        ORDER BY id
+        FOR UPDATE;
+        -- button was removed by concurrent reaction, start over
+        CONTINUE WHEN NOT EXISTS(SELECT 1 FROM core_button WHERE id = v_button_id);
+
+        IF v_reaction_id IS NULL THEN
+            -- user reacting first time
+            INSERT INTO core_reaction (user_id, message_id, button_id)
+            VALUES (p_user_id, p_message_id, v_button_id)
+            ON CONFLICT (user_id, message_id) DO NOTHING
+            RETURNING id INTO v_reaction_id;
+            -- concurrent click of the same user, start over
+            CONTINUE WHEN v_reaction_id IS NULL;
+            UPDATE core_button SET count = count + 1
+            WHERE id = v_button_id
+            RETURNING * INTO v_button;
+        ELSIF v_old_button_id = v_button_id THEN
+            -- clicked same button -> remove reaction
+            DELETE FROM core_reaction WHERE id = v_reaction_id;
+            v_reaction_id := NULL;
+            DELETE FROM core_button
+            WHERE id = v_button_id AND count = 1 AND NOT permanent
+            RETURNING * INTO v_button;
+            IF FOUND THEN
+                v_button.count := 0;
+            ELSE
+                UPDATE core_button SET count = greatest(count - 1, 0)
+                WHERE id = v_button_id
+                RETURNING * INTO v_button;
+            END IF;
+        ELSE
+            -- clicked another button -> change reaction
+            UPDATE core_reaction SET button_id = v_button_id WHERE id = v_reaction_id;
+            DELETE FROM core_button
+            WHERE id = v_old_button_id AND count = 1 AND NOT permanent;
+            UPDATE core_button SET count = count - 1
+            WHERE id = v_old_button_id AND count >= 1;
+            UPDATE core_button SET count = count + 1
+            WHERE id = v_button_id
+            RETURNING * INTO v_button;
+        END IF;
+        EXIT;
+    END LOOP;
+
+    SELECT coalesce(json_agg(json_build_array(text, count) ORDER BY index, id), '[]')
+    INTO v_buttons
+    FROM core_button
+    WHERE message_id = p_message_id;
+    UPDATE core_message SET button_counts = v_buttons::jsonb WHERE id = p_message_id;
+
+    RETURN json_build_object(
+        'reaction_id', v_reaction_id,
+        'button', row_to_json(v_button),
+        'buttons', v_buttons
+    );
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_toggle_reaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='button_counts',
+            field=django.contrib.postgres.fields.jsonb.JSONField(
+                blank=True,
+                help_text='Snapshot of (text, count) pairs of buttons, ordered by index.',
+                null=True
+            ),
+        ),
+        migrations.RunSQL(TOGGLE_REACTION_SQL, reverse_sql=previous.TOGGLE_REACTION_SQL),
+    ]
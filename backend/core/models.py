@@ -1,10 +1,10 @@
 import uuid
 from datetime import timedelta
-from typing import Tuple, List
+from typing import List, NamedTuple, Optional, Tuple
 
 from django.conf import settings
 from django.contrib.postgres.fields import ArrayField, JSONField
-from django.db import IntegrityError, models
+from django.db import IntegrityError, connection, models
 from django.utils import timezone
 from telegram import Chat as TGChat, Message as TGMessage, Update, User as TGUser
 
@@ -172,6 +172,23 @@ class MessageQuerySet(models.QuerySet):
         msg.set_buttons(buttons)
         return msg
 
+    def rebuild_button_counts(self) -> int:
+        """Rebuild button counts snapshots of messages from Button table in a single query."""
+        sql, params = self.values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE core_message m SET button_counts = coalesce((
+                    SELECT json_agg(json_build_array(b.text, b.count) ORDER BY b.index, b.id)
+                    FROM core_button b
+                    WHERE b.message_id = m.id
+                ), '[]')::jsonb
+                WHERE m.id IN ({sql})
+                """,
+                params,
+            )
+            return cursor.rowcount
+
     def delete_old(self, delta=None):
         # todo: filter out messages that are amongst 10 last messages of the chat
         delta = delta or timedelta(days=30)
@@ -220,6 +237,11 @@ class Message(TGMixin, models.Model):
         null=True,
         help_text="Telegram ID of original forwarded message w/o appended chat ID."
     )
+    button_counts = JSONField(
+        blank=True,
+        null=True,
+        help_text="Snapshot of (text, count) pairs of buttons, ordered by index.",
+    )
 
     objects = MessageQuerySet.as_manager()
 
@@ -279,6 +301,14 @@ class Message(TGMixin, models.Model):
             Button(message=self, index=index, text=text, permanent=permanent)
             for index, text in enumerate(buttons)
         ])
+        self.button_counts = [[text, 0] for text in buttons]
+        self.save(update_fields=['button_counts'])
+
+    def get_reactions(self) -> List[Tuple[str, int]]:
+        """(text, count) pairs of message's buttons. Uses snapshot if it was built."""
+        if self.button_counts is None:
+            return Button.objects.reactions(**self.ids)
+        return [(text, count) for text, count in self.button_counts]
 
     def __str__(self):
         ids = ', '.join(map(lambda e: f'{e[0]}={e[1]}', self.ids.items()))
@@ -329,6 +359,12 @@ class Button(models.Model):
         ordering = ('index',)
 
 
+class ReactionToggle(NamedTuple):
+    reaction: Optional['Reaction']
+    button: Optional[Button]
+    reactions: Optional[List[Tuple[str, int]]]
+
+
 class ReactionManager(models.Manager):
     def safe_create(self, user: TGUser, umid, button: Button, rerun=True):
         try:
@@ -343,6 +379,49 @@ class ReactionManager(models.Manager):
                 return self.safe_create(user, umid, button, rerun=False)
             raise
 
+    def toggle(
+        self, user: TGUser, chat_id, message_id, inline_message_id, button_text
+    ) -> ReactionToggle:
+        """
+        Add, change or remove user reaction in a single database round trip.
+
+        All the work is done by `core_toggle_reaction` SQL function (see migration 0007):
+        it creates missing user and button, upserts reaction and adjusts counters in place,
+        so parallel clicks on the same message can't lose updates.
+        Returns reaction (None if it was removed), clicked button (None if there are too many
+        buttons) and fresh (text, count) pairs of all message's buttons for rendering.
+        """
+        umid = Message.get_id(chat_id, message_id, inline_message_id)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT core_toggle_reaction(%s, %s, %s, %s, %s, %s, %s)',
+                [
+                    str(user.id),
+                    user.username,
+                    user.first_name,
+                    user.last_name,
+                    str(umid),
+                    button_text,
+                    settings.MAX_NUM_BUTTONS,
+                ],
+            )
+            result = cursor.fetchone()[0]
+        if not result:
+            # too many buttons
+            return ReactionToggle(None, None, None)
+
+        button = Button(**result['button'])
+        reaction = None
+        if result['reaction_id']:
+            reaction = Reaction(
+                id=result['reaction_id'],
+                user_id=str(user.id),
+                message_id=umid,
+                button=button,
+            )
+        reactions = [(text, count) for text, count in result['buttons']]
+        return ReactionToggle(reaction, button, reactions)
+
     def react(self, user: TGUser, chat_id, message_id, inline_message_id, button_text):
         """
         Add user reaction to the message.
@@ -351,34 +430,10 @@ class ReactionManager(models.Manager):
 
         Message-Button consistency should be guarantied by Telegram API.
         """
-        umid = Message.get_id(chat_id, message_id, inline_message_id)
-        button = Button.objects.get_for_reaction(button_text, umid)
-        if not button:
-            # too many buttons
-            return None, None
-        try:
-            r = Reaction.objects.get(
-                user_id=user.id,
-                message_id=umid,
-            )
-            # user already reacted...
-            # clicked same button -> remove reaction
-            if r.button_id == button.id:
-                r.delete()
-                r = None
-                button.dec()
-            else:
-                # clicked another button -> change reaction
-                old_btn = r.button
-                old_btn.dec()
-                button.inc()
-                r.button = button
-                r.save()
-        except Reaction.DoesNotExist:
-            # user reacting first time
-            r = self.safe_create(user, umid, button)
-            button.inc()
-        return r, button
+        reaction, button, _ = self.toggle(
+            user, chat_id, message_id, inline_message_id, button_text
+        )
+        return reaction, button
 
 
 class Reaction(models.Model):
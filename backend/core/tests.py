@@ -1,7 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 import pytest
 from django.conf import settings
+from django.db import connection
 from django.utils import timezone
 from telegram import Chat as TGChat, User as TGUser
 
@@ -119,6 +121,28 @@ class TestMessageModel:
     def test_split_umid(self):
         assert Message.split_id('a_b') == ['a', 'b']
 
+    def test_button_counts(self):
+        user = self.create_user()
+        msg = self.create_message(buttons=['a', 'b'])
+        assert msg.button_counts == [['a', 0], ['b', 0]]
+
+        Reaction.objects.toggle(user.tg, **msg.ids, button_text='c')
+        msg.refresh_from_db()
+        assert msg.get_reactions() == [('a', 0), ('b', 0), ('c', 1)]
+
+    def test_rebuild_button_counts(self):
+        user = self.create_user()
+        msg = self.create_message(buttons=['a', 'b'])
+        Reaction.objects.toggle(user.tg, **msg.ids, button_text='b')
+        Message.objects.filter(id=msg.id).update(button_counts=None)
+        msg.refresh_from_db()
+        assert msg.button_counts is None
+        assert msg.get_reactions() == [('a', 0), ('b', 1)]
+
+        assert Message.objects.filter(button_counts__isnull=True).rebuild_button_counts() == 1
+        msg.refresh_from_db()
+        assert msg.button_counts == [['a', 0], ['b', 1]]
+
 
 @pytest.mark.usefixtures('create_chat', 'create_message', 'create_button')
 @pytest.mark.django_db
@@ -267,6 +291,51 @@ class TestReactionModel:
         assert b1 is None
         assert r1 is None
 
+    def test_toggle_returns_reactions(self):
+        user = self.create_user()
+        msg = self.create_message(buttons=['a', 'b'])
+        r, b, reactions = Reaction.objects.toggle(user.tg, **msg.ids, button_text='b')
+        assert r is not None and b.text == 'b'
+        assert reactions == [('a', 0), ('b', 1)]
+
+        r, b, reactions = Reaction.objects.toggle(user.tg, **msg.ids, button_text='c')
+        assert b.index == 2
+        assert reactions == [('a', 0), ('b', 0), ('c', 1)]
+
+        # non-permanent button is removed with the last reaction
+        r, b, reactions = Reaction.objects.toggle(user.tg, **msg.ids, button_text='c')
+        assert r is None and b.count == 0
+        assert reactions == [('a', 0), ('b', 0)]
+
+    def test_toggle_too_many(self):
+        user = self.create_user()
+        msg = self.create_message(buttons=list(map(str, range(settings.MAX_NUM_BUTTONS))))
+        assert Reaction.objects.toggle(user.tg, **msg.ids, button_text='a') == (None, None, None)
+
+    @pytest.mark.django_db(transaction=True)
+    def test_toggle_concurrent(self):
+        users = [self.create_user() for _ in range(30)]
+        msg = self.create_message(buttons=['a', 'b'])
+
+        def click(user, text):
+            try:
+                Reaction.objects.toggle(user.tg, **msg.ids, button_text=text)
+            finally:
+                connection.close()
+
+        def click_all(clicks):
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                list(executor.map(lambda e: click(*e), clicks))
+
+        # everybody reacts with 'a' at once, a third of them clicks 'a' twice
+        click_all([(u, 'a') for u in users] + [(u, 'a') for u in users[:10]])
+        # a third switches to 'b', another third adds brand new 'c'
+        click_all([(u, 'b') for u in users[10:20]] + [(u, 'c') for u in users[20:]])
+
+        buttons = Button.objects.filter(message=msg).order_by('index')
+        assert list(buttons.values_list('text', 'count')) == [('a', 0), ('b', 10), ('c', 10)]
+        assert Reaction.objects.filter(message=msg).count() == 20
+
 
 @pytest.mark.usefixtures('create_user')
 @pytest.mark.django_db
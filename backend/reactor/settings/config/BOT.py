@@ -2,10 +2,65 @@ from os import getenv
 
 TG_BOT_TOKEN = getenv('TG_BOT_TOKEN')
 TG_BOT_WORKERS = int(getenv('TG_BOT_WORKERS', '4'))
+# updates of a chat are processed one by one, more queued updates of a chat are dropped
+CHAT_QUEUE_SIZE = int(getenv('CHAT_QUEUE_SIZE', 100))
 WEBHOOK_URL = getenv('WEBHOOK_URL')
+TG_POLL_TIMEOUT = int(getenv('TG_POLL_TIMEOUT', 10))  # seconds, long polling w/o backlog
+# dispatcher checks only handlers picked by update's kind, chat, command, reply and user's state
+HANDLER_INDEX = getenv('HANDLER_INDEX', 'true').lower() == 'true'
+# user_data/chat_data of dispatcher (unused by handlers) are kept for a limited number
+# of recently seen users/chats
+CONTEXT_DATA_SIZE = int(getenv('CONTEXT_DATA_SIZE', 1000))  # per process, 0 - keep nothing
+CONTEXT_DATA_TTL = int(getenv('CONTEXT_DATA_TTL', 60 * 60))  # seconds since last access
+# webhook only queues updates in redis streams, they are processed by `manage.py runworker`
+WEBHOOK_QUEUE = getenv('WEBHOOK_QUEUE', 'false').lower() == 'true'
+UPDATES_STREAM_MAXLEN = int(getenv('UPDATES_STREAM_MAXLEN', 100000))  # approximate
+UPDATES_CLAIM_IDLE = float(getenv('UPDATES_CLAIM_IDLE', 60))  # seconds, then redelivered
+UPDATES_MAX_DELIVERIES = int(getenv('UPDATES_MAX_DELIVERIES', 3))
+# queued updates are split by chat into shards, shards are split between live workers
+UPDATES_SHARDS = int(getenv('UPDATES_SHARDS', 16))
+UPDATES_WORKER_TIMEOUT = float(getenv('UPDATES_WORKER_TIMEOUT', 15))  # seconds w/o heartbeat
+# send API requests from a single asyncio loop, so handlers can skip waiting for responses
+TG_API_ASYNC = getenv('TG_API_ASYNC', 'false').lower() == 'true'
+TG_API_MAX_CONNECTIONS = int(getenv('TG_API_MAX_CONNECTIONS', 100))  # per process
+# outbound rate limits (per process), calls that hit RetryAfter are retried
+TG_RATE_LIMIT = getenv('TG_RATE_LIMIT', 'true').lower() == 'true'
+TG_RATE_GLOBAL = float(getenv('TG_RATE_GLOBAL', 30))  # calls per second
+TG_RATE_GROUP = float(getenv('TG_RATE_GROUP', 20))  # messages per minute per group
+TG_RATE_PRIVATE = float(getenv('TG_RATE_PRIVATE', 1))  # messages per second per private chat
+TG_RATE_RETRIES = int(getenv('TG_RATE_RETRIES', 2))
 
 REDIS_URL = getenv('REDIS_URL', 'redis://localhost:6379/0')
 
+# reactions
+REACTIONS_BACKEND = getenv('REACTIONS_BACKEND', 'db')  # db or redis
+REACTIONS_FLUSH_INTERVAL = int(getenv('REACTIONS_FLUSH_INTERVAL', 5))  # seconds
+REACTIONS_CACHE_EXPIRY = int(getenv('REACTIONS_CACHE_EXPIRY', 24 * 60 * 60))  # seconds
+# answer callback queries before DB work, reaction is confirmed only by updated markup
+CALLBACK_FAST_ACK = getenv('CALLBACK_FAST_ACK', 'true').lower() == 'true'
+# max one markup edit per message per window, 0 - edit on every click
+MARKUP_UPDATE_WINDOW = float(getenv('MARKUP_UPDATE_WINDOW', 1))  # seconds
+
+# skip user/chat updates if their telegram data wasn't changed
+UPSERT_CACHE_SIZE = int(getenv('UPSERT_CACHE_SIZE', 10000))  # per process, 0 - disable
+UPSERT_CACHE_REDIS = getenv('UPSERT_CACHE_REDIS', 'true').lower() == 'true'
+UPSERT_CACHE_EXPIRY = int(getenv('UPSERT_CACHE_EXPIRY', 24 * 60 * 60))  # seconds
+
+# chat settings cache, invalidated by pub/sub on every chat save
+CHAT_CACHE_SIZE = int(getenv('CHAT_CACHE_SIZE', 10000))  # per process, 0 - disable
+CHAT_CACHE_TTL = int(getenv('CHAT_CACHE_TTL', 60))  # seconds, per process
+CHAT_CACHE_EXPIRY = int(getenv('CHAT_CACHE_EXPIRY', 24 * 60 * 60))  # seconds, redis
+
+# admin lists, shared by processes (admin-only actions confirm status by getChatMember)
+ADMIN_CACHE_EXPIRY = int(getenv('ADMIN_CACHE_EXPIRY', 6 * 60 * 60))  # seconds, full refresh
+ADMIN_REFRESH_COOLDOWN = int(getenv('ADMIN_REFRESH_COOLDOWN', 60))  # seconds, refresh on miss
+
+# parts of album are collected for this time and then reposted together
+ALBUM_WINDOW = float(getenv('ALBUM_WINDOW', 1.5))  # seconds
+
+# metrics
+METRICS_FLUSH_INTERVAL = int(getenv('METRICS_FLUSH_INTERVAL', 10))  # seconds
+
 # donation
 GITHUB_URL = getenv('GITHUB_URL')
 PATREON_URL = getenv('PATREON_URL')
@@ -3,3 +3,8 @@ from .base import *
 
 SECRET_KEY = 'secret'
 TG_BOT_TOKEN = '000000000:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+MARKUP_UPDATE_WINDOW = 0
+UPSERT_CACHE_SIZE = 0
+UPSERT_CACHE_REDIS = False
+CHAT_CACHE_SIZE = 0
+ALBUM_WINDOW = 0
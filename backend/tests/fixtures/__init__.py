@@ -1,4 +1,4 @@
-from .mockers import mock_bot, mock_redis
+from .mockers import mock_bot, mock_redis, real_redis
 from .models import create_user, create_chat, create_message, create_button
 from .tg import (
     create_tg_user,
@@ -1,4 +1,6 @@
 import pytest
+from django.conf import settings
+from redis import ConnectionError as RedisConnectionError, ConnectionPool, Redis
 from telegram import Bot
 
 from bot import redis
@@ -35,3 +37,20 @@ def mock_bot(mocker, create_tg_user):
 @pytest.fixture
 def mock_redis(mocker):
     mocker.patch.object(redis, 'rc')
+
+
+@pytest.fixture
+def real_redis(mocker):
+    """
+    Redis at `REDIS_URL` for testing scripts, its database 15 is used and flushed after test.
+    Test is skipped if redis isn't running.
+    """
+    kwargs = ConnectionPool.from_url(settings.REDIS_URL).connection_kwargs
+    client = Redis(**{**kwargs, 'db': 15, 'socket_connect_timeout': 1})
+    try:
+        client.flushdb()
+    except RedisConnectionError:
+        pytest.skip("redis isn't running")
+    mocker.patch.object(redis, 'rc', client)
+    yield client
+    client.flushdb()